@@ -2,6 +2,14 @@ from django.contrib import admin
 from .models import FAQ,FAQLearning, UserQuery
 
 
-admin.site.register(FAQ)
+# Бот держит ответы FAQ в памяти (chatbot/search.py). Правки здесь помечают индекс устаревшим
+# сигналами моделей (chatbot/signals.py), а процесс бота замечает их по отпечатку таблицы
+# (число строк и последний updated_at) и перестраивает индекс в течение FAQ_INDEX_REFRESH_SECONDS.
+@admin.register(FAQ)
+class FAQAdmin(admin.ModelAdmin):
+    list_display = ('id', 'question', 'updated_at')
+    search_fields = ('question', 'answer')
+
+
 admin.site.register(FAQLearning)
 admin.site.register(UserQuery)
@@ -3,4 +3,7 @@ from django.apps import AppConfig
 
 class OrderConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'chatbot'
\ No newline at end of file
+    name = 'chatbot'
+
+    def ready(self):
+        from chatbot import signals  # noqa: F401
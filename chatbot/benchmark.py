@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiogram.types import Update
+from aiohttp import web
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Нагрузочный стенд бота без сети: локальный сервер изображает Bot API Telegram и OpenAI
+# с настраиваемыми задержками, сообщения подаются в Dispatcher напрямую как обновления.
+
+
+class FakeServices:
+    """
+    Bot API (/bot<token>/<method>) и OpenAI Chat Completions со стримингом (/v1/chat/completions)
+    на одном локальном порту.
+    """
+
+    def __init__(self, telegram_latency=0.0, openai_latency=0.0, openai_chunks=20, chunk_delay=0.0):
+        self.telegram_latency = telegram_latency
+        self.openai_latency = openai_latency
+        self.openai_chunks = openai_chunks
+        self.chunk_delay = chunk_delay
+        self.telegram_calls = {}
+        self.openai_calls = 0
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.telegram)
+        app.router.add_post('/v1/chat/completions', self.chat_completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def telegram(self, request):
+        method = request.match_info['method']
+        self.telegram_calls[method] = self.telegram_calls.get(method, 0) + 1
+        data = await request.post()
+        if self.telegram_latency:
+            await asyncio.sleep(self.telegram_latency)
+
+        if method in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': int(data.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'private'},
+                'text': data.get('text', ''),
+            }
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def chat_completions(self, request):
+        self.openai_calls += 1
+        body = await request.json()
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        if self.openai_latency:
+            await asyncio.sleep(self.openai_latency)
+
+        words = f"Тестовый ответ на вопрос: {body['messages'][-1]['content']}".split()
+        try:
+            for i in range(self.openai_chunks):
+                chunk = {
+                    'id': 'bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': body.get('model', 'bench'),
+                    'choices': [{'index': 0, 'delta': {'content': words[i % len(words)] + ' '}, 'finish_reason': None}],
+                }
+                await response.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                if self.chunk_delay:
+                    await asyncio.sleep(self.chunk_delay)
+            await response.write(b'data: [DONE]\n\n')
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # Клиент закрыл поток (отмененный или проигравший страхующий запрос)
+        return response
+
+
+class QueryCounter:
+    """
+    Счетчик SQL-запросов во всех потоках: обертка ставится на каждое новое соединение.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def _attach(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def install(self):
+        connection_created.connect(self._attach, weak=False)
+        for connection in connections.all(initialized_only=True):
+            self._attach(None, connection)
+
+    def uninstall(self):
+        connection_created.disconnect(self._attach)
+
+
+def make_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': text,
+        },
+    }
+
+
+def make_queries(questions, count, faq_ratio, llm_ratio, seed=1):
+    """
+    Смесь запросов: точные вопросы FAQ, обрывки вопросов (ведут к уточнению) и уникальные
+    вопросы не по теме, которые уходят в ChatGPT.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        roll = rng.random()
+        question = rng.choice(questions)
+        if roll < faq_ratio:
+            queries.append(question)
+        elif roll < faq_ratio + llm_ratio:
+            queries.append(f"Расскажите подробнее про вариант номер {i}")
+        else:
+            queries.append(' '.join(question.split()[:2]))
+    return queries
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_load(dispatcher, bot, queries, users, rate, concurrency):
+    """
+    Подает запросы в dispatcher. При rate > 0 — с постоянной частотой (открытая нагрузка,
+    задержка считается от момента поступления и включает ожидание в очереди), при rate = 0 —
+    concurrency пользователей отправляют следующий запрос сразу после ответа на предыдущий.
+    Возвращает длительности обработки, число ошибок и общее время.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def feed(update, arrived=None):
+        nonlocal errors
+        async with semaphore:
+            arrived = arrived or time.perf_counter()
+            try:
+                await dispatcher.feed_update(bot, update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - arrived)
+
+    updates = [
+        Update.model_validate(make_update(i, 1000 + i % users, query), context={'bot': bot})
+        for i, query in enumerate(queries, start=1)
+    ]
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    if rate:
+        tasks = []
+        for i, update in enumerate(updates):
+            delay = started + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(feed(update, time.perf_counter())))
+        await asyncio.gather(*tasks)
+    else:
+        pending = iter(updates)
+
+        async def worker():
+            for update in pending:
+                await feed(update)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, loop.time() - started
@@ -1,86 +1,126 @@
 import asyncio
 import os
-import logging, openai
-from aiogram import Bot, Dispatcher, types
-from aiogram.fsm.storage.memory import MemoryStorage
+from contextlib import suppress
+from datetime import timedelta
+import logging
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
-from chatbot.models import FAQ, UserQuery, FAQLearning
-from asgiref.sync import sync_to_async
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
-from aiogram.filters import Command, StateFilter
+from chatbot.cache import SingleFlight, TTLCache
+from chatbot.context import ContextBuilder, RollingSummary, context_key, system_prompt
+from chatbot.conversations import ConversationCache
+from chatbot.db import close_db_pool, database_sync_to_async, warm_db_pool
+from chatbot.llm import create_llm_client
+from chatbot.metrics import TelegramTimingMiddleware, metrics, profiler, start_metrics_server
+from chatbot.outbox import Outbox
+from chatbot.models import EMPTY_ANSWER, ERROR_ANSWER_PREFIX, FAQLearning
+from chatbot.persistence import WriteBehindQueue
+from chatbot.search import get_faq_entry, rebuild_faq_index, search_faq, watch_faq_changes
+from chatbot.startup import StartupTimer, set_ready
+from chatbot.storage import create_storage, purge_expired_states
+from chatbot.streaming import StreamingReply, split_text
+from chatbot.text import query_key
+from django.conf import settings
+from django.utils import timezone
+from aiogram.filters import Command
 
 # Настроим логирование
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=os.getenv('BOT_TOKEN'))
-dp = Dispatcher(storage=MemoryStorage())
+# Bot, Dispatcher, очередь отправки и клиент OpenAI создают setup_telegram() и setup_bot(),
+# а не импорт модуля: импорт ничего не открывает, а обращение к bots.bot, bots.dp, bots.outbox,
+# bots.llm создает их при первой необходимости (см. __getattr__ ниже)
+
+# Последние ходы диалога активных пользователей: контекст для ChatGPT без чтения из базы
+conversations = ConversationCache(
+    max_users=settings.CONVERSATION_CACHE_USERS,
+    max_turns=settings.CONVERSATION_CACHE_TURNS,
+    ttl=settings.CONVERSATION_CACHE_TTL,
+    refresh=settings.CONVERSATION_CACHE_REFRESH,
+)
+# История запросов пишется в базу пачками в фоне, не задерживая ответ пользователю
+history = WriteBehindQueue(
+    max_batch=settings.HISTORY_BATCH_SIZE,
+    flush_interval=settings.HISTORY_FLUSH_INTERVAL,
+    max_pending=settings.HISTORY_MAX_PENDING,
+    conversations=conversations,
+)
+
+metrics.gauge('history_pending', lambda: len(history))
+metrics.gauge('conversation_cache_users', lambda: len(conversations))
 
 class FAQStates(StatesGroup):
     awaiting_clarification = State()  # Ожидание выбора пользователя
 
 
 
-@sync_to_async
-def search_faq_with_postgres(query):
-    try:
-        search_query = SearchQuery(query)
-        faqs = FAQ.objects.annotate(
-            rank=SearchRank(SearchVector('question'), search_query)
-        ).filter(rank__gte=0.1).order_by('-rank')
-        return list(faqs)
-    except Exception as e:
-        logging.error(f"Error while searching FAQ: {e}")
-        return []
+# Форматирование вариантов с нумерацией
+def format_faq_list(faqs):
+    return "\n".join([f"{i + 1}. {faq.question}" for i, faq in enumerate(faqs)])
 
 
 
-@sync_to_async
-def search_faq_or_chatgpt(query):
-    try:
-        faqs = FAQ.objects.filter(question__icontains=query)
-        if faqs.exists():
-            return faqs.first().answer
-        return None
-    except Exception as e:
-        logging.error(f"Error while searching FAQ: {e}")
-        return None
+# Обработка сообщений
+async def handle_message(message: types.Message, state: FSMContext):
+    with profiler.sample(), metrics.span('handle_message'):
+        await answer_message(message, state)
 
 
 
-# Форматирование вариантов с нумерацией
-def format_faq_list(faqs):
-    return "\n".join([f"{i + 1}. {faq.question}" for i, faq in enumerate(faqs)])
+# id вопроса FAQ, если пользователь ответил номером варианта из последнего списка
+async def selected_option(state, query):
+    # Варианты остаются до первого сообщения, которое не номер варианта: можно выбрать несколько
+    if await state.get_state() != FAQStates.awaiting_clarification.state:
+        return None
+    data = await state.get_data()
+    faq_id = data.get('faq_options', {}).get(query.strip())
+    if faq_id is None:
+        await state.clear()
+    return faq_id
 
 
 
-# Обработка сообщений
-async def handle_message(message: types.Message, state: FSMContext):
+async def answer_message(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
+    chat_id = message.chat.id
     query = message.text
 
     if query == '/start':
-        await message.answer("Привет! Чем могу помочь?")
+        outbox.send_message(chat_id, "Привет! Чем могу помочь?")
         return
 
-    previous_query = await sync_to_async(UserQuery.objects.filter(user_id=user_id).order_by('-created_at').first)()
-    await bot.send_chat_action(message.chat.id, action="typing")
-
     try:
-        faq_answer = await search_faq_or_chatgpt(query)
-        similar_faqs = await search_faq_with_postgres(query)
+        # Пользователь ответил номером варианта из списка — ответ берем из индекса по id, без поиска:
+        # иначе "1" найдется как подстрока в вопросах FAQ
+        faq_id = await selected_option(state, query)
+        if faq_id is not None:
+            selected = await get_faq_entry(faq_id)
+            if selected is None:
+                outbox.send_message(chat_id, "Этот вопрос больше не доступен.")
+                return
+            metrics.inc('messages', route='faq_clarified')
+            outbox.send_message(chat_id, selected.answer)
+            with metrics.span('persist'):
+                await history.add_query(user_id, query=selected.question, response=selected.answer)
+            return
+
+        with metrics.span('faq_search'):
+            result = await search_faq(query)
+        faq_answer = result.exact.answer if result.exact else None
+        similar_faqs = result.candidates
 
         if faq_answer:
-            await message.answer(faq_answer)
-            await sync_to_async(UserQuery.objects.create)(
-                user_id=user_id, query=query, response=faq_answer, parent=previous_query
-            )
+            metrics.inc('messages', route='faq')
+            outbox.send_message(chat_id, faq_answer)
+            with metrics.span('persist'):
+                await history.add_query(user_id, query=query, response=faq_answer)
         else:
             if similar_faqs:
-                # Отправляем список вариантов с нумерацией
+                metrics.inc('messages', route='clarification')
+                # Список вариантов с нумерацией и кнопки выбора — одним сообщением
                 faq_list = format_faq_list(similar_faqs)
-                await message.answer(f"Я нашел несколько вариантов:\n\n{faq_list}")
 
                 keyboard = InlineKeyboardMarkup(row_width=3,inline_keyboard=[])  # Устанавливаем максимальное количество кнопок в строке
 
@@ -95,134 +135,343 @@ async def handle_message(message: types.Message, state: FSMContext):
                     keyboard.inline_keyboard.append(buttons[i:i + 3])  # Добавляем группы кнопок по 3
 
 
-                await message.answer(
-                    "Выберите один или несколько вариантов:", reply_markup=keyboard
+                outbox.send_message(
+                    chat_id,
+                    f"Я нашел несколько вариантов:\n\n{faq_list}\n\nВыберите один или несколько вариантов:",
+                    reply_markup=keyboard,
                 )
 
-                # Сохраняем варианты в состоянии
-                await state.update_data(faq_options={faq.id: faq.question for faq in similar_faqs})
+                # Сохраняем варианты в состоянии: номер варианта -> id вопроса
+                await state.update_data(faq_options={str(i + 1): faq.id for i, faq in enumerate(similar_faqs)})
                 await state.set_state(FAQStates.awaiting_clarification)
 
             else:
-                old_query = await state.get_data()
-                try:
-                    query = old_query['faq_options'][query]
-                    faq_answer = await search_faq_or_chatgpt(query)
-                    if faq_answer:
-                        await message.answer(faq_answer)
-                        await sync_to_async(UserQuery.objects.create)(
-                            user_id=user_id, query=query, response=faq_answer, parent=previous_query
-                        )
-                except Exception as e:
-                    chatgpt_answer = await asyncio.wait_for(get_chatgpt_response(user_id,query), timeout=15.0)
-                    await message.answer(chatgpt_answer)
-                    await sync_to_async(UserQuery.objects.create)(
-                        user_id=user_id, query=query, response=chatgpt_answer
-                    )
-                    await sync_to_async(FAQLearning.objects.create)(
-                        question=query, answer=chatgpt_answer
-                    )
+                metrics.inc('messages', route='llm')
+                # "Печатает..." показываем только там, где ответ правда готовится долго
+                outbox.send_chat_action(chat_id, action="typing")
+                if settings.LLM_STREAM_REPLIES:
+                    chatgpt_answer = await stream_chatgpt_response(chat_id, user_id, query)
+                else:
+                    chatgpt_answer = await wait_chatgpt_response(chat_id, user_id, query)
+                    for part in split_text(chatgpt_answer):
+                        outbox.send_message(chat_id, part)
+                with metrics.span('persist'):
+                    await history.add_query(user_id, query=query, response=chatgpt_answer)
+                    await history.add_learning(question=query, answer=chatgpt_answer)
     except asyncio.TimeoutError:
-        await message.answer("Произошла задержка при получении ответа. Пожалуйста, попробуйте позже.")
+        metrics.inc('messages', route='timeout')
+        outbox.send_message(chat_id, "Произошла задержка при получении ответа. Пожалуйста, попробуйте позже.")
     except Exception as e:
         logging.error(f"Error while handling message: {e}")
-        await message.answer("Произошла ошибка при обработке вашего запроса.")
+        metrics.inc('messages', route='error')
+        outbox.send_message(chat_id, "Произошла ошибка при обработке вашего запроса.")
 
 
 
 # Обработка выбора кнопки
-@dp.callback_query(StateFilter(FAQStates.awaiting_clarification))
 async def process_faq_selection(callback_query: types.CallbackQuery, state: FSMContext):
+    # Убираем "часики" на кнопке. Слишком старое нажатие Telegram подтвердить не дает, ответ все равно отправляем
+    with suppress(TelegramBadRequest):
+        await callback_query.answer()
     faq_id = int(callback_query.data.split('_')[1])
-    selected_faq = await sync_to_async(FAQ.objects.get)(id=faq_id)
+    selected_faq = await get_faq_entry(faq_id)
+    if selected_faq is None:
+        outbox.send_message(callback_query.message.chat.id, "Этот вопрос больше не доступен.")
+        return
 
-    await callback_query.message.answer(selected_faq.answer)
+    outbox.send_message(callback_query.message.chat.id, selected_faq.answer)
 
     # Сохраняем выбор
     # await state.clear()
 
-# Регистрация обработчиков
-dp.message.register(handle_message, Command(commands=["start"]))
-dp.message.register(handle_message)
 
 
+async def get_user_conversation(user_id, limit=5):
+    return await conversations.recent(user_id, limit)
 
-client = openai.AsyncOpenAI(api_key=os.getenv('CHAT_GPT_API_KEY'))
-content = '''
-GPT должен отвечать только на те вопросы которые связаны с компанией Dexfreedom,Dexnet.one,Dexsafe,Dexcard,DexMobile,Dexnoda, 
-ты должен отвечать как консультант и искать максимально похожие вопросы у себя на базе и задавать уточняющие вопросы. 
-Все сторонние вопросы не должен отвечать ничего кроме "Я не могу ответить на вопрос".
-'''
 
 
-@sync_to_async
-def get_user_conversation(user_id, limit=5):
-    return list(UserQuery.objects.filter(user_id=user_id).order_by('-created_at')[:limit])
-
+# Контекст ограничен бюджетом токенов, старые ходы сворачиваются в сводку
+context_builder = ContextBuilder(
+    budget=settings.LLM_CONTEXT_TOKENS,
+    summary=RollingSummary(
+        budget=settings.LLM_SUMMARY_TOKENS,
+        max_users=settings.CONVERSATION_CACHE_USERS,
+        ttl=settings.CONVERSATION_CACHE_TTL,
+    ),
+)
 
 
 # Формирование контекста для запроса в ChatGPT
-async def build_context(user_id):
-    messages = await get_user_conversation(user_id)
-    context = [{"role": "system", "content": content}]
-    for message in reversed(messages):
-        context.append({"role": "user", "content": message.query})
-        context.append({"role": "assistant", "content": message.response})
-    return context
+async def build_context(user_id, query):
+    messages = await get_user_conversation(user_id, settings.CONVERSATION_CACHE_TURNS)
+    return context_builder.build(user_id, system_prompt(os.getenv('ASSISTANT_ID')), messages, query)
+
+
+
+SLOW_ANSWER = "Готовлю ответ, это займет немного больше времени."
+
+LLM_MODEL = "gpt-3.5-turbo"
+
+# Кэш ответов ChatGPT по нормализованному запросу и контексту: одинаковые вопросы не ходят в API повторно
+llm_cache = TTLCache(maxsize=settings.LLM_CACHE_SIZE, ttl=settings.LLM_CACHE_TTL)
+# Одинаковые вопросы, заданные одновременно (например, после рассылки), делят один запрос к API
+llm_calls = SingleFlight()
+metrics.gauge('llm_cache_size', lambda: len(llm_cache))
+
+
+def llm_cache_key(query, context):
+    # Ответ строится по истории пользователя, поэтому без отпечатка контекста
+    # один пользователь получил бы ответ, составленный по диалогу другого
+    return query_key(query), context_key(context)
+
+
+@database_sync_to_async
+def seed_llm_cache():
+    """
+    Заполняет кэш свежими ответами из FAQLearning, чтобы он работал сразу после рестарта.
+    Ответы кэшируются для пользователей без истории диалога.
+    """
+    now = timezone.now()
+    rows = list(
+        FAQLearning.objects.usable()
+        .filter(created_at__gte=now - timedelta(seconds=settings.LLM_CACHE_TTL))
+        .order_by('-created_at')
+        .values_list('question', 'answer', 'created_at')[:settings.LLM_CACHE_SIZE]
+    )
+    prompt = system_prompt(os.getenv('ASSISTANT_ID'))
+    for question, answer, created_at in reversed(rows):
+        age = (now - created_at).total_seconds()
+        context = context_builder.build(None, prompt, [], question)
+        llm_cache.set(llm_cache_key(question, context), answer, ttl=settings.LLM_CACHE_TTL - age)
+    return len(rows)
+
+
+
+# Ответ кэшируется внутри общего запроса, даже если все ожидающие ушли по таймауту
+async def request_and_cache_chatgpt(context, key, on_text=None):
+    response_text = await llm.complete(context, on_text)
+    if response_text.strip():
+        llm_cache.set(key, response_text)
+    return response_text
 
 
 
 # Основная функция для обработки запроса к ChatGPT и поиска в файлах
-async def get_chatgpt_response(user_id, query):
+async def get_chatgpt_response(user_id, query, on_text=None):
     assistant_id = os.getenv('ASSISTANT_ID')
     try:
         # Формируем контекст из предыдущих сообщений
-        context = await build_context(user_id)
-        context.append({"role": "user", "content": query})
-
-        # Добавляем системное сообщение для идентификации ассистента
-        system_message = {
-            "role": "system",
-            "content": f"Вы используете ассистента с ID: {assistant_id}. {content}"
-        }
-        context.insert(0, system_message)
-
-
-        # Отправляем запрос в OpenAI API с настройкой ассистента
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=context,
-            stream=True  # Включаем потоковый режим
+        with metrics.span('llm_context'):
+            context = await build_context(user_id, query)
+        key = llm_cache_key(query, context)
+        cached_answer = llm_cache.get(key)
+        if cached_answer is not None:
+            metrics.inc('llm_cache', result='hit')
+            return cached_answer
+        metrics.inc('llm_cache', result='miss')
+
+        # Запросы совместимы, если совпадают модель, нормализованный вопрос и контекст;
+        # текст по мере генерации получают все ожидающие, иначе у присоединившихся
+        # не сработает таймаут первых токенов
+        response_text = await llm_calls.stream(
+            (LLM_MODEL, *key), request_and_cache_chatgpt, context, key, on_text=on_text
         )
 
-        response_text = ""
-
-        # Обрабатываем потоковый ответ
-        async for chunk in response:
-            try:
-                content_chunk = chunk.choices[0].delta.content  # Явный доступ к атрибуту
-            except AttributeError:
-                logging.error(f"Ошибка при обработке фрагмента: {chunk}")
-                continue  # Пропускаем фрагмент, если он некорректный
-
-            if content_chunk:
-                response_text += content_chunk
-
         # Проверяем, что ответ не пустой
         if not response_text.strip():
-            warning_msg = "Ответ от ассистента пустой."
-            return warning_msg
+            return EMPTY_ANSWER
 
         return response_text
 
     except Exception as e:
+        metrics.inc('llm_errors', error=type(e).__name__)
         error_msg = f"Ошибка при запросе к ассистенту {assistant_id}: {str(e)}"
         logging.error(error_msg)
-        return f"Извините, произошла ошибка: {error_msg}"
+        return f"{ERROR_ANSWER_PREFIX}: {error_msg}"
 
 
 
-async def start_bot():
-    await dp.start_polling(bot)
+# Ответ ChatGPT целиком. Если за LLM_TIMEOUT он не готов, запрос не прерывается:
+# пользователь получает уведомление, а ответ — когда будет готов (до LLM_STREAM_TIMEOUT)
+async def wait_chatgpt_response(chat_id, user_id, query):
+    response = asyncio.ensure_future(get_chatgpt_response(user_id, query))
+    try:
+        return await asyncio.wait_for(asyncio.shield(response), timeout=settings.LLM_TIMEOUT)
+    except asyncio.TimeoutError:
+        outbox.send_message(chat_id, SLOW_ANSWER)
+    try:
+        return await asyncio.wait_for(response, timeout=settings.LLM_STREAM_TIMEOUT)
+    except BaseException:
+        response.cancel()
+        raise
+
+
+
+# Ответ ChatGPT с показом по мере генерации. Таймаут LLM_TIMEOUT ограничивает ожидание
+# первых токенов, дальше ответ может дописываться до LLM_STREAM_TIMEOUT
+async def stream_chatgpt_response(chat_id, user_id, query):
+    reply = StreamingReply(outbox, chat_id, interval=settings.LLM_STREAM_EDIT_INTERVAL)
+    response = asyncio.ensure_future(get_chatgpt_response(user_id, query, on_text=reply.update))
+    started = asyncio.ensure_future(reply.started.wait())
+    try:
+        await asyncio.wait({response, started}, timeout=settings.LLM_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        if not response.done() and not started.done():
+            raise asyncio.TimeoutError
+        answer = await asyncio.wait_for(response, timeout=settings.LLM_STREAM_TIMEOUT)
+    except BaseException:
+        response.cancel()
+        await reply.abort()
+        raise
+    finally:
+        started.cancel()
+
+    await reply.finish(answer)
+    return answer
+
+
+
+def register_handlers(dispatcher):
+    # id вопроса есть в самой кнопке, поэтому кнопки работают и после ответа номером варианта
+    dispatcher.callback_query.register(process_faq_selection, F.data.startswith('faq_'))
+    dispatcher.message.register(handle_message, Command(commands=["start"]))
+    # Стикеры, фото и другие сообщения без текста не обрабатываем: отвечать на них нечего
+    dispatcher.message.register(handle_message, F.text)
+
+
+
+def setup_telegram():
+    """
+    Создает Bot и Dispatcher с обработчиками (один раз на процесс). Супервизору
+    run_bot --workers N нужны только они, без очереди отправки и клиента OpenAI.
+    """
+    global bot, dp
+    if 'bot' in globals():
+        return
+
+    telegram = Bot(token=os.getenv('BOT_TOKEN'))
+    telegram.session.middleware(TelegramTimingMiddleware(metrics))
+    dispatcher = Dispatcher(storage=create_storage())
+    register_handlers(dispatcher)
 
+    # Глобальные имена появляются вместе, только если ни один конструктор не упал
+    bot, dp = telegram, dispatcher
 
+
+def setup_bot():
+    """
+    Создает все, что нужно для обработки сообщений: Bot, Dispatcher, очередь отправки и клиент OpenAI.
+    """
+    global outbox, llm
+    setup_telegram()
+    if 'outbox' in globals():
+        return
+
+    # Все ответы уходят через очередь с учетом лимитов Telegram, обработчики не ждут отправки
+    sender = Outbox(
+        bot,
+        rate=settings.TELEGRAM_GLOBAL_RATE,
+        chat_rate=settings.TELEGRAM_CHAT_RATE,
+        chat_burst=settings.TELEGRAM_CHAT_BURST,
+        group_rate=settings.TELEGRAM_GROUP_RATE,
+        workers=settings.TELEGRAM_SEND_WORKERS,
+    )
+    # Запросы к OpenAI с общим пулом соединений, лимитами тарифа и повторами
+    client = create_llm_client(LLM_MODEL)
+
+    outbox, llm = sender, client
+    metrics.gauge('telegram_outbox_pending', lambda: len(outbox))
+
+
+def __getattr__(name):
+    if name in ('bot', 'dp'):
+        setup_telegram()
+        return globals()[name]
+    if name in ('outbox', 'llm'):
+        setup_bot()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+
+async def warm_up_telegram():
+    try:
+        me = await bot.get_me()
+    except Exception as e:
+        logging.warning(f"Telegram warm-up failed: {e!r}")
+    else:
+        logging.info(f"Telegram bot @{me.username}")
+
+
+
+async def load_data(background):
+    if settings.LLM_CACHE_SIZE:
+        logging.info(f"LLM cache seeded with {await seed_llm_cache()} answers")
+    if settings.FAQ_INDEX_ENABLED:
+        # Строим индекс FAQ до приема сообщений и следим за изменениями из других процессов
+        await rebuild_faq_index()
+        background.append(asyncio.create_task(watch_faq_changes(settings.FAQ_INDEX_REFRESH_SECONDS)))
+
+
+
+# Подготовка к приему сообщений (общая для polling, webhook и воркеров), возвращает фоновые задачи.
+# Соединения с базой открываются первыми: без базы бот не работает, и запуск прерывается с ошибкой.
+# Данные FAQ и HTTP-соединения с Telegram и OpenAI готовятся параллельно
+async def startup_bot():
+    timer = StartupTimer()
+    background = []
+    with timer.phase('setup'):
+        setup_bot()
+    with timer.phase('db'):
+        await warm_db_pool()
+
+    async def data():
+        with timer.phase('data'):
+            await load_data(background)
+
+    async def http():
+        with timer.phase('http'):
+            await asyncio.gather(warm_up_telegram(), llm.warm_up(settings.LLM_WARMUP_CONNECTIONS))
+
+    try:
+        await asyncio.gather(data(), http())
+    except BaseException:
+        for task in background:
+            task.cancel()
+        raise
+    if hasattr(dp.storage, 'purge_expired'):
+        background.append(asyncio.create_task(purge_expired_states(dp.storage, settings.FSM_PURGE_INTERVAL)))
+    set_ready()
+    timer.report()
+    return background
+
+
+
+async def shutdown_bot(background):
+    set_ready(False)
+    for task in background:
+        task.cancel()
+    await history.close()
+    await outbox.close(settings.TELEGRAM_SEND_DRAIN_TIMEOUT)
+    await dp.storage.close()
+    await bot.session.close()
+    await llm.close()
+    close_db_pool()
+
+
+
+async def start_bot():
+    # В режиме polling Django не запущен, метрики отдает отдельный сервер.
+    # Он запускается первым: пока бот готовится, /ready отвечает 503
+    metrics_server = None
+    if settings.METRICS_ENABLED and settings.METRICS_PORT:
+        metrics_server = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
+    try:
+        background = await startup_bot()
+        try:
+            await dp.start_polling(bot)
+        finally:
+            await shutdown_bot(background)
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
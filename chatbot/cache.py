@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    LRU-кэш с ограничением размера и временем жизни записей (в секундах).
+    Используется из одного event loop, поэтому без блокировок.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+class _Listeners:
+    """
+    Раздает промежуточный результат общего вызова всем ожидающим. Результат — текст целиком
+    на текущий момент, поэтому подключившийся позже сразу получает последний.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+        self.last = None
+
+    def __call__(self, value):
+        self.last = value
+        for callback in list(self.callbacks):
+            callback(value)
+
+    def add(self, callback):
+        self.callbacks.append(callback)
+        if self.last is not None:
+            callback(self.last)
+
+    def remove(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одинаковым ключом: первый вызов выполняет работу,
+    остальные ждут его результат или получают ту же ошибку.
+    Отмена (например, таймаут) одного ожидающего не отменяет общий вызов.
+    """
+
+    def __init__(self):
+        self._calls = {}  # key -> (asyncio.Task, _Listeners)
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func, *args, **kwargs):
+        task, _ = self._start(key, func, args, kwargs)
+        return await asyncio.shield(task)
+
+    async def stream(self, key, func, *args, on_text=None):
+        """
+        Как do(), но func получает последним аргументом обработчик промежуточного результата,
+        который передает его on_text каждого ожидающего, а не только первого.
+        """
+        listeners = _Listeners()
+        task, listeners = self._start(key, func, (*args, listeners), {}, listeners)
+        if on_text is None or listeners is None:
+            return await asyncio.shield(task)
+        listeners.add(on_text)
+        try:
+            return await asyncio.shield(task)
+        finally:
+            listeners.remove(on_text)
+
+    def _start(self, key, func, args, kwargs, listeners=None):
+        call = self._calls.get(key)
+        if call is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            call = self._calls[key] = (task, listeners)
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return call
+
+    def _forget(self, key, task):
+        if key in self._calls and self._calls[key][0] is task:
+            del self._calls[key]
+        # Ошибку могли не забрать, если все ожидающие ушли по таймауту
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,156 @@
+import random
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from chatbot.fuzzy import trigrams
+
+# Группировка вопросов из FAQLearning, на которые отвечал ChatGPT: одинаковые по смыслу
+# формулировки с опечатками и перестановками слов собираются в один кластер.
+# Кандидаты ищутся через MinHash + LSH (без сравнения всех пар), кластер хранит только
+# подпись и id строк, поэтому память ограничена числом кластеров, а не объемом таблицы.
+
+MINHASH_SIZE = 64
+LSH_BANDS = 16
+# Сколько формулировок кластера хранить, чтобы выбрать из них вопрос для FAQ
+SAMPLE_SIZE = 8
+_PRIME = (1 << 31) - 1
+
+
+class MinHasher:
+    """
+    MinHash-подписи множеств триграмм: доля совпавших позиций двух подписей
+    оценивает близость Жаккара, как similarity() в pg_trgm.
+    """
+
+    def __init__(self, size=MINHASH_SIZE, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, _PRIME, size, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size, dtype=np.uint64)
+
+    def signature(self, text):
+        grams = trigrams(text)
+        if not grams:
+            return None
+        hashes = np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+        hashes %= _PRIME
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % _PRIME).min(axis=1).astype(np.uint32)
+
+
+class Cluster:
+    __slots__ = ('id', 'signature', 'count', 'samples', 'latest_id')
+
+    def __init__(self, cluster_id, signature, learning_id):
+        self.id = cluster_id
+        self.signature = signature.tobytes()  # bytes компактнее массива numpy
+        self.count = 1
+        self.samples = [learning_id]  # Случайная выборка формулировок (reservoir sampling)
+        self.latest_id = learning_id  # Самый свежий ответ ChatGPT на вопрос кластера
+
+    def add(self, learning_id, rng):
+        self.count += 1
+        self.latest_id = learning_id
+        if len(self.samples) < SAMPLE_SIZE:
+            self.samples.append(learning_id)
+        else:
+            slot = rng.randrange(self.count)
+            if slot < SAMPLE_SIZE:
+                self.samples[slot] = learning_id
+
+
+class QuestionClusterer:
+    """
+    Онлайн-кластеризация: вопрос присоединяется к кластеру, с подписью которого совпадает
+    не меньше чем similarity позиций, иначе открывает новый. Если кластеров больше max_clusters,
+    давно не пополнявшиеся кластеры меньше min_count вытесняются — они все равно не попадут в FAQ.
+    """
+
+    def __init__(self, similarity=0.6, max_clusters=100000, min_count=3, hasher=None):
+        self.similarity = similarity
+        self.max_clusters = max_clusters
+        self.min_count = min_count
+        self.hasher = hasher or MinHasher()
+        self.rows = len(self.hasher.a) // LSH_BANDS
+        self.clusters = OrderedDict()  # id -> Cluster, в начале — давно не пополнявшиеся
+        self._buckets = {}  # ключ полосы подписи -> id кластера
+        self._next_id = 0
+        self._rng = random.Random(0)
+        self.stats = {'read': 0, 'skipped': 0, 'evicted': 0}
+
+    def _bands(self, signature):
+        return [
+            hash((band, signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+            for band in range(LSH_BANDS)
+        ]
+
+    def add(self, learning_id, question):
+        self.stats['read'] += 1
+        signature = self.hasher.signature(question)
+        if signature is None:
+            self.stats['skipped'] += 1
+            return None
+        bands = self._bands(signature)
+
+        best, best_score = None, self.similarity
+        for cluster_id in {self._buckets[key] for key in bands if key in self._buckets}:
+            cluster = self.clusters.get(cluster_id)
+            if cluster is None:
+                continue
+            score = np.count_nonzero(np.frombuffer(cluster.signature, dtype=np.uint32) == signature) / len(signature)
+            if score >= best_score:
+                best, best_score = cluster, score
+
+        if best is not None:
+            best.add(learning_id, self._rng)
+            self.clusters.move_to_end(best.id)
+            return best
+
+        cluster = Cluster(self._next_id, signature, learning_id)
+        self._next_id += 1
+        self.clusters[cluster.id] = cluster
+        for key in bands:
+            self._buckets.setdefault(key, cluster.id)
+        return cluster
+
+    def evict(self):
+        """
+        Сокращает число кластеров до 90% от max_clusters, начиная с давно не пополнявшихся.
+        """
+        if len(self.clusters) <= self.max_clusters:
+            return
+        target = int(self.max_clusters * 0.9)
+        for cluster in list(self.clusters.values()):
+            if len(self.clusters) <= target:
+                break
+            if cluster.count >= self.min_count:
+                continue
+            del self.clusters[cluster.id]
+            for key in self._bands(np.frombuffer(cluster.signature, dtype=np.uint32)):
+                if self._buckets.get(key) == cluster.id:
+                    del self._buckets[key]
+            self.stats['evicted'] += 1
+
+    def frequent(self):
+        """
+        Кластеры не меньше min_count вопросов, самые частые первыми.
+        """
+        return sorted(
+            (cluster for cluster in self.clusters.values() if cluster.count >= self.min_count),
+            key=lambda cluster: (-cluster.count, cluster.id),
+        )
+
+
+def central_question(questions):
+    """
+    Формулировка, ближе всего (по триграммам) к остальным: обычно без опечаток и лишних слов.
+    """
+    grams = [trigrams(question) for question in questions]
+
+    def closeness(i):
+        return sum(
+            len(grams[i] & other) / len(grams[i] | other)
+            for j, other in enumerate(grams) if j != i and grams[i] | other
+        )
+
+    return questions[max(range(len(questions)), key=lambda i: (closeness(i), -len(questions[i])))]
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import math
+from collections import Counter
+
+from chatbot.cache import TTLCache
+
+# Сборка контекста для ChatGPT с ограничением по токенам.
+# В контекст попадают один системный промпт и столько последних ходов диалога, сколько
+# помещается в бюджет; остальные ходы сворачиваются в сводку внутри системного промпта.
+
+# Ответ модели на вопросы не по теме; такие ответы не кэшируются и не переносятся в FAQ
+OFF_TOPIC_ANSWER = "Я не могу ответить на вопрос"
+
+content = f'''
+GPT должен отвечать только на те вопросы которые связаны с компанией Dexfreedom,Dexnet.one,Dexsafe,Dexcard,DexMobile,Dexnoda, 
+ты должен отвечать как консультант и искать максимально похожие вопросы у себя на базе и задавать уточняющие вопросы. 
+Все сторонние вопросы не должен отвечать ничего кроме "{OFF_TOPIC_ANSWER}".
+'''
+
+# Служебные токены на каждое сообщение в формате chat completions
+MESSAGE_OVERHEAD = 4
+# Сколько символов вопроса и ответа оставлять в сводке
+SUMMARY_QUERY_CHARS = 120
+SUMMARY_ANSWER_CHARS = 200
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+_encoding = None
+
+
+def count_tokens(text):
+    """
+    Число токенов в тексте: точно, если установлен tiktoken, иначе оценка
+    (для русского текста в среднем около трех символов на токен).
+    """
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 3)
+
+
+def system_prompt(assistant_id):
+    return f"Вы используете ассистента с ID: {assistant_id}. {content}"
+
+
+def message_tokens(message):
+    return count_tokens(message['content']) + MESSAGE_OVERHEAD
+
+
+def shorten(text, limit):
+    text = ' '.join((text or '').split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + '…'
+
+
+class RollingSummary:
+    """
+    Сводка старых ходов диалога по пользователям. Новые свернутые ходы дописываются
+    к уже готовой сводке, а самые старые строки вытесняются, когда сводка не влезает в бюджет.
+    """
+
+    def __init__(self, budget, max_users, ttl):
+        self.budget = budget
+        self._users = TTLCache(maxsize=max_users, ttl=ttl)  # user_id -> (ключи ходов, строки)
+
+    def summarize(self, user_id, turns):
+        if not turns or self.budget <= 0:
+            return ''
+        seen, lines = self._users.get(user_id, (Counter(), []))
+        # Ход узнается по тексту, а не по объекту: ходы из кэша, из базы и после записи
+        # (когда появляется pk) — разные объекты. Повторы одного вопроса считаются по количеству
+        keys = Counter(turn_key(turn) for turn in turns)
+        new_turns = []
+        for turn in reversed(turns):
+            key = turn_key(turn)
+            if keys[key] > seen[key]:
+                keys[key] -= 1
+                new_turns.append(turn)
+        new_turns.reverse()
+        if new_turns:
+            lines = lines + [
+                f"- {shorten(turn.query, SUMMARY_QUERY_CHARS)} — {shorten(turn.response, SUMMARY_ANSWER_CHARS)}"
+                for turn in new_turns
+            ]
+            while lines and count_tokens('\n'.join(lines)) > self.budget:
+                lines = lines[1:]
+            self._users.set(user_id, (Counter(turn_key(turn) for turn in turns), lines))
+        return '\n'.join(lines)
+
+
+def turn_key(turn):
+    return turn.query, turn.response
+
+
+class ContextBuilder:
+    """
+    Собирает сообщения для ChatGPT в пределах budget токенов.
+    """
+
+    def __init__(self, budget, summary):
+        self.budget = budget
+        self.summary = summary
+
+    def build(self, user_id, system_prompt, turns, query):
+        """
+        turns — ходы диалога от старых к новым (объекты с полями query и response).
+        """
+        system = {"role": "system", "content": system_prompt}
+        question = {"role": "user", "content": query}
+        remaining = self.budget - message_tokens(system) - message_tokens(question)
+
+        packed, cut = self._pack(turns, remaining)
+        if cut:
+            # Все ходы не влезли: оставляем место под сводку свернутых
+            packed, cut = self._pack(turns, remaining - self.summary.budget)
+            summary = self.summary.summarize(user_id, turns[:cut])
+            if summary:
+                system["content"] = f"{system_prompt}\n\nКраткое содержание предыдущего диалога:\n{summary}"
+        return [system, *packed, question]
+
+    @staticmethod
+    def _pack(turns, remaining):
+        """
+        Последние ходы, которые помещаются в remaining токенов, и индекс первого из них.
+        """
+        packed = []
+        cut = len(turns)
+        for index in range(len(turns) - 1, -1, -1):
+            turn = turns[index]
+            messages = [{"role": "user", "content": turn.query}]
+            if turn.response:
+                messages.append({"role": "assistant", "content": turn.response})
+            cost = sum(message_tokens(message) for message in messages)
+            if cost > remaining:
+                break
+            remaining -= cost
+            packed[:0] = messages
+            cut = index
+        return packed, cut
+
+
+def context_key(context):
+    """
+    Отпечаток контекста без последнего вопроса: ответ модели можно отдать другому запросу
+    только при совпадающих системном промпте, сводке и ходах диалога.
+    """
+    data = json.dumps(context[:-1], ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def context_tokens(context):
+    return sum(message_tokens(message) for message in context)
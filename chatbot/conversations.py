@@ -0,0 +1,97 @@
+import time
+from collections import deque
+
+from chatbot.cache import TTLCache
+from chatbot.db import database_sync_to_async
+from chatbot.models import UserQuery
+
+
+class Conversation:
+    __slots__ = ('turns', 'complete', 'loaded_at')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)  # UserQuery, от старых к новым
+        self.complete = False  # True — история из базы уже подгружена
+        self.loaded_at = None  # Когда история читалась из базы (time.monotonic)
+
+
+class ConversationCache:
+    """
+    Последние ходы диалога активных пользователей в памяти процесса.
+    Пополняется при сохранении запросов (WriteBehindQueue), из базы история
+    читается при первом обращении к пользователю. Если сообщения одного пользователя
+    могут попасть в разные процессы (webhook за несколькими воркерами сервера),
+    refresh > 0: история старше refresh секунд перечитывается из базы.
+    """
+
+    def __init__(self, max_users, max_turns, ttl, refresh=0):
+        self.max_turns = max_turns
+        self.refresh = refresh
+        self._users = TTLCache(maxsize=max_users, ttl=ttl)
+
+    def __len__(self):
+        return len(self._users)
+
+    def _get(self, user_id, create=False):
+        user_id = str(user_id)
+        conversation = self._users.get(user_id)
+        if conversation is None and create:
+            conversation = Conversation(self.max_turns)
+        if conversation is not None:
+            # Продлеваем жизнь записи при каждом обращении
+            self._users.set(user_id, conversation)
+        return conversation
+
+    def append(self, user_id, user_query):
+        self._get(user_id, create=True).turns.append(user_query)
+
+    def _stale(self, conversation):
+        return (
+            self.refresh > 0 and conversation.loaded_at is not None
+            and time.monotonic() - conversation.loaded_at > self.refresh
+        )
+
+    def last(self, user_id):
+        """
+        Последний запрос пользователя и признак того, что это точно известно без базы.
+        """
+        conversation = self._get(user_id)
+        if conversation is None:
+            return None, False
+        if self._stale(conversation):
+            # Другой процесс мог записать более новый запрос. Еще не записанный запрос этого
+            # процесса новее всего, что есть в базе; иначе родителя найдет запись пачки
+            if conversation.turns and conversation.turns[-1].pk is None:
+                return conversation.turns[-1], True
+            return None, False
+        if conversation.turns:
+            return conversation.turns[-1], True
+        return None, conversation.complete
+
+    async def recent(self, user_id, limit=None):
+        """
+        Последние limit ходов пользователя, от старых к новым.
+        """
+        limit = limit or self.max_turns
+        conversation = self._get(user_id, create=True)
+        stale = self._stale(conversation)
+        if stale or (not conversation.complete and len(conversation.turns) < limit):
+            stored = await load_recent_queries(str(user_id), self.max_turns)
+            if stale:
+                # База — источник истины, из памяти добавляются только еще не записанные ходы
+                turns = stored + [turn for turn in conversation.turns if turn.pk is None]
+            else:
+                known = {turn.pk for turn in conversation.turns if turn.pk is not None}
+                # Ходы из базы старше тех, что уже есть в памяти
+                older = [turn for turn in stored if turn.pk not in known]
+                turns = older + list(conversation.turns)
+            conversation.turns.clear()
+            conversation.turns.extend(turns)
+            conversation.complete = True
+            conversation.loaded_at = time.monotonic()
+        return list(conversation.turns)[-limit:]
+
+
+@database_sync_to_async
+def load_recent_queries(user_id, limit):
+    return list(reversed(UserQuery.objects.filter(user_id=user_id).order_by('-created_at')[:limit]))
@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+
+# Доступ к базе из асинхронного кода бота.
+# sync_to_async и асинхронные методы ORM (aget, acreate...) по умолчанию выполняют все запросы
+# в одном потоке, то есть по одному. Здесь запросы идут в пул из DB_POOL_SIZE потоков,
+# у каждого свое постоянное соединение (CONN_MAX_AGE), поэтому запросы разных пользователей
+# выполняются параллельно, а лишние ждут свободный поток.
+
+# Как часто поток пула проверяет свое соединение, с. close_old_connections() сбрасывает
+# health_check_done, и при CONN_HEALTH_CHECKS следующий запрос начинается с лишнего SELECT 1
+HEALTH_CHECK_INTERVAL = 30
+
+_executor = None
+_local = threading.local()
+
+
+def get_db_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.DB_POOL_SIZE, thread_name_prefix='db')
+    return _executor
+
+
+def _call(func, *args, **kwargs):
+    # Закрывает только сломанные и устаревшие (старше CONN_MAX_AGE) соединения,
+    # не чаще раза в HEALTH_CHECK_INTERVAL секунд на поток
+    now = time.monotonic()
+    if now - getattr(_local, 'checked_at', -HEALTH_CHECK_INTERVAL) >= HEALTH_CHECK_INTERVAL:
+        close_old_connections()
+        _local.checked_at = now
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        # Соединение могло сломаться: закрываем его сразу и проверяем перед следующим запросом
+        close_old_connections()
+        _local.checked_at = -HEALTH_CHECK_INTERVAL
+        raise
+
+
+def database_sync_to_async(func):
+    """
+    Аналог sync_to_async для функций, работающих с ORM, но с параллельным выполнением в пуле.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, _call, func, *args, **kwargs)
+        return await loop.run_in_executor(get_db_executor(), call)
+
+    return wrapper
+
+
+def _open_connection(barrier):
+    try:
+        connection.ensure_connection()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except BaseException:
+        barrier.abort()
+        raise
+    # Поток ждет остальных, чтобы каждое соединение открылось в своем потоке пула
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+
+
+async def warm_db_pool(timeout=30):
+    """
+    Открывает и проверяет соединение в каждом потоке пула до приема сообщений:
+    ошибка подключения видна при запуске, а первые запросы не ждут установки соединения.
+    """
+    size = settings.DB_POOL_SIZE
+    barrier = threading.Barrier(size, timeout=timeout)
+    loop = asyncio.get_running_loop()
+    executor = get_db_executor()
+    await asyncio.gather(*(loop.run_in_executor(executor, _open_connection, barrier) for _ in range(size)))
+    return size
+
+
+def close_db_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
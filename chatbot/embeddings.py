@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import tempfile
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from chatbot.text import normalize_text, tokenize
+
+# Векторный поиск по вопросам FAQ.
+# Векторы вопросов считаются заранее и хранятся в компактном float32-файле (.npz),
+# поиск — косинусная близость одним матричным умножением в процессе бота.
+
+EMBED_BATCH_SIZE = 256
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class HashingEmbedder:
+    """
+    Локальный эмбеддер без сети и моделей: символьные n-граммы слов, хешированные в вектор.
+    Ловит словоформы и опечатки, подходит для тестов и как запасной вариант.
+    """
+    blocking = False  # Доли миллисекунды на запрос: можно вызывать прямо в event loop
+
+    def __init__(self, dim=1024, ngram=3):
+        self.dim = dim
+        self.ngram = ngram
+        self.name = f'hashing-{dim}-{ngram}'
+
+    def embed(self, texts):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in tokenize(normalize_text(text)):
+                word = f'<{word}>'
+                for i in range(max(1, len(word) - self.ngram + 1)):
+                    gram = word[i:i + self.ngram].encode()
+                    matrix[row, zlib.crc32(gram) % self.dim] += 1.0
+        np.sqrt(matrix, out=matrix)
+        return normalize_rows(matrix)
+
+
+class SentenceTransformerEmbedder:
+    """
+    Локальная нейросетевая модель (пакет sentence-transformers), работает офлайн после загрузки модели.
+    Вычисления на CPU занимают десятки миллисекунд, поэтому в боте выполняется в отдельном потоке.
+    """
+    blocking = True
+
+    def __init__(self, model=None):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as exc:
+            raise ImportError(
+                "Для SentenceTransformerEmbedder установите пакет sentence-transformers"
+            ) from exc
+        model = model or getattr(settings, 'FAQ_EMBEDDING_MODEL', None) or 'paraphrase-multilingual-MiniLM-L12-v2'
+        self.model = SentenceTransformer(model)
+        self.name = f'sentence-transformers-{model}'
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True)
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+class OpenAIEmbedder:
+    """
+    Эмбеддинги OpenAI. Сетевой вызов, поэтому в боте выполняется в отдельном потоке.
+    """
+    blocking = True
+
+    def __init__(self, model=None):
+        import openai
+
+        self.model = model or getattr(settings, 'FAQ_EMBEDDING_MODEL', None) or 'text-embedding-3-small'
+        self.client = openai.OpenAI(api_key=os.getenv('CHAT_GPT_API_KEY'))
+        self.name = f'openai-{self.model}'
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(model=self.model, input=list(texts))
+        vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+EMBEDDERS = {
+    'hashing': HashingEmbedder,
+    'sentence-transformers': SentenceTransformerEmbedder,
+    'openai': OpenAIEmbedder,
+}
+
+_embedder = None
+
+
+def get_embedder():
+    """
+    Эмбеддер из настройки FAQ_EMBEDDER: короткое имя из EMBEDDERS или путь к классу.
+    """
+    global _embedder
+    if _embedder is None:
+        name = settings.FAQ_EMBEDDER
+        embedder_class = EMBEDDERS.get(name) or import_string(name)
+        _embedder = embedder_class()
+    return _embedder
+
+
+def text_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+class VectorIndex:
+    """
+    Матрица нормированных векторов вопросов (float32) и их id.
+    """
+
+    def __init__(self, ids, vectors, hashes, embedder_name):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        self.hashes = np.asarray(hashes, dtype=np.int64)
+        self.embedder_name = embedder_name
+
+    def __len__(self):
+        return len(self.ids)
+
+    def top_k(self, vector, k, min_score=0.0):
+        """
+        Пары (id, косинусная близость) для k ближайших вопросов, по убыванию близости.
+        """
+        if not len(self.ids):
+            return []
+        scores = self.vectors @ np.asarray(vector, dtype=np.float32).ravel()
+        if k < len(scores):
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [(int(self.ids[i]), float(scores[i])) for i in top if scores[i] >= min_score]
+
+    def save(self, path):
+        # Свой временный файл у каждого процесса: воркеры run_bot --workers строят индекс одновременно
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp', delete=False) as f:
+            try:
+                np.savez(
+                    f, ids=self.ids, vectors=self.vectors, hashes=self.hashes,
+                    embedder=np.array(self.embedder_name),
+                )
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'], data['vectors'], data['hashes'], str(data['embedder']))
+
+
+def load_or_build_vectors(entries, embedder=None, path=None):
+    """
+    Векторы для вопросов FAQ. Берет готовые из файла и досчитывает только новые
+    или измененные вопросы, после чего сохраняет файл обратно.
+    """
+    embedder = embedder or get_embedder()
+    path = path or settings.FAQ_EMBEDDINGS_PATH
+
+    cached = {}
+    if path and os.path.exists(path):
+        try:
+            previous = VectorIndex.load(path)
+            if previous.embedder_name == embedder.name:
+                cached = {
+                    (int(faq_id), int(question_hash)): vector
+                    for faq_id, question_hash, vector in zip(previous.ids, previous.hashes, previous.vectors)
+                }
+        except Exception as e:
+            logging.error(f"Error while loading FAQ embeddings from {path}: {e}")
+
+    ids = [entry.id for entry in entries]
+    hashes = [text_hash(entry.question) for entry in entries]
+    missing = [i for i, key in enumerate(zip(ids, hashes)) if key not in cached]
+
+    fresh = {}
+    for start in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[start:start + EMBED_BATCH_SIZE]
+        vectors = embedder.embed([entries[i].question for i in batch])
+        fresh.update(zip(batch, vectors))
+
+    dim = next(iter(cached.values())).shape[0] if cached else (len(fresh[missing[0]]) if fresh else 0)
+    matrix = np.empty((len(entries), dim), dtype=np.float32)
+    for i, key in enumerate(zip(ids, hashes)):
+        matrix[i] = fresh[i] if i in fresh else cached[key]
+
+    index = VectorIndex(ids, matrix, hashes, embedder.name)
+    if path and (missing or len(cached) != len(entries)):
+        index.save(path)
+    if missing:
+        logging.info(f"FAQ embeddings: computed {len(missing)} of {len(entries)} vectors")
+    return index
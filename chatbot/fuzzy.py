@@ -0,0 +1,63 @@
+import numpy as np
+
+from chatbot.text import normalize_text, tokenize
+
+# Нечеткое сравнение вопросов по триграммам, как в расширении pg_trgm PostgreSQL:
+# близость — доля общих триграмм (|A ∩ B| / |A ∪ B|), поэтому опечатки, пропущенная
+# пунктуация и двоеточие в конце вопроса почти не влияют на результат.
+
+
+def trigrams(text):
+    """
+    Множество триграмм текста: каждое слово дополняется двумя пробелами слева и одним справа.
+    """
+    grams = set()
+    for word in tokenize(normalize_text(text)):
+        word = f'  {word} '
+        for i in range(len(word) - 2):
+            grams.add(word[i:i + 3])
+    return grams
+
+
+class TrigramIndex:
+    """
+    Близость запроса сразу ко всем вопросам: для каждой триграммы хранится массив номеров
+    вопросов, в которых она есть, число общих триграмм считается одним np.bincount.
+    """
+
+    def __init__(self, ids, texts):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self._sizes = np.zeros(len(self.ids), dtype=np.float32)
+        postings = {}
+        for row, text in enumerate(texts):
+            grams = trigrams(text)
+            self._sizes[row] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(row)
+        self._postings = {gram: np.asarray(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def scores(self, query):
+        """
+        Близость запроса к каждому вопросу (массив в порядке ids).
+        """
+        grams = trigrams(query)
+        rows = [self._postings[gram] for gram in grams if gram in self._postings]
+        if not rows:
+            return np.zeros(len(self.ids), dtype=np.float32)
+        shared = np.bincount(np.concatenate(rows), minlength=len(self.ids)).astype(np.float32)
+        return shared / (len(grams) + self._sizes - shared)
+
+    def top_k(self, query, k, min_score=0.0):
+        """
+        До k пар (id, близость) с близостью не ниже min_score, по убыванию близости.
+        """
+        if not len(self.ids) or k <= 0:
+            return []
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.lexsort((self.ids[best], -scores[best]))]
+        return [(int(self.ids[row]), float(scores[row])) for row in best if scores[row] >= min_score and scores[row] > 0]
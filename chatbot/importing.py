@@ -0,0 +1,197 @@
+import json
+
+from django.db import transaction
+
+from chatbot.models import FAQ
+from chatbot.text import query_key, split_qa_pairs
+
+# Массовый импорт FAQ из qa_data.json (testt.py), JSONL и экспорта чата Telegram Desktop.
+# Файл читается потоково, в памяти держится только текущая пачка и множество уже
+# встреченных ключей вопросов.
+
+READ_CHUNK_SIZE = 1 << 20
+JSONL_SUFFIXES = ('.jsonl', '.ndjson')
+
+
+class _JSONStream:
+    """
+    Минимальный потоковый разбор JSON: элементы массива верхнего уровня
+    или массива messages в объекте (экспорт Telegram) по одному.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > READ_CHUNK_SIZE:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += chunk
+        return True
+
+    def _peek(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError(f"Unexpected {char or 'end of file'!r} at position {self.pos}, expected {chars!r}")
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # Число в конце буфера могло оборваться: принимаем значение, только если после него что-то есть
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def _array(self):
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        if self._peek() == '[':
+            yield from self._array()
+            return
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'messages' and self._peek() == '[':
+                yield from self._array()
+            else:
+                self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+def iter_json_records(path):
+    """
+    Записи из файла: строки JSONL или элементы JSON-массива.
+    """
+    with open(path, encoding='utf-8') as file:
+        if path.endswith(JSONL_SUFFIXES):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _JSONStream(file)
+
+
+def message_text(message):
+    """
+    Текст сообщения из экспорта Telegram: строка или список фрагментов с разметкой.
+    """
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
+
+
+def iter_qa_pairs(path):
+    """
+    Пары (вопрос, ответ) из файла в любом из поддерживаемых форматов.
+    """
+    for record in iter_json_records(path):
+        if not isinstance(record, dict):
+            continue
+        if 'question' in record:
+            yield record['question'], record.get('answer') or ''
+        elif record.get('type') == 'message':
+            # Сообщение из экспорта группы — разбираем так же, как testt.py
+            for pair in split_qa_pairs(message_text(record)):
+                yield pair['question'], pair['answer']
+
+
+class FAQImporter:
+    """
+    Загружает пары в FAQ пачками по batch_size. Дубликаты определяются по нормализованному
+    вопросу (query_key), из повторов в файлах берется первый. Записываются только новые
+    и измененные вопросы — одним upsert на пачку.
+    """
+
+    def __init__(self, batch_size=1000, dry_run=False):
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.stats = {'read': 0, 'duplicates': 0, 'skipped': 0, 'created': 0, 'updated': 0, 'unchanged': 0}
+        self._seen = set()
+        self._batch = {}
+
+    def add(self, question, answer):
+        self.stats['read'] += 1
+        question, answer = (question or '').strip(), (answer or '').strip()
+        key = query_key(question)
+        if not key or not answer:
+            self.stats['skipped'] += 1
+            return
+        if key in self._seen:
+            self.stats['duplicates'] += 1
+            return
+        self._seen.add(key)
+        self._batch[key] = (question, answer)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, {}
+        existing = {
+            key: (question, answer)
+            for key, question, answer in FAQ.objects.filter(question_key__in=batch)
+            .values_list('question_key', 'question', 'answer')
+        }
+        changed = [
+            FAQ(question_key=key, question=question, answer=answer)
+            for key, (question, answer) in batch.items()
+            if existing.get(key) != (question, answer)
+        ]
+        updated = sum(1 for faq in changed if faq.question_key in existing)
+        self.stats['created'] += len(changed) - updated
+        self.stats['updated'] += updated
+        self.stats['unchanged'] += len(batch) - len(changed)
+        if changed and not self.dry_run:
+            FAQ.objects.bulk_create(
+                changed, update_conflicts=True, unique_fields=['question_key'],
+                update_fields=['question', 'answer', 'updated_at'],
+            )
+
+    def run(self, pairs):
+        """
+        Импорт в одной транзакции: при ошибке FAQ остаются в прежнем виде.
+        """
+        with transaction.atomic():
+            for question, answer in pairs:
+                self.add(question, answer)
+            self.flush()
+        return self.stats
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+import openai
+from django.conf import settings
+
+from chatbot.context import context_tokens
+from chatbot.metrics import metrics
+from chatbot.throttling import TokenBucket, backoff_delay
+
+# Запросы к OpenAI: общий пул HTTP-соединений, ограничение числа одновременных запросов,
+# лимиты запросов и токенов в минуту (как у тарифа API), повторы с джиттером
+# и необязательный "страхующий" второй запрос, если первый долго не отдает первые токены.
+
+# Лимиты тарифа считаются за минуту, допускаем всплеск в объеме BURST_SECONDS секунд лимита
+BURST_SECONDS = 10
+# Ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def retry_after(error):
+    """
+    Задержка из заголовков Retry-After ответа OpenAI, если она есть.
+    """
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        if 'retry-after-ms' in response.headers:
+            return float(response.headers['retry-after-ms']) / 1000
+        if 'retry-after' in response.headers:
+            return float(response.headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class _Race:
+    """
+    Кто из параллельных попыток первым получил токены — его ответ и показывается пользователю.
+    """
+
+    def __init__(self, on_text):
+        self.on_text = on_text
+        self.winner = None
+
+    def claim(self, attempt):
+        if self.winner is None:
+            self.winner = attempt
+        return self.winner is attempt
+
+
+class LLMClient:
+    def __init__(self, client, model, max_concurrency, requests_per_minute=0, tokens_per_minute=0,
+                 completion_tokens=0, max_retries=0, retry_base_delay=0.5, retry_max_delay=8.0, hedge_after=0.0):
+        self.client = client
+        self.model = model
+        self.completion_tokens = completion_tokens
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.hedge_after = hedge_after
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.requests = self.tokens = None
+        if requests_per_minute:
+            self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute / 60 * BURST_SECONDS)
+        if tokens_per_minute:
+            self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 60 * BURST_SECONDS)
+        self.in_flight = 0
+
+    async def complete(self, messages, on_text=None):
+        """
+        Потоковый запрос к модели, возвращает полный текст ответа.
+        on_text(текст) вызывается по мере получения фрагментов.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._hedged(messages, on_text)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, self.retry_base_delay, self.retry_max_delay)
+                server_delay = retry_after(e)
+                if isinstance(e, openai.RateLimitError):
+                    # Тариф исчерпан: придерживаем все запросы процесса, а не только этот
+                    pause = server_delay or delay
+                    for bucket in (self.requests, self.tokens):
+                        if bucket is not None:
+                            bucket.pause(pause)
+                metrics.inc('llm_retries', error=type(e).__name__)
+                logging.warning(f"OpenAI request failed ({e.__class__.__name__}), retry {attempt + 1} in {delay:.1f} s")
+                await asyncio.sleep(max(delay, server_delay or 0))
+
+    async def warm_up(self, connections, timeout=10):
+        """
+        Заранее открывает connections соединений с API (TLS-рукопожатие), заодно проверяя ключ.
+        Ошибки только пишутся в лог: недоступный API не мешает отвечать из FAQ.
+        """
+        if not connections:
+            return
+        requests = [self.client.models.list() for _ in range(connections)]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*requests, return_exceptions=True), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"OpenAI warm-up timed out after {timeout} s")
+            return
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            logging.warning(f"OpenAI warm-up failed: {errors[0]!r}")
+
+    async def close(self):
+        await self.client.close()
+
+    async def _hedged(self, messages, on_text):
+        race = _Race(on_text)
+        loop = asyncio.get_running_loop()
+        tasks = {asyncio.create_task(self._stream(messages, race))}
+        hedge_at = loop.time() + self.hedge_after if self.hedge_after else None
+        error = None
+        try:
+            while tasks:
+                timeout = None
+                if hedge_at is not None and race.winner is None:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, tasks = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Первые токены задерживаются: отправляем такой же запрос параллельно
+                    hedge_at = None
+                    metrics.inc('llm_hedged')
+                    tasks.add(asyncio.create_task(self._stream(messages, race)))
+                    continue
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result() is not None:
+                        return task.result()
+            # Все попытки завершились: та, что получила токены первой, упала с ошибкой
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _stream(self, messages, race):
+        """
+        Одна попытка. Возвращает None, если первой токены получила другая попытка.
+        """
+        attempt = object()
+        if self.requests is not None:
+            await self.requests.acquire()
+        if self.tokens is not None:
+            await self.tokens.acquire(context_tokens(messages) + self.completion_tokens)
+
+        async with self._semaphore:
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    stream=True  # Включаем потоковый режим
+                )
+                async with response:
+                    response_text = ""
+                    async for chunk in response:
+                        try:
+                            content_chunk = chunk.choices[0].delta.content  # Явный доступ к атрибуту
+                        except (AttributeError, IndexError):
+                            logging.error(f"Ошибка при обработке фрагмента: {chunk}")
+                            continue  # Пропускаем фрагмент, если он некорректный
+
+                        if not content_chunk:
+                            continue
+                        if not response_text:
+                            if not race.claim(attempt):
+                                return None
+                            metrics.observe('llm_first_token', time.perf_counter() - started)
+                        response_text += content_chunk
+                        if race.on_text is not None:
+                            race.on_text(response_text)
+
+                metrics.observe('llm_request', time.perf_counter() - started)
+                return response_text
+            finally:
+                self.in_flight -= 1
+
+
+def create_llm_client(model, api_key=None, base_url=None):
+    http_client = openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        ),
+        # Таймаут чтения — пауза между фрагментами ответа, а не время всего ответа
+        timeout=httpx.Timeout(settings.LLM_REQUEST_TIMEOUT, connect=5.0),
+    )
+    client = openai.AsyncOpenAI(
+        api_key=api_key or os.getenv('CHAT_GPT_API_KEY'),
+        base_url=base_url,
+        http_client=http_client,
+        max_retries=0,  # Повторы делает LLMClient
+    )
+    return LLMClient(
+        client,
+        model=model,
+        max_concurrency=settings.LLM_MAX_CONCURRENCY,
+        requests_per_minute=settings.LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.LLM_TOKENS_PER_MINUTE,
+        completion_tokens=settings.LLM_COMPLETION_TOKENS,
+        max_retries=settings.LLM_MAX_RETRIES,
+        retry_base_delay=settings.LLM_RETRY_BASE_DELAY,
+        retry_max_delay=settings.LLM_RETRY_MAX_DELAY,
+        hedge_after=settings.LLM_HEDGE_AFTER,
+    )
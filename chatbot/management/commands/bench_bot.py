@@ -0,0 +1,129 @@
+import asyncio
+import os
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+
+from chatbot.benchmark import FakeServices, QueryCounter, make_queries, percentile, run_load
+from chatbot.importing import FAQImporter, iter_qa_pairs
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест бота на тестовой базе с локальными заглушками Telegram и OpenAI'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data', default=str(settings.BASE_DIR / 'qa_data.json'), help='Файл с парами вопрос-ответ для FAQ')
+        parser.add_argument('--faq-copies', type=int, default=1, help='Сколько раз размножить FAQ (для проверки больших баз)')
+        parser.add_argument('--messages', type=int, default=1000, help='Сколько сообщений отправить')
+        parser.add_argument('--users', type=int, default=100, help='Сколько разных пользователей')
+        parser.add_argument('--rate', type=float, default=0, help='Сообщений в секунду (0 — как можно быстрее)')
+        parser.add_argument('--concurrency', type=int, default=50, help='Максимум одновременно обрабатываемых сообщений')
+        parser.add_argument('--faq-ratio', type=float, default=0.6, help='Доля точных вопросов из FAQ')
+        parser.add_argument('--llm-ratio', type=float, default=0.2, help='Доля вопросов, уходящих в ChatGPT')
+        parser.add_argument('--telegram-latency', type=float, default=0.02, help='Задержка ответа Bot API, с')
+        parser.add_argument('--openai-latency', type=float, default=0.3, help='Задержка первого токена OpenAI, с')
+        parser.add_argument('--openai-chunks', type=int, default=20, help='Фрагментов в потоковом ответе OpenAI')
+        parser.add_argument('--chunk-delay', type=float, default=0.02, help='Пауза между фрагментами OpenAI, с')
+        parser.add_argument('--max-p95', type=float, default=0, help='Завершиться ошибкой, если p95 больше (мс)')
+
+    def handle(self, *args, **options):
+        # Боту и клиенту OpenAI (chatbot.bots.setup_bot) нужны ключи; в стенде запросы идут в заглушки
+        os.environ.setdefault('BOT_TOKEN', '123456:bench')
+        os.environ.setdefault('CHAT_GPT_API_KEY', 'bench')
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            pairs = [(question, answer) for question, answer in iter_qa_pairs(options['data'])]
+            pairs += [
+                (f"{question.rstrip(':')} ({copy}):", answer)
+                for copy in range(1, options['faq_copies'])
+                for question, answer in pairs
+            ]
+            stats = FAQImporter().run(pairs)
+            self.stdout.write(f"FAQ: {stats['created']} вопросов")
+            questions = [question for question, _ in pairs]
+            queries = make_queries(questions, options['messages'], options['faq_ratio'], options['llm_ratio'])
+
+            report = asyncio.run(self.run(queries, options))
+        finally:
+            # Соединения потоков пула закрываются при их завершении
+            for thread in threading.enumerate():
+                if thread.name.startswith('db_'):
+                    thread.join(timeout=5)
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(report, options)
+
+    async def run(self, queries, options):
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+
+        from chatbot import bots
+        from chatbot.llm import create_llm_client
+        from chatbot.metrics import TelegramTimingMiddleware, metrics
+
+        services = FakeServices(
+            telegram_latency=options['telegram_latency'],
+            openai_latency=options['openai_latency'],
+            openai_chunks=options['openai_chunks'],
+            chunk_delay=options['chunk_delay'],
+        )
+        url = await services.start()
+        bots.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+        bots.bot.session.middleware(TelegramTimingMiddleware(metrics))
+        # Клиент, созданный setup_bot() для настоящего API, заменяем клиентом заглушки
+        await bots.llm.close()
+        bots.llm = create_llm_client(bots.LLM_MODEL, api_key='bench', base_url=f'{url}/v1')
+
+        counter = QueryCounter()
+        background = await bots.startup_bot()
+        counter.install()
+        try:
+            latencies, errors, elapsed = await run_load(
+                bots.dp, bots.bot, queries, options['users'], options['rate'], options['concurrency'],
+            )
+        finally:
+            # Дописываем отложенную историю, чтобы ее запросы тоже попали в счетчик
+            await bots.shutdown_bot(background)
+            counter.uninstall()
+            await services.stop()
+        return {
+            'latencies': latencies, 'errors': errors, 'elapsed': elapsed, 'queries': counter.count,
+            'telegram_calls': services.telegram_calls, 'openai_calls': services.openai_calls,
+            'stages': dict(metrics.stages),
+        }
+
+    def report(self, report, options):
+        latencies = report['latencies']
+        count = len(latencies)
+        if not count:
+            raise CommandError('Ни одно сообщение не обработано')
+        p95 = percentile(latencies, 0.95) * 1000
+
+        self.stdout.write(
+            f"Сообщений: {count}, ошибок: {report['errors']}, за {report['elapsed']:.2f} с "
+            f"— {count / report['elapsed']:.1f} сообщ./с"
+        )
+        self.stdout.write(
+            f"Задержка, мс: p50 {percentile(latencies, 0.5) * 1000:.1f}, p95 {p95:.1f}, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}, max {max(latencies) * 1000:.1f}"
+        )
+        self.stdout.write(f"SQL-запросов на сообщение: {report['queries'] / count:.2f}")
+        telegram_calls = sum(report['telegram_calls'].values())
+        self.stdout.write(
+            f"Bot API: {telegram_calls / count:.2f} вызовов на сообщение "
+            f"({', '.join(f'{method} {calls}' for method, calls in sorted(report['telegram_calls'].items()))}), "
+            f"OpenAI: {report['openai_calls']} запросов"
+        )
+        self.stdout.write("Этапы (оценка по гистограммам), мс:")
+        for stage, histogram in sorted(report['stages'].items()):
+            self.stdout.write(
+                f"  {stage:<28} n={histogram.count:<6} среднее {histogram.sum / histogram.count * 1000:8.1f}"
+                f"  p50 ≤{histogram.quantile(0.5) * 1000:g}  p99 ≤{histogram.quantile(0.99) * 1000:g}"
+            )
+
+        if options['max_p95'] and p95 > options['max_p95']:
+            raise CommandError(f"p95 {p95:.1f} мс больше допустимых {options['max_p95']:g} мс")
@@ -0,0 +1,80 @@
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.context import ContextBuilder, RollingSummary, content, context_tokens, system_prompt
+
+
+def build_legacy_context(turns, query):
+    # Контекст в прежнем виде: промпт дважды и последние 5 ходов целиком
+    context = [{"role": "system", "content": system_prompt('assistant')}, {"role": "system", "content": content}]
+    for turn in turns[-5:]:
+        context.append({"role": "user", "content": turn.query})
+        context.append({"role": "assistant", "content": turn.response})
+    context.append({"role": "user", "content": query})
+    return context
+
+
+class Command(BaseCommand):
+    help = 'Сравнение размера и времени сборки контекста ChatGPT: прежний способ и бюджет токенов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--data', default=str(settings.BASE_DIR / 'qa_data.json'), help='Файл с парами вопрос-ответ')
+        parser.add_argument('--turns', type=int, default=settings.CONVERSATION_CACHE_TURNS, help='Ходов в диалоге')
+        parser.add_argument('--answer-repeat', type=int, default=4, help='Во сколько раз удлинить ответы')
+        parser.add_argument('--iterations', type=int, default=2000)
+        parser.add_argument(
+            '--live', action='store_true',
+            help='Дополнительно отправить оба контекста в OpenAI и замерить время ответа (платно)',
+        )
+
+    def handle(self, *args, **options):
+        with open(options['data'], encoding='utf-8') as f:
+            pairs = json.load(f)
+        random.seed(1)
+        turns = [
+            SimpleNamespace(query=pair['question'], response=' '.join([pair['answer']] * options['answer_repeat']))
+            for pair in random.sample(pairs, min(options['turns'], len(pairs)))
+        ]
+        query = 'Сколько стоит устройство и как его получить?'
+
+        builder = ContextBuilder(
+            budget=settings.LLM_CONTEXT_TOKENS,
+            summary=RollingSummary(budget=settings.LLM_SUMMARY_TOKENS, max_users=1, ttl=60),
+        )
+        variants = {
+            'прежний': lambda: build_legacy_context(turns, query),
+            'бюджет': lambda: builder.build('bench', system_prompt('assistant'), turns, query),
+        }
+
+        contexts = {}
+        for name, build in variants.items():
+            started = time.perf_counter()
+            for _ in range(options['iterations']):
+                contexts[name] = build()
+            elapsed = (time.perf_counter() - started) / options['iterations']
+            self.stdout.write(
+                f"{name:>8}: {len(contexts[name])} сообщений, ~{context_tokens(contexts[name])} токенов, "
+                f"сборка {elapsed * 1e6:.0f} мкс"
+            )
+
+        if options['live']:
+            import asyncio
+            asyncio.run(self.measure_live(contexts))
+
+    async def measure_live(self, contexts):
+        from chatbot.bots import LLM_MODEL, llm
+
+        for name, context in contexts.items():
+            started = time.perf_counter()
+            first_token = None
+            response = await llm.client.chat.completions.create(model=LLM_MODEL, messages=context, stream=True)
+            async for chunk in response:
+                if first_token is None and chunk.choices and chunk.choices[0].delta.content:
+                    first_token = time.perf_counter() - started
+            total = time.perf_counter() - started
+            self.stdout.write(f"{name:>8}: первый токен {first_token or 0:.2f} с, весь ответ {total:.2f} с")
@@ -0,0 +1,77 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.embeddings import get_embedder, load_or_build_vectors
+from chatbot.models import FAQ, FAQLearning
+from chatbot.search import FAQEntry, FAQIndex
+
+
+class Command(BaseCommand):
+    help = 'Расчет векторов вопросов FAQ для семантического поиска'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--evaluate', type=int, default=0, metavar='N',
+            help='Сравнить поиск по словам и по эмбеддингам на последних N вопросах из FAQLearning',
+        )
+
+    def handle(self, *args, **options):
+        entries = [
+            FAQEntry(*row)
+            for row in FAQ.objects.order_by('id').values_list('id', 'question', 'answer')
+        ]
+        embedder = get_embedder()
+
+        started = time.perf_counter()
+        vectors = load_or_build_vectors(entries, embedder)
+        self.stdout.write(
+            f"{len(vectors)} векторов ({embedder.name}) за {time.perf_counter() - started:.2f} с "
+            f"-> {settings.FAQ_EMBEDDINGS_PATH}"
+        )
+
+        if options['evaluate']:
+            self.evaluate(FAQIndex(entries, vectors=vectors), embedder, options['evaluate'])
+
+    def evaluate(self, index, embedder, count):
+        # Вопросы из FAQLearning — ровно те, что раньше ушли в ChatGPT
+        questions = list(
+            FAQLearning.objects.order_by('-created_at').values_list('question', flat=True)[:count]
+        )
+        if not questions:
+            self.stdout.write("В FAQLearning нет вопросов для оценки")
+            return
+
+        limit = settings.FAQ_SEARCH_LIMIT
+        query_vectors = embedder.embed(questions)
+        stats = {'lexical': [0, 0], 'semantic': [0, 0]}
+        for question, vector in zip(questions, query_vectors):
+            lexical = index.search(question, min_score=settings.FAQ_INDEX_MIN_SCORE, limit=limit)
+            if lexical.exact:
+                stats['lexical'][0] += 1
+                stats['semantic'][0] += 1
+                continue
+            if lexical.candidates:
+                stats['lexical'][1] += 1
+
+            matches = index.semantic(vector, min_score=settings.FAQ_SEMANTIC_MIN_SCORE, limit=limit)
+            if matches and matches[0][1] >= settings.FAQ_SEMANTIC_EXACT_SCORE:
+                stats['semantic'][0] += 1
+            elif matches:
+                stats['semantic'][1] += 1
+
+        total = len(questions)
+        for mode, (exact, candidates) in stats.items():
+            fallback = total - exact - candidates
+            self.stdout.write(
+                f"{mode:>8}: точных {exact} ({exact / total:.0%}), "
+                f"с уточнением {candidates} ({candidates / total:.0%}), "
+                f"в ChatGPT {fallback} ({fallback / total:.0%})"
+            )
+
+        started = time.perf_counter()
+        for vector in query_vectors:
+            index.vectors.top_k(vector, limit)
+        elapsed = (time.perf_counter() - started) / total
+        self.stdout.write(f"top-{limit} по {len(index.vectors)} векторам: {elapsed * 1e6:.0f} мкс на запрос")
@@ -0,0 +1,48 @@
+import itertools
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.importing import FAQImporter, iter_qa_pairs
+from chatbot.models import FAQ
+from chatbot.search import FAQEntry, faq_changed
+
+
+class Command(BaseCommand):
+    help = 'Импорт вопросов и ответов в FAQ из qa_data.json, JSONL или экспорта чата Telegram'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Файлы .json, .jsonl или result.json из Telegram Desktop')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки upsert')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать изменения, ничего не записывать')
+        parser.add_argument(
+            '--embeddings', action='store_true',
+            help='Сразу досчитать векторы измененных вопросов (по умолчанию — если включен семантический поиск)',
+        )
+
+    def handle(self, *args, **options):
+        importer = FAQImporter(batch_size=options['batch_size'], dry_run=options['dry_run'])
+
+        started = time.perf_counter()
+        stats = importer.run(itertools.chain.from_iterable(iter_qa_pairs(path) for path in options['paths']))
+        self.stdout.write(
+            f"Прочитано {stats['read']} пар за {time.perf_counter() - started:.2f} с: "
+            f"новых {stats['created']}, измененных {stats['updated']}, без изменений {stats['unchanged']}, "
+            f"дубликатов {stats['duplicates']}, пропущено {stats['skipped']}"
+        )
+        if options['dry_run'] or not (stats['created'] or stats['updated']):
+            return
+
+        # bulk_create не отправляет сигналы; боты заметят изменения по отпечатку таблицы FAQ
+        faq_changed()
+        if options['embeddings'] or settings.FAQ_SEARCH_MODE != 'lexical':
+            from chatbot.embeddings import load_or_build_vectors
+
+            started = time.perf_counter()
+            entries = [
+                FAQEntry(*row)
+                for row in FAQ.objects.order_by('id').values_list('id', 'question', 'answer')
+            ]
+            vectors = load_or_build_vectors(entries)
+            self.stdout.write(f"{len(vectors)} векторов за {time.perf_counter() - started:.2f} с")
@@ -0,0 +1,157 @@
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from chatbot.clustering import QuestionClusterer, central_question
+from chatbot.models import FAQ, FAQLearning
+from chatbot.search import FAQEntry, FAQIndex, faq_changed
+from chatbot.text import query_key
+
+
+class Command(BaseCommand):
+    help = 'Поиск частых вопросов из FAQLearning (ответы ChatGPT) и перенос их в FAQ'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Сколько строк FAQLearning читать за раз')
+        parser.add_argument('--days', type=int, default=0, help='Только вопросы за последние N дней (0 — все)')
+        parser.add_argument('--similarity', type=float, default=0.6, help='Близость формулировок в одном кластере, 0..1')
+        parser.add_argument('--min-count', type=int, default=3, help='Минимум повторов вопроса для переноса в FAQ')
+        parser.add_argument(
+            '--max-clusters', type=int, default=100000,
+            help='Предел числа кластеров в памяти (порядка 3 КБ на кластер)',
+        )
+        parser.add_argument('--limit', type=int, default=100, help='Максимум предложений')
+        parser.add_argument('--related', type=int, default=3, help='Сколько похожих вопросов FAQ связать с новым')
+        parser.add_argument('--output', help='Сохранить предложения в JSONL (формат import_faq)')
+        parser.add_argument('--apply', action='store_true', help='Добавить предложения в FAQ')
+
+    def handle(self, *args, **options):
+        clusterer = QuestionClusterer(
+            similarity=options['similarity'],
+            max_clusters=options['max_clusters'],
+            min_count=options['min_count'],
+        )
+        started = time.perf_counter()
+        for chunk in self.iter_learning(options['chunk_size'], options['days']):
+            for learning_id, question in chunk:
+                clusterer.add(learning_id, question)
+            clusterer.evict()
+        stats = clusterer.stats
+        self.stdout.write(
+            f"Прочитано {stats['read']} вопросов за {time.perf_counter() - started:.2f} с: "
+            f"кластеров {len(clusterer.clusters)}, вытеснено {stats['evicted']}, пропущено {stats['skipped']}"
+        )
+
+        proposals = self.build_proposals(clusterer.frequent(), options['limit'], options['related'])
+        if not proposals:
+            self.stdout.write("Новых частых вопросов нет")
+            return
+        for proposal in proposals:
+            self.stdout.write(f"{proposal['count']:>6}  {proposal['question']}")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                for proposal in proposals:
+                    f.write(json.dumps(proposal, ensure_ascii=False) + '\n')
+            self.stdout.write(f"{len(proposals)} предложений -> {options['output']}")
+        if options['apply']:
+            self.apply(proposals)
+
+    def iter_learning(self, chunk_size, days):
+        """
+        FAQLearning пачками по возрастанию id, без OFFSET и без загрузки ответов.
+        """
+        queryset = FAQLearning.objects.order_by('id')
+        if days:
+            queryset = queryset.filter(created_at__gte=timezone.now() - timedelta(days=days))
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id).values_list('id', 'question')[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1][0]
+
+    def build_proposals(self, clusters, limit, related):
+        """
+        Вопрос и ответ для каждого частого кластера. Кластеры, на которые уже отвечает FAQ,
+        пропускаются, для остальных подбираются похожие вопросы FAQ.
+        """
+        index = FAQIndex([
+            FAQEntry(*row)
+            for row in FAQ.objects.order_by('id').values_list('id', 'question', 'answer')
+        ])
+        proposals = []
+        seen = set()
+        for start in range(0, len(clusters), 1000):
+            batch = clusters[start:start + 1000]
+            ids = {cluster.latest_id for cluster in batch}
+            for cluster in batch:
+                ids.update(cluster.samples)
+            rows = FAQLearning.objects.in_bulk(ids)
+            # Ошибки API, пустые ответы и отказы модели в FAQ не попадают
+            usable = set(FAQLearning.objects.usable().filter(id__in=ids).values_list('id', flat=True))
+            for cluster in batch:
+                questions = [rows[i].question.strip() for i in cluster.samples if i in rows]
+                if not questions:
+                    continue  # Строки удалены, пока шла кластеризация
+                # Ответ — самый свежий из пригодных: последний в кластере, затем из выборки
+                answer_ids = [cluster.latest_id, *sorted(cluster.samples, reverse=True)]
+                answer_id = next((i for i in answer_ids if i in usable and i in rows), None)
+                if answer_id is None:
+                    continue
+                question = central_question(questions)
+                answer = rows[answer_id].answer.strip()
+                key = query_key(question)
+                if not answer or not key or key in seen:
+                    continue
+                seen.add(key)
+                result = index.search(
+                    question,
+                    min_score=settings.FAQ_INDEX_MIN_SCORE,
+                    limit=related,
+                    fuzzy_exact_score=settings.FAQ_FUZZY_EXACT_SCORE if settings.FAQ_FUZZY_ENABLED else None,
+                    fuzzy_min_score=settings.FAQ_FUZZY_MIN_SCORE,
+                )
+                if result.exact:
+                    continue
+                proposals.append({
+                    'question': question,
+                    'answer': answer,
+                    'count': cluster.count,
+                    'related': [entry.id for entry in result.candidates[:related]],
+                })
+                if len(proposals) >= limit:
+                    return proposals
+        return proposals
+
+    def apply(self, proposals):
+        Related = FAQ.related_questions.through
+        with transaction.atomic():
+            faqs = FAQ.objects.bulk_create([
+                FAQ(question=proposal['question'], question_key=query_key(proposal['question']), answer=proposal['answer'])
+                for proposal in proposals
+            ])
+            # Связь симметричная: при записи в промежуточную таблицу напрямую нужны обе стороны
+            links = []
+            for faq, proposal in zip(faqs, proposals):
+                for related_id in proposal['related']:
+                    links.append(Related(from_faq_id=faq.id, to_faq_id=related_id))
+                    links.append(Related(from_faq_id=related_id, to_faq_id=faq.id))
+            Related.objects.bulk_create(links, ignore_conflicts=True)
+        self.stdout.write(f"Добавлено в FAQ: {len(faqs)}, связей с похожими вопросами: {len(links) // 2}")
+
+        # bulk_create не отправляет сигналы; боты заметят изменения по отпечатку таблицы FAQ
+        faq_changed()
+        if settings.FAQ_SEARCH_MODE != 'lexical':
+            from chatbot.embeddings import load_or_build_vectors
+
+            load_or_build_vectors([
+                FAQEntry(*row)
+                for row in FAQ.objects.order_by('id').values_list('id', 'question', 'answer')
+            ])
@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chatbot.retention import archive_queries, purge_archive
+
+
+class Command(BaseCommand):
+    help = 'Перенос старых запросов из UserQuery в архив и очистка архива (запускать по расписанию)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.HISTORY_RETENTION_DAYS,
+            help='Переносить запросы старше N дней (0 — не переносить)',
+        )
+        parser.add_argument(
+            '--archive-days', type=int, default=settings.HISTORY_ARCHIVE_RETENTION_DAYS,
+            help='Удалять из архива запросы старше N дней (0 — хранить всегда)',
+        )
+        parser.add_argument('--batch-size', type=int, default=settings.HISTORY_PURGE_BATCH_SIZE, help='Размер пачки')
+        parser.add_argument('--no-archive', action='store_true', help='Удалять старые запросы, не сохраняя в архив')
+        parser.add_argument('--pause', type=float, default=0.0, help='Пауза между пачками (с), чтобы не нагружать базу')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        if options['days']:
+            moved = self.run_batches(
+                archive_queries(
+                    now - timedelta(days=options['days']), options['batch_size'], archive=not options['no_archive'],
+                ),
+                options['pause'],
+            )
+            action = 'Удалено' if options['no_archive'] else 'Перенесено в архив'
+            self.stdout.write(f"{action} запросов старше {options['days']} дн.: {moved}")
+
+        if options['archive_days']:
+            purged = self.run_batches(
+                purge_archive(now - timedelta(days=options['archive_days']), options['batch_size']),
+                options['pause'],
+            )
+            self.stdout.write(f"Удалено из архива запросов старше {options['archive_days']} дн.: {purged}")
+
+    def run_batches(self, batches, pause):
+        total = 0
+        started = time.perf_counter()
+        for count in batches:
+            total += count
+            self.stdout.write(f"  {total} строк, {total / (time.perf_counter() - started):.0f} строк/с")
+            if pause:
+                time.sleep(pause)
+        return total
@@ -1,10 +1,73 @@
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import argparse
 import asyncio
-from chatbot.bots import start_bot  # Импортируем функцию для запуска бота
+
 
 class Command(BaseCommand):
     help = 'Запуск Telegram-бота'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--set-webhook', action='store_true',
+            help='Зарегистрировать TELEGRAM_WEBHOOK_URL в Telegram и выйти (бот работает в ASGI-приложении)',
+        )
+        parser.add_argument(
+            '--delete-webhook', action='store_true',
+            help='Удалить webhook в Telegram и выйти (для возврата к long polling)',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.BOT_WORKERS,
+            help='Число процессов-обработчиков; больше 1 — супервизор раздает им обновления по id пользователя',
+        )
+        # Номер воркера: так супервизор запускает дочерние процессы
+        parser.add_argument('--worker-shard', type=int, default=None, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['set_webhook']:
+            asyncio.run(self.set_webhook())
+            return
+        if options['delete_webhook']:
+            asyncio.run(self.delete_webhook())
+            return
+
+        if options['worker_shard'] is not None:
+            from chatbot.workers import run_worker
+
+            asyncio.run(run_worker(options['worker_shard'], options['workers']))
+            return
+        if options['workers'] > 1:
+            from chatbot.workers import run_supervisor
+
+            asyncio.run(run_supervisor(options['workers']))
+            return
+
+        from chatbot.bots import start_bot  # Импортируем функцию для запуска бота
+
         # Запускаем бота в основном потоке
         asyncio.run(start_bot())
+
+    async def set_webhook(self):
+        from chatbot.bots import bot, dp
+
+        if not settings.TELEGRAM_WEBHOOK_URL:
+            raise CommandError('TELEGRAM_WEBHOOK_URL не задан')
+        try:
+            await bot.set_webhook(
+                settings.TELEGRAM_WEBHOOK_URL,
+                secret_token=settings.TELEGRAM_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(settings.WEBHOOK_MAX_CONCURRENCY, 100),
+            )
+        finally:
+            await bot.session.close()
+        self.stdout.write(f'Webhook установлен: {settings.TELEGRAM_WEBHOOK_URL}')
+
+    async def delete_webhook(self):
+        from chatbot.bots import bot
+
+        try:
+            await bot.delete_webhook()
+        finally:
+            await bot.session.close()
+        self.stdout.write('Webhook удален')
@@ -0,0 +1,276 @@
+import cProfile
+import hmac
+import io
+import logging
+import pstats
+import random
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+# Метрики задержек бота: длительность этапов обработки сообщения собирается в гистограммы
+# и отдается в текстовом формате Prometheus (/metrics в Django или отдельный порт в режиме polling).
+# Все наблюдения делаются в потоке event loop, поэтому блокировки не нужны.
+# Модуль импортируется при старте Django (через chatbot.signals), поэтому aiogram здесь не импортируется.
+
+# Границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина — больше всех границ
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Оценка квантиля сверху — граница корзины, в которую он попал.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class Metrics:
+    """
+    Гистограммы длительности этапов, счетчики событий и значения, вычисляемые при выгрузке.
+    """
+
+    def __init__(self, enabled=True, prefix='chatbot'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        if not self.enabled:
+            return
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, func):
+        """
+        Регистрирует значение (например, длину очереди), которое читается при каждой выгрузке.
+        """
+        self.gauges[name] = func
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def timed(self, stage):
+        """
+        Декоратор для корутин: время выполнения попадает в гистограмму stage.
+        """
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        """
+        Текущие значения в виде, пригодном для JSON: так воркеры передают метрики супервизору.
+        """
+        gauges = {}
+        for gauge, func in self.gauges.items():
+            try:
+                gauges[gauge] = func()
+            except Exception as e:
+                logging.error(f"Error while reading gauge {gauge}: {e}")
+        return {
+            'stages': {stage: [histogram.counts, histogram.sum, histogram.count] for stage, histogram in self.stages.items()},
+            'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+            'gauges': gauges,
+        }
+
+    def merge(self, snapshot):
+        """
+        Прибавляет снимок другого процесса: гистограммы, счетчики и значения gauge складываются.
+        """
+        for stage, (counts, total, count) in snapshot['stages'].items():
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.counts = [ours + theirs for ours, theirs in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(label) for label in labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+        for gauge, value in snapshot['gauges'].items():
+            previous = self.gauges.get(gauge)
+            total = value + (previous() if previous else 0)
+            self.gauges[gauge] = lambda total=total: total
+
+    def render(self):
+        lines = []
+        name = f'{self.prefix}_stage_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for stage, histogram in sorted(self.stages.items()):
+            total = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {total}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for counter in sorted({counter for counter, _ in self.counters}):
+            lines.append(f'# TYPE {self.prefix}_{counter}_total counter')
+            for (key, labels), value in sorted(self.counters.items()):
+                if key == counter:
+                    lines.append(f'{self.prefix}_{counter}_total{{{_labels(labels)}}} {value}')
+
+        for gauge, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logging.error(f"Error while reading gauge {gauge}: {e}")
+                continue
+            lines.append(f'# TYPE {self.prefix}_{gauge} gauge')
+            lines.append(f'{self.prefix}_{gauge} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+    """
+    cProfile для доли rate обработанных сообщений, статистика накапливается между выборками.
+    Профилируется весь поток event loop, поэтому в выборку попадают и параллельные обработчики.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.samples = 0
+        self._stats = None
+        self._active = False
+
+    @contextmanager
+    def sample(self):
+        # В потоке может работать только один профилировщик
+        if self._active or not self.rate or random.random() >= self.rate:
+            yield
+            return
+        profiler = cProfile.Profile()
+        self._active = True
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._active = False
+            self.samples += 1
+            if self._stats is None:
+                self._stats = pstats.Stats(profiler)
+            else:
+                self._stats.add(profiler)
+
+    def report(self, limit=40):
+        if self._stats is None:
+            return 'No profile samples yet\n'
+        output = io.StringIO()
+        output.write(f'{self.samples} samples\n')
+        self._stats.stream = output
+        self._stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+
+class TelegramTimingMiddleware:
+    """
+    Время запросов к Bot API по методам (sendMessage, editMessageText, sendChatAction...).
+    Middleware запросов aiogram: bot.session.middleware(TelegramTimingMiddleware(metrics)).
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    async def __call__(self, make_request, bot, method):
+        with self.registry.span(f'telegram.{method.__api_method__}'):
+            return await make_request(bot, method)
+
+
+metrics = Metrics(enabled=settings.METRICS_ENABLED)
+profiler = SamplingProfiler(rate=settings.METRICS_PROFILE_RATE)
+
+
+def authorized(headers, query):
+    """
+    Проверка токена METRICS_TOKEN из заголовка Authorization (Bearer) или параметра token.
+    Если токен не задан, доступ есть только в DEBUG или при METRICS_PUBLIC.
+    """
+    if not settings.METRICS_TOKEN:
+        return settings.DEBUG or settings.METRICS_PUBLIC
+    token = headers.get('Authorization', '').removeprefix('Bearer ') or query.get('token', '')
+    return hmac.compare_digest(token, settings.METRICS_TOKEN)
+
+
+async def start_metrics_server(host, port, registry=None, ready=None):
+    """
+    Отдельный HTTP-сервер метрик для бота в режиме polling, где Django не запущен.
+    registry — объект с методом render(), по умолчанию метрики этого процесса;
+    ready — функция готовности для /ready (200 или 503), по умолчанию готовность этого процесса.
+    """
+    from aiohttp import web
+
+    from chatbot.startup import is_ready
+
+    registry = registry or metrics
+    ready = ready or is_ready
+
+    async def handle(request):
+        if not authorized(request.headers, request.query):
+            return web.Response(status=403)
+        body = profiler.report() if 'profile' in request.query else registry.render()
+        return web.Response(body=body.encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    async def handle_ready(request):
+        if ready():
+            return web.Response(text='ready')
+        return web.Response(status=503, text='starting')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    app.router.add_get('/ready', handle_ready)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Metrics server started on {host}:{port}")
+    return runner
@@ -0,0 +1,52 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Вектор считается в базе, поэтому он актуален и после save(), и после bulk_create/update
+CREATE_TRIGGER = """
+CREATE FUNCTION chatbot_faq_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('russian', coalesce(NEW.question, '')), 'A') ||
+        setweight(to_tsvector('russian', coalesce(NEW.answer, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER chatbot_faq_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF question, answer ON chatbot_faq
+    FOR EACH ROW EXECUTE FUNCTION chatbot_faq_search_vector_update();
+
+UPDATE chatbot_faq SET search_vector =
+    setweight(to_tsvector('russian', coalesce(question, '')), 'A') ||
+    setweight(to_tsvector('russian', coalesce(answer, '')), 'B');
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER IF EXISTS chatbot_faq_search_vector_trigger ON chatbot_faq;
+DROP FUNCTION IF EXISTS chatbot_faq_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0003_faq_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="faq",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="faq",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="chatbot_faq_search_gin"
+            ),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0004_faq_search_vector"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FSMRecord",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("key", models.CharField(max_length=255, unique=True)),
+                ("state", models.CharField(blank=True, max_length=255, null=True)),
+                ("data", models.JSONField(default=dict)),
+                ("expires_at", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
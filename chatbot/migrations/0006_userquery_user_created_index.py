@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0005_fsmrecord"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="userquery",
+            index=models.Index(
+                fields=["user_id", "-created_at"], name="chatbot_uq_user_created_idx"
+            ),
+        ),
+    ]
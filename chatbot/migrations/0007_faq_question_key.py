@@ -0,0 +1,43 @@
+import re
+
+from django.db import migrations, models
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def query_key(text):
+    # Копия chatbot.text.query_key на момент миграции: изменения в коде приложения
+    # не должны менять то, что делает уже написанная миграция
+    text = (text or "").casefold().replace("ё", "е")
+    return " ".join(_WORD_RE.findall(text))
+
+
+def fill_question_keys(apps, schema_editor):
+    # Ключ получает первый (самый старый) из вопросов-дубликатов, у остальных он остается пустым
+    FAQ = apps.get_model("chatbot", "FAQ")
+    seen = set()
+    changed = []
+    for faq in FAQ.objects.order_by("id").only("id", "question").iterator():
+        key = query_key(faq.question) or None
+        if key is None or key in seen:
+            continue
+        seen.add(key)
+        faq.question_key = key
+        changed.append(faq)
+    FAQ.objects.bulk_update(changed, ["question_key"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0006_userquery_user_created_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="faq",
+            name="question_key",
+            field=models.TextField(editable=False, null=True, unique=True),
+        ),
+        migrations.RunPython(fill_question_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chatbot", "0008_faq_question_trgm"),
+    ]
+
+    operations = [
+        # Только поведение Django при удалении: в базе ограничение внешнего ключа не меняется
+        migrations.AlterField(
+            model_name="userquery",
+            name="parent",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="children",
+                to="chatbot.userquery",
+            ),
+        ),
+        migrations.CreateModel(
+            name="UserQueryArchive",
+            fields=[
+                ("id", models.BigIntegerField(primary_key=True, serialize=False)),
+                ("user_id", models.CharField(max_length=100)),
+                ("query", models.TextField()),
+                ("response", models.TextField(blank=True, null=True)),
+                ("faq_match_id", models.BigIntegerField(blank=True, null=True)),
+                ("parent_id", models.BigIntegerField(blank=True, null=True)),
+                ("created_at", models.DateTimeField()),
+                ("escalated_to_human", models.BooleanField(default=False)),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["user_id", "-created_at"],
+                        name="chatbot_uqa_user_created_idx",
+                    ),
+                    models.Index(fields=["created_at"], name="chatbot_uqa_created_idx"),
+                ],
+            },
+        ),
+    ]
@@ -1,32 +1,139 @@
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.functions import Upper
+
+from chatbot.context import OFF_TOPIC_ANSWER
+from chatbot.text import query_key
+
+# Конфигурация полнотекстового поиска PostgreSQL, база FAQ на русском
+SEARCH_CONFIG = 'russian'
+
+
+class FAQQuerySet(models.QuerySet):
+    def update_search_vector(self):
+        # Обычно вектор пересчитывает триггер в базе (миграция 0004), метод нужен для ручного пересчета
+        return self.update(
+            search_vector=SearchVector('question', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('answer', weight='B', config=SEARCH_CONFIG)
+        )
+
 
 class FAQ(models.Model):
     question = models.TextField()  # Вопрос в FAQ
+    question_key = models.TextField(unique=True, null=True, editable=False)  # Нормализованный вопрос, по нему импорт находит дубликаты
     answer = models.TextField()    # Ответ на вопрос
     related_questions = models.ManyToManyField('self', blank=True)  # Связанные вопросы для уточнений
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Время последнего изменения, по нему бот перестраивает индекс поиска
+    search_vector = SearchVectorField(null=True, editable=False)  # Вопрос (вес A) и ответ (вес B), заполняется триггером
+
+    objects = FAQQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['search_vector'], name='chatbot_faq_search_gin'),
+            # Триграммы вопроса (pg_trgm): поиск с опечатками и icontains без полного просмотра таблицы
+            GinIndex(OpClass(Upper('question'), name='gin_trgm_ops'), name='chatbot_faq_question_trgm'),
+        ]
 
     def __str__(self):
         return self.question
 
+    def clean(self):
+        key = query_key(self.question) or None
+        if key and FAQ.objects.filter(question_key=key).exclude(pk=self.pk).exists():
+            raise ValidationError({'question': "Такой вопрос уже есть в FAQ"})
+
+    def save(self, *args, **kwargs):
+        self.question_key = query_key(self.question) or None
+        super().save(*args, **kwargs)
+
 
 class UserQuery(models.Model):
     user_id = models.CharField(max_length=100)  # ID пользователя Telegram
     query = models.TextField()                  # Запрос пользователя
     response = models.TextField(null=True, blank=True)  # Ответ, если найден
     faq_match = models.ForeignKey(FAQ, null=True, blank=True, on_delete=models.SET_NULL)  # Связанный вопрос FAQ, если найден
-    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='children')  # Ссылка на предыдущее сообщение (если есть)
+    # Ссылка на предыдущее сообщение (если есть). При удалении старых запросов цепочка
+    # обрывается, а не удаляется целиком (см. команду purge_history)
+    parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='children')
     created_at = models.DateTimeField(auto_now_add=True)
     escalated_to_human = models.BooleanField(default=False)  # Флаг эскалации на человека
 
+    class Meta:
+        indexes = [
+            # Последние запросы пользователя: родитель нового запроса и контекст для ChatGPT
+            models.Index(fields=['user_id', '-created_at'], name='chatbot_uq_user_created_idx'),
+        ]
+
     def __str__(self):
         return f"Query from {self.user_id}: {self.query}"
 
 
+class UserQueryArchive(models.Model):
+    """
+    Запросы старше HISTORY_RETENTION_DAYS, перенесенные из UserQuery командой purge_history.
+    Id сохраняются прежними, ссылки хранятся числами без внешних ключей.
+    """
+    id = models.BigIntegerField(primary_key=True)  # Id запроса в UserQuery
+    user_id = models.CharField(max_length=100)
+    query = models.TextField()
+    response = models.TextField(null=True, blank=True)
+    faq_match_id = models.BigIntegerField(null=True, blank=True)
+    parent_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField()
+    escalated_to_human = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_id', '-created_at'], name='chatbot_uqa_user_created_idx'),
+            models.Index(fields=['created_at'], name='chatbot_uqa_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived query from {self.user_id}: {self.query}"
+
+
+# Ответы, которые бот записывает в FAQLearning вместо ответа ChatGPT
+EMPTY_ANSWER = "Ответ от ассистента пустой."
+ERROR_ANSWER_PREFIX = "Извините, произошла ошибка"
+# Начала отказов модели отвечать: ответ по системному промпту (иногда в кавычках) и обычные отказы
+REFUSAL_PREFIXES = (
+    OFF_TOPIC_ANSWER, f'"{OFF_TOPIC_ANSWER}', f'«{OFF_TOPIC_ANSWER}',
+    "Извините, я не могу", "К сожалению, я не могу", "I'm sorry", "I cannot", "I can't",
+)
+
+
+class FAQLearningQuerySet(models.QuerySet):
+    def usable(self):
+        """
+        Без ошибок, пустых ответов и отказов: только такие ответы кэшируются и переносятся в FAQ.
+        """
+        unusable = models.Q(answer='') | models.Q(answer=EMPTY_ANSWER) | models.Q(answer__startswith=ERROR_ANSWER_PREFIX)
+        for prefix in REFUSAL_PREFIXES:
+            unusable |= models.Q(answer__istartswith=prefix)
+        return self.exclude(unusable)
+
+
 class FAQLearning(models.Model):
     question = models.TextField()  # Вопрос пользователя, на который не нашлось ответа
     answer = models.TextField()    # Ответ от человека, который потом добавляется в FAQ
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = FAQLearningQuerySet.as_manager()
+
     def __str__(self):
         return self.question
+
+
+class FSMRecord(models.Model):
+    key = models.CharField(max_length=255, unique=True)  # Ключ состояния aiogram (бот, чат, пользователь)
+    state = models.CharField(max_length=255, null=True, blank=True)  # Текущее состояние FSM
+    data = models.JSONField(default=dict)  # Данные состояния
+    expires_at = models.DateTimeField(db_index=True)  # После этого времени запись считается устаревшей
+
+    def __str__(self):
+        return f"{self.key}: {self.state}"
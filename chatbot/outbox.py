@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendChatAction, SendMessage
+
+from chatbot.cache import TTLCache
+from chatbot.metrics import metrics
+from chatbot.throttling import TokenBucket
+
+# Очередь исходящих запросов к Bot API. Обработчики ставят сообщения в очередь и не ждут сети,
+# а отправка идет с учетом лимитов Telegram: около 30 сообщений в секунду на бота,
+# 1 в секунду в личный чат (с небольшим всплеском) и 20 в минуту в группу.
+# Сообщения в один чат уходят строго по порядку, RetryAfter обрабатывается здесь же.
+
+
+class _Job:
+    __slots__ = ('method', 'future', 'droppable')
+
+    def __init__(self, method, future, droppable=False):
+        self.method = method
+        self.future = future
+        self.droppable = droppable  # Можно не отправлять, если чат упирается в лимит (chat action)
+
+
+def _log_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Error while sending to Telegram: {future.exception()}")
+
+
+class Outbox:
+    """
+    Планировщик отправки. Методы send_message и edit_message_text повторяют Bot API
+    и возвращают future: его можно ждать (нужен message_id) или не ждать вовсе.
+    """
+
+    def __init__(self, bot, rate, chat_rate, chat_burst, group_rate, workers, chat_ttl=60):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.workers = workers
+        self._global = TokenBucket(rate)
+        self._buckets = TTLCache(maxsize=100000, ttl=chat_ttl)  # chat_id -> TokenBucket
+        self._chats = {}  # chat_id -> очередь заданий; чат есть здесь, пока у него есть задания
+        self._ready = asyncio.Queue()  # чаты, у которых можно отправлять следующее задание
+        self._runners = []
+        self._closing = False
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self._chats.values())
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные id — группы и каналы, у них лимит строже
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, capacity=self.chat_burst)
+        self._buckets.set(chat_id, bucket)
+        return bucket
+
+    def _ensure_running(self):
+        self._runners = [task for task in self._runners if not task.done()]
+        while len(self._runners) < self.workers:
+            self._runners.append(asyncio.create_task(self._run()))
+
+    def submit(self, method, droppable=False):
+        if self._closing:
+            raise RuntimeError("Outbox is closed")
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_error)
+        chat_id = method.chat_id
+        jobs = self._chats.get(chat_id)
+        if jobs is None:
+            jobs = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        jobs.append(_Job(method, future, droppable))
+        self._ensure_running()
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(SendMessage(chat_id=chat_id, text=text, **kwargs))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(EditMessageText(text=text, chat_id=chat_id, message_id=message_id, **kwargs))
+
+    def send_chat_action(self, chat_id, action):
+        """
+        "Печатает..." — только если в чат ничего не отправляется; при нехватке лимита пропускается.
+        """
+        if chat_id in self._chats:
+            return None
+        return self.submit(SendChatAction(chat_id=chat_id, action=action), droppable=True)
+
+    def _requeue_later(self, chat_id, delay):
+        asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+
+    async def _run(self):
+        while True:
+            chat_id = await self._ready.get()
+            jobs = self._chats[chat_id]
+            job = jobs[0]
+            bucket = self._bucket(chat_id)
+
+            if job.future.cancelled():
+                jobs.popleft()  # Ответ уже никому не нужен
+            elif job.droppable and bucket.delay():
+                jobs.popleft()
+                job.future.set_result(None)
+                metrics.inc('telegram_outbox', result='dropped')
+            elif not job.droppable and not bucket.try_acquire():
+                # Чат отдыхает, поток тем временем отправляет в другие чаты
+                self._requeue_later(chat_id, bucket.delay())
+                continue
+            else:
+                # Chat action не расходует лимит сообщений чата, только общий
+                await self._global.acquire()
+                try:
+                    result = await self.bot(job.method)
+                except TelegramRetryAfter as e:
+                    metrics.inc('telegram_outbox', result='retry_after')
+                    logging.warning(f"Telegram flood control for chat {chat_id}: retry in {e.retry_after} s")
+                    bucket.pause(e.retry_after)
+                    self._requeue_later(chat_id, e.retry_after)
+                    continue
+                except Exception as e:
+                    jobs.popleft()
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    metrics.inc('telegram_outbox', result='error')
+                else:
+                    jobs.popleft()
+                    if not job.future.done():
+                        job.future.set_result(result)
+                    metrics.inc('telegram_outbox', result='sent')
+
+            if jobs:
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._chats[chat_id]
+
+    async def close(self, timeout):
+        """
+        Перестает принимать сообщения и ждет отправки очереди, не дольше timeout секунд.
+        """
+        self._closing = True
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._chats and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._chats:
+            logging.warning(f"Dropped {len(self)} unsent Telegram messages")
+        for task in self._runners:
+            task.cancel()
+        for jobs in self._chats.values():
+            for job in jobs:
+                job.future.cancel()
+        self._chats.clear()
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+
+from django.db import DataError, IntegrityError, transaction
+from django.db.models import Max
+
+from chatbot.db import database_sync_to_async
+from chatbot.metrics import metrics
+from chatbot.models import FAQLearning, UserQuery
+from chatbot.throttling import backoff_delay
+
+# Отложенная (write-behind) запись истории: обработчик кладет запись в очередь и сразу
+# отвечает пользователю, а фоновая задача пишет накопленное пачками через bulk_create.
+# Потерять при падении процесса можно только то, что еще не записано: не больше
+# max_pending записей за последние flush_interval секунд.
+
+_STOP = object()
+# Пачку с такими ошибками база не примет и при повторе: ищем в ней неверные записи
+DATA_ERRORS = (IntegrityError, DataError)
+# Пока база недоступна, пачка повторяется с растущей паузой (не дольше FLUSH_MAX_DELAY секунд),
+# а новые записи ждут в очереди. При остановке делается не больше FLUSH_ATTEMPTS попыток
+FLUSH_ATTEMPTS = 3
+FLUSH_MAX_DELAY = 30
+
+
+class WriteBehindQueue:
+    """
+    Очередь записей UserQuery и FAQLearning. Пачка пишется, когда набралось max_batch записей
+    или прошло flush_interval секунд. Если очередь заполнена, добавление ждет (back-pressure).
+    """
+
+    def __init__(self, max_batch, flush_interval, max_pending, conversations):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = asyncio.Queue(maxsize=max_pending)
+        # Последний запрос пользователя (ConversationCache) — родитель для следующего, без чтения из базы
+        self.conversations = conversations
+        self._runner = None
+        self._closing = False
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def _ensure_running(self):
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def add_query(self, user_id, **fields):
+        user_id = str(user_id)
+        parent, known = self.conversations.last(user_id)
+        user_query = UserQuery(user_id=user_id, parent=parent, **fields)
+        validate(user_query)
+        # Пользователя еще не видели в этом процессе: родителя найдем при записи пачки
+        user_query._resolve_parent = not known
+        self.conversations.append(user_id, user_query)
+        await self._put(user_query)
+        return user_query
+
+    async def add_learning(self, question, answer):
+        learning = FAQLearning(question=question, answer=answer)
+        validate(learning)
+        await self._put(learning)
+
+    async def _put(self, record):
+        self._ensure_running()
+        await self._queue.put(record)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is _STOP:
+                break
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                batch.append(record)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        dropped = await self._write(batch)
+        if dropped:
+            metrics.inc('history_dropped', dropped)
+            logging.error(f"Dropped {dropped} of {len(batch)} records")
+
+    async def _write(self, batch):
+        """
+        Пишет пачку, возвращает число отброшенных записей. Если база отвергает пачку,
+        делит ее пополам и отбрасывает только записи, которые не пишутся. Порядок сохраняется,
+        поэтому родитель пишется раньше ответов на него.
+        """
+        attempt = 0
+        while True:
+            try:
+                with metrics.span('history_flush'):
+                    await write_records(batch)
+                return 0
+            except DATA_ERRORS as e:
+                if len(batch) == 1:
+                    logging.error(f"Dropped record {batch[0]!r}: {e}")
+                    return 1
+                break
+            except Exception as e:
+                # Соединение с базой (OperationalError, InterfaceError): записи не виноваты, ждем базу
+                attempt += 1
+                logging.error(f"Error while writing {len(batch)} records (attempt {attempt}): {e}")
+                if self._closing and attempt >= FLUSH_ATTEMPTS:
+                    return len(batch)
+                await asyncio.sleep(backoff_delay(attempt, 1, FLUSH_MAX_DELAY))
+        middle = len(batch) // 2
+        return await self._write(batch[:middle]) + await self._write(batch[middle:])
+
+    async def close(self):
+        """
+        Дописывает все, что есть в очереди, и останавливает фоновую задачу.
+        """
+        self._closing = True
+        if self._runner is None or self._runner.done():
+            if self._queue.empty():
+                return
+            self._ensure_running()
+        await self._queue.put(_STOP)
+        await self._runner
+        # Записи, добавленные во время остановки
+        rest = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not _STOP:
+                rest.append(record)
+        if rest:
+            await self._flush(rest)
+
+
+def validate(record):
+    """
+    Проверяет поля записи до постановки в очередь (ValidationError), чтобы одна неверная запись
+    не срывала запись пачки. Внешние ключи не проверяются: это запросы к базе.
+    """
+    record.clean_fields(exclude=[field.name for field in record._meta.fields if field.is_relation])
+
+
+@database_sync_to_async
+def write_records(batch):
+    queries = [record for record in batch if isinstance(record, UserQuery) and record.pk is None]
+    learnings = [record for record in batch if isinstance(record, FAQLearning) and record.pk is None]
+
+    try:
+        _write_batch(queries, learnings)
+    except Exception:
+        # Транзакция откатилась: id, выданные bulk_create, недействительны для повторной попытки
+        for record in queries + learnings:
+            record.pk = None
+        raise
+
+    # Не держим в памяти цепочку объектов-родителей, достаточно parent_id
+    parent_field = _parent_field()
+    for user_query in queries:
+        if parent_field.is_cached(user_query):
+            parent_field.delete_cached_value(user_query)
+
+
+def _parent_field():
+    return UserQuery._meta.get_field('parent')
+
+
+def parent_of(user_query):
+    # Только объект, привязанный в памяти; по parent_id в базу не ходим
+    return _parent_field().get_cached_value(user_query, default=None)
+
+
+def _write_batch(queries, learnings):
+    with transaction.atomic():
+        resolve_parents(queries)
+        # Родитель может быть в этой же пачке: пишем "поколениями", чтобы у него уже был id
+        pending = queries
+        while pending:
+            ready = [q for q in pending if parent_of(q) is None or parent_of(q).pk is not None]
+            if not ready:
+                # Родитель так и не был записан (пачка отброшена) — сохраняем без ссылки
+                ready = pending
+                for user_query in ready:
+                    user_query.parent = None
+            for user_query in ready:
+                if parent_of(user_query) is not None:
+                    user_query.parent_id = parent_of(user_query).pk
+            UserQuery.objects.bulk_create(ready)
+            pending = [q for q in pending if q.pk is None]
+        if learnings:
+            FAQLearning.objects.bulk_create(learnings)
+
+
+def resolve_parents(queries):
+    """
+    Для первых запросов пользователей, которых процесс еще не видел, находит последний
+    сохраненный запрос — одним запросом на всю пачку.
+    """
+    unresolved = [q for q in queries if getattr(q, '_resolve_parent', False)]
+    if not unresolved:
+        return
+    latest = dict(
+        UserQuery.objects.filter(user_id__in={q.user_id for q in unresolved})
+        .values('user_id').annotate(last_id=Max('id')).values_list('user_id', 'last_id')
+    )
+    for user_query in unresolved:
+        user_query.parent_id = latest.get(user_query.user_id)
+        user_query._resolve_parent = False
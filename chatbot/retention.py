@@ -0,0 +1,85 @@
+from django.db import connection, transaction
+from django.db.models import Value
+from django.utils import timezone
+
+from chatbot.models import UserQuery, UserQueryArchive
+
+# Перенос старых запросов из UserQuery в архив и очистка архива.
+# Работает пачками по id в отдельных транзакциях: блокировки короткие, а бот
+# продолжает писать историю, пока идет перенос.
+
+ARCHIVE_FIELDS = (
+    'id', 'user_id', 'query', 'response', 'faq_match_id', 'parent_id', 'created_at', 'escalated_to_human',
+)
+
+
+def _copy_to_archive(ids):
+    # INSERT ... SELECT: строки копируются внутри базы, без загрузки в Python
+    select = (
+        UserQuery.objects.filter(id__in=ids)
+        .annotate(archived_at=Value(timezone.now()))
+        .values_list(*ARCHIVE_FIELDS, 'archived_at')
+    )
+    sql, params = select.query.sql_with_params()
+    columns = ', '.join(
+        connection.ops.quote_name(UserQueryArchive._meta.get_field(name).column)
+        for name in (*ARCHIVE_FIELDS, 'archived_at')
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {connection.ops.quote_name(UserQueryArchive._meta.db_table)} ({columns}) {sql}', params,
+        )
+
+
+def _delete_queries(ids):
+    # Явный DELETE по id вместо .delete(): сборщик связей Django выбрал бы строки и
+    # отдельно обнулил бы parent у children. Здесь это уже сделано одним UPDATE, других
+    # ссылок на UserQuery и сигналов удаления нет
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {connection.ops.quote_name(UserQuery._meta.db_table)} WHERE id IN ({placeholders})', ids,
+        )
+
+
+def _oldest_ids(queryset, cutoff, batch_size):
+    # id растут вместе с created_at, поэтому старые строки — в начале первичного ключа
+    return list(
+        queryset.filter(created_at__lt=cutoff).order_by('id').values_list('id', flat=True)[:batch_size]
+    )
+
+
+def archive_queries(cutoff, batch_size, archive=True):
+    """
+    Переносит запросы старше cutoff в UserQueryArchive (или просто удаляет при archive=False).
+    Генератор: после каждой пачки отдает число перенесенных строк.
+    """
+    while True:
+        with transaction.atomic():
+            ids = _oldest_ids(UserQuery.objects, cutoff, batch_size)
+            if not ids:
+                return
+            if archive:
+                _copy_to_archive(ids)
+            # Обрываем цепочки одним UPDATE: более новые запросы перестают ссылаться на удаляемые.
+            # В архиве parent_id остается, и диалог можно восстановить целиком
+            UserQuery.objects.filter(parent_id__in=ids).exclude(id__in=ids).update(parent=None)
+            _delete_queries(ids)
+        yield len(ids)
+        if len(ids) < batch_size:
+            return
+
+
+def purge_archive(cutoff, batch_size):
+    """
+    Удаляет из архива запросы старше cutoff. Генератор, как archive_queries.
+    """
+    while True:
+        ids = _oldest_ids(UserQueryArchive.objects, cutoff, batch_size)
+        if not ids:
+            return
+        # У архива нет связей и сигналов: .delete() сводится к одному DELETE
+        UserQueryArchive.objects.filter(id__in=ids).delete()
+        yield len(ids)
+        if len(ids) < batch_size:
+            return
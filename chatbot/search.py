@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import math
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import BooleanField, Case, Count, F, Max, Q, Value, When
+from django.db.models.functions import Upper
+
+from chatbot.db import database_sync_to_async
+from chatbot.metrics import metrics
+from chatbot.models import FAQ, SEARCH_CONFIG
+from chatbot.text import normalize_text, query_key, stems, tokenize, word_spans
+
+# Вопрос из FAQ в том виде, в котором он хранится в индексе
+FAQEntry = namedtuple('FAQEntry', ['id', 'question', 'answer'])
+
+# Результат поиска: точное совпадение или (если его нет) список похожих вопросов
+FAQSearchResult = namedtuple('FAQSearchResult', ['exact', 'candidates'])
+
+# Вес совпадения в вопросе и в ответе при ранжировании
+QUESTION_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.3
+
+
+class FAQIndex:
+    """
+    Неизменяемый индекс FAQ в памяти процесса: ответы по id и по нормализованному вопросу,
+    инвертированный индекс по основам слов для ранжированного поиска, по целым словам для поиска подстроки
+    и по триграммам для поиска с опечатками.
+    """
+
+    def __init__(self, entries, fingerprint=None, version=0, vectors=None):
+        self.fingerprint = fingerprint
+        self.version = version
+        self.entries = {entry.id: entry for entry in entries}
+        self.vectors = vectors  # VectorIndex из chatbot.embeddings для семантического поиска
+
+        self._questions = {}                  # id -> нормализованный вопрос
+        self._by_key = {}                     # query_key вопроса -> вопрос с наименьшим id
+        self._words = defaultdict(set)        # слово вопроса -> ids
+        self._postings = defaultdict(dict)    # основа -> {id: вес}
+
+        for entry in self.entries.values():
+            question = normalize_text(entry.question)
+            self._questions[entry.id] = question
+            self._by_key.setdefault(query_key(question), entry)
+            for word in tokenize(question):
+                self._words[word].add(entry.id)
+            for word_stem in stems(normalize_text(entry.answer)):
+                self._postings[word_stem][entry.id] = ANSWER_WEIGHT
+            for word_stem in stems(question):
+                self._postings[word_stem][entry.id] = QUESTION_WEIGHT
+
+        total = len(self.entries)
+        self._idf = {
+            word_stem: math.log(1 + total / len(ids))
+            for word_stem, ids in self._postings.items()
+        }
+        # Слова, которых нет в индексе, считаем самыми редкими
+        self._unknown_idf = math.log(1 + total) if total else 1.0
+
+        from chatbot.fuzzy import TrigramIndex  # numpy нужен только процессу бота
+
+        self._trigrams = TrigramIndex(list(self._questions), list(self._questions.values()))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, faq_id):
+        return self.entries.get(faq_id)
+
+    def by_question(self, query):
+        """
+        Вопрос, совпадающий с запросом с точностью до регистра, пробелов и знаков препинания.
+        """
+        return self._by_key.get(query_key(query))
+
+    def exact(self, query):
+        """
+        Аналог question__icontains=query: первый вопрос, содержащий запрос целиком.
+        """
+        query = normalize_text(query)
+        if not query:
+            return None
+
+        # Слова внутри запроса обязаны встречаться в вопросе целиком,
+        # крайние могут быть обрезаны, поэтому по ним не фильтруем
+        candidates = None
+        for match in word_spans(query):
+            if match.start() == 0 or match.end() == len(query):
+                continue
+            ids = self._words.get(match.group(), set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return None
+
+        ids = sorted(candidates) if candidates is not None else self._questions
+        for faq_id in ids:
+            if query in self._questions[faq_id]:
+                return self.entries[faq_id]
+        return None
+
+    def ranked(self, query, min_score=0.0, limit=None):
+        """
+        Похожие вопросы, отсортированные по убыванию релевантности.
+        Оценка — доля "веса" слов запроса (по idf), найденных в вопросе или ответе.
+        """
+        query_stems = set(stems(normalize_text(query)))
+        if not query_stems:
+            return []
+
+        total = sum(self._idf.get(word_stem, self._unknown_idf) for word_stem in query_stems)
+        scores = defaultdict(float)
+        for word_stem in query_stems:
+            postings = self._postings.get(word_stem)
+            if not postings:
+                continue
+            idf = self._idf[word_stem]
+            for faq_id, weight in postings.items():
+                scores[faq_id] += idf * weight
+
+        ranked = sorted(
+            ((score / total, faq_id) for faq_id, score in scores.items() if score / total >= min_score),
+            key=lambda item: (-item[0], item[1]),
+        )
+        if limit is not None:
+            ranked = ranked[:limit]
+        return [self.entries[faq_id] for _, faq_id in ranked]
+
+    def fuzzy(self, query, min_score=0.0, limit=None):
+        """
+        Пары (вопрос, близость по триграммам) — аналог pg_trgm similarity(question, query).
+        """
+        matches = self._trigrams.top_k(query, limit or len(self), min_score=min_score)
+        return [(self.entries[faq_id], score) for faq_id, score in matches]
+
+    def semantic(self, vector, min_score=0.0, limit=None):
+        """
+        Пары (вопрос, близость) по эмбеддингу запроса.
+        """
+        if self.vectors is None:
+            return []
+        matches = self.vectors.top_k(vector, limit or len(self.vectors), min_score=min_score)
+        return [(self.entries[faq_id], score) for faq_id, score in matches if faq_id in self.entries]
+
+    def search(self, query, min_score=0.0, limit=None, fuzzy_exact_score=None, fuzzy_min_score=0.0):
+        """
+        Точное совпадение, затем почти тот же вопрос (близость по триграммам не ниже
+        fuzzy_exact_score), затем похожие вопросы. Менее близкие по триграммам вопросы
+        только добавляются в варианты: "тариф 5000" не должен получить ответ про "Тариф 500".
+        """
+        exact = self.by_question(query) or self.exact(query)
+        if exact is not None:
+            return FAQSearchResult(exact, [])
+
+        matches = []
+        if fuzzy_exact_score:
+            matches = self.fuzzy(query, min_score=fuzzy_min_score, limit=limit)
+            if matches and matches[0][1] >= fuzzy_exact_score:
+                return FAQSearchResult(matches[0][0], [])
+
+        candidates = self.ranked(query, min_score=min_score, limit=limit)
+        # Слова с опечатками не совпадают по основам — такие вопросы находятся только по триграммам
+        seen = {entry.id for entry in candidates}
+        candidates += [entry for entry, _ in matches if entry.id not in seen]
+        if limit is not None:
+            candidates = candidates[:limit]
+        return FAQSearchResult(None, candidates)
+
+
+# Текущий индекс процесса и счетчик изменений FAQ.
+# Счетчик увеличивается сигналами моделей (см. chatbot/signals.py) и
+# фоновой проверкой изменений, сделанных в других процессах.
+_index = None
+_version = 0
+_rebuild_lock = asyncio.Lock()
+
+
+def faq_changed(**kwargs):
+    global _version
+    _version += 1
+
+
+def _fingerprint():
+    stats = FAQ.objects.aggregate(count=Count('id'), updated_at=Max('updated_at'))
+    return stats['count'], stats['updated_at']
+
+
+@database_sync_to_async
+def _load_entries():
+    # Отпечаток читаем до данных: если FAQ изменится между запросами,
+    # следующая проверка увидит расхождение и перестроит индекс
+    fingerprint = _fingerprint()
+    entries = [
+        FAQEntry(*row)
+        for row in FAQ.objects.order_by('id').values_list('id', 'question', 'answer')
+    ]
+    return fingerprint, entries
+
+
+def _build_index(entries, fingerprint, version):
+    vectors = None
+    if settings.FAQ_SEARCH_MODE != 'lexical':
+        from chatbot.embeddings import load_or_build_vectors
+        vectors = load_or_build_vectors(entries)
+    return FAQIndex(entries, fingerprint=fingerprint, version=version, vectors=vectors)
+
+
+async def _load_index(version):
+    fingerprint, entries = await _load_entries()
+    # Эмбеддинги новых вопросов могут считаться по сети: строим индекс вне пула базы,
+    # чтобы не держать его потоки и соединения
+    return await asyncio.to_thread(_build_index, entries, fingerprint, version)
+
+
+async def rebuild_faq_index():
+    global _index
+    async with _rebuild_lock:
+        version = _version
+        if _index is None or _index.version != version:
+            with metrics.span('faq_index_rebuild'):
+                _index = await _load_index(version)
+            logging.info(f"FAQ index built: {len(_index)} entries")
+    return _index
+
+
+async def get_faq_index():
+    """
+    Актуальный индекс FAQ. Обращается к базе только если FAQ изменились.
+    """
+    index = _index
+    if index is None or index.version != _version:
+        index = await rebuild_faq_index()
+    return index
+
+
+async def watch_faq_changes(interval):
+    """
+    Периодически сверяет отпечаток таблицы FAQ, чтобы подхватить правки из других процессов (админка).
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            fingerprint = await database_sync_to_async(_fingerprint)()
+            if _index is None or fingerprint != _index.fingerprint:
+                faq_changed()
+                await rebuild_faq_index()
+        except Exception as e:
+            logging.error(f"Error while refreshing FAQ index: {e}")
+
+
+@database_sync_to_async
+def _load_entry(faq_id):
+    row = FAQ.objects.filter(id=faq_id).values_list('id', 'question', 'answer').first()
+    return FAQEntry(*row) if row else None
+
+
+async def get_faq_entry(faq_id):
+    """
+    Вопрос FAQ по id (кнопки выбора варианта): из индекса, без запроса к базе.
+    """
+    if not settings.FAQ_INDEX_ENABLED:
+        return await _load_entry(faq_id)
+    index = await get_faq_index()
+    return index.get(faq_id)
+
+
+@database_sync_to_async
+def search_faq_in_database(query, limit):
+    """
+    Тот же поиск одним запросом к PostgreSQL: совпадение подстроки в вопросе,
+    полнотекстовый поиск по search_vector либо близость по триграммам, точные совпадения первыми.
+    Все три условия обслуживаются GIN-индексами (миграции 0004 и 0008).
+    """
+    try:
+        search_query = SearchQuery(query, config=SEARCH_CONFIG)
+        # icontains в PostgreSQL сравнивает UPPER(question), по этому же выражению
+        # построен триграммный индекс, поэтому и оператор % применяем к нему
+        condition = Q(question__icontains=query) | Q(search_vector=search_query)
+        is_exact = Q(question__icontains=query)
+        matches = Q(is_exact=True) | Q(rank__gte=0.1)
+        similarity = Value(0.0)
+        if settings.FAQ_FUZZY_ENABLED:
+            condition |= Q(question_upper__trigram_similar=query.upper())
+            similarity = TrigramSimilarity(Upper('question'), query.upper())
+            is_exact |= Q(similarity__gte=settings.FAQ_FUZZY_EXACT_SCORE)
+            matches |= Q(similarity__gte=settings.FAQ_FUZZY_MIN_SCORE)
+        faqs = list(
+            FAQ.objects.alias(question_upper=Upper('question'))
+            .filter(condition)
+            .annotate(similarity=similarity, rank=SearchRank(F('search_vector'), search_query))
+            .annotate(is_exact=Case(When(is_exact, then=True), default=False, output_field=BooleanField()))
+            .filter(matches)
+            .defer('search_vector')
+            .order_by('-is_exact', '-similarity', '-rank', 'id')[:limit]
+        )
+    except Exception as e:
+        logging.error(f"Error while searching FAQ: {e}")
+        return FAQSearchResult(None, [])
+
+    if faqs and faqs[0].is_exact:
+        return FAQSearchResult(faqs[0], [])
+    return FAQSearchResult(None, faqs)
+
+
+async def search_faq(query, limit=None):
+    """
+    Единая точка поиска по FAQ: одно обращение к индексу (или к базе, если индекс выключен).
+    """
+    limit = limit or settings.FAQ_SEARCH_LIMIT
+    if not settings.FAQ_INDEX_ENABLED:
+        return await search_faq_in_database(query, limit)
+    index = await get_faq_index()
+    result = index.search(
+        query,
+        min_score=settings.FAQ_INDEX_MIN_SCORE,
+        limit=limit,
+        fuzzy_exact_score=settings.FAQ_FUZZY_EXACT_SCORE if settings.FAQ_FUZZY_ENABLED else None,
+        fuzzy_min_score=settings.FAQ_FUZZY_MIN_SCORE,
+    )
+    if result.exact or index.vectors is None:
+        return result
+    # В гибридном режиме эмбеддинги нужны только когда по словам ничего не нашлось
+    if settings.FAQ_SEARCH_MODE == 'hybrid' and result.candidates:
+        return result
+    try:
+        return await search_faq_semantic(index, query, limit)
+    except Exception as e:
+        logging.error(f"Error while searching FAQ by embeddings: {e}")
+        return result
+
+
+async def search_faq_semantic(index, query, limit):
+    from chatbot.embeddings import get_embedder
+
+    embedder = get_embedder()
+    if embedder.blocking:
+        # Модель или сеть: не останавливаем обработку остальных сообщений
+        vector = (await asyncio.to_thread(embedder.embed, [query]))[0]
+    else:
+        vector = embedder.embed([query])[0]
+
+    matches = index.semantic(vector, min_score=settings.FAQ_SEMANTIC_MIN_SCORE, limit=limit)
+    # Очень близкий по смыслу вопрос считаем точным совпадением
+    if matches and matches[0][1] >= settings.FAQ_SEMANTIC_EXACT_SCORE:
+        return FAQSearchResult(matches[0][0], [])
+    return FAQSearchResult(None, [entry for entry, _ in matches])
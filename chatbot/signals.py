@@ -0,0 +1,12 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chatbot.models import FAQ
+from chatbot.search import faq_changed
+
+
+# Любое изменение FAQ в этом процессе сразу помечает индекс поиска устаревшим
+@receiver(post_save, sender=FAQ)
+@receiver(post_delete, sender=FAQ)
+def invalidate_faq_index(sender, **kwargs):
+    faq_changed()
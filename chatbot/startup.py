@@ -0,0 +1,52 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from chatbot.metrics import metrics
+
+# Запуск бота по этапам: клиенты Telegram и OpenAI, соединения с базой, данные FAQ, HTTP-пулы.
+# Обновления принимаются только после всех этапов; время каждого этапа пишется в лог
+# и в метрики (этап startup.<имя>), а готовность процесса отдается на /ready.
+# Модуль легкий: его импортируют views при старте Django.
+
+_ready = False
+
+
+def is_ready():
+    return _ready
+
+
+def set_ready(value=True):
+    global _ready
+    _ready = value
+
+
+metrics.gauge('ready', lambda: int(_ready))
+
+
+class StartupTimer:
+    """
+    Время этапов запуска. Этапы могут выполняться параллельно, у каждого свое время.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases.append((name, elapsed))
+            metrics.observe(f'startup.{name}', elapsed)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def report(self):
+        phases = ', '.join(f"{name} {elapsed:.2f} s" for name, elapsed in self.phases)
+        logging.info(f"Bot started in {self.elapsed:.2f} s ({phases})")
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from datetime import timedelta
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage
+from django.conf import settings
+from django.utils import timezone
+
+from chatbot.db import database_sync_to_async
+from chatbot.models import FSMRecord
+
+# Хранилища состояний FSM для aiogram.
+# В отличие от MemoryStorage состояния переживают рестарт и видны всем процессам бота,
+# устаревшие записи (старше FSM_STATE_TTL) не возвращаются и периодически удаляются.
+
+# Сколько SQLiteStorage ждет файл, заблокированный другим процессом (с), и начальная пауза между попытками
+SQLITE_LOCK_TIMEOUT = 5
+SQLITE_RETRY_DELAY = 0.001
+
+
+def resolve_state(state):
+    if state is None:
+        return None
+    if isinstance(state, State):
+        return state.state
+    return str(state)
+
+
+class DatabaseStorage(BaseStorage):
+    """
+    Состояния в основной базе Django (таблица FSMRecord, данные в jsonb).
+    Обычная запись — один UPDATE, для новых или устаревших ключей — один upsert.
+    """
+
+    def __init__(self, ttl, key_builder=None):
+        self.ttl = timedelta(seconds=ttl)
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    @database_sync_to_async
+    def _write(self, key, **fields):
+        now = timezone.now()
+        record_key = self.key_builder.build(key)
+        fields['expires_at'] = now + self.ttl
+        updated = FSMRecord.objects.filter(key=record_key, expires_at__gt=now).update(**fields)
+        if not updated:
+            # Ключа нет или он устарел: старые данные не должны "воскреснуть"
+            record = FSMRecord(key=record_key, **{'state': None, 'data': {}, **fields})
+            FSMRecord.objects.bulk_create(
+                [record], update_conflicts=True, unique_fields=['key'],
+                update_fields=['state', 'data', 'expires_at'],
+            )
+
+    @database_sync_to_async
+    def _read(self, key, field):
+        return FSMRecord.objects.filter(
+            key=self.key_builder.build(key), expires_at__gt=timezone.now()
+        ).values_list(field, flat=True).first()
+
+    async def set_state(self, key, state=None):
+        await self._write(key, state=resolve_state(state))
+
+    async def get_state(self, key):
+        return await self._read(key, 'state')
+
+    async def set_data(self, key, data):
+        await self._write(key, data=data)
+
+    async def get_data(self, key):
+        data = await self._read(key, 'data')
+        return dict(data) if data else {}
+
+    @database_sync_to_async
+    def purge_expired(self):
+        deleted, _ = FSMRecord.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+    async def close(self):
+        pass
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Быстрое локальное хранилище в файле SQLite (WAL). Подходит для нескольких процессов
+    на одной машине; запросы выполняются за микросекунды, поэтому прямо в event loop.
+    SQLite не ждет блокировку сам (timeout=0): занятый другим процессом файл ждем
+    асинхронными повторами, не останавливая остальные обработчики.
+    """
+
+    def __init__(self, path, ttl, key_builder=None):
+        self.path = path
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, timeout=0, isolation_level=None)
+            try:
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS fsm ('
+                    'key TEXT PRIMARY KEY, state TEXT, data TEXT NOT NULL, expires_at REAL NOT NULL)'
+                )
+                connection.execute('CREATE INDEX IF NOT EXISTS fsm_expires_at ON fsm (expires_at)')
+            except sqlite3.Error:
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    async def _execute(self, sql, params, fetch=False):
+        delay = SQLITE_RETRY_DELAY
+        deadline = time.monotonic() + SQLITE_LOCK_TIMEOUT
+        while True:
+            try:
+                cursor = self.connection.execute(sql, params)
+                return cursor.fetchone() if fetch else cursor
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or time.monotonic() >= deadline:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    async def _read(self, key, field):
+        row = await self._execute(
+            f'SELECT {field} FROM fsm WHERE key = ? AND expires_at > ?',
+            (self.key_builder.build(key), time.time()),
+            fetch=True,
+        )
+        return row[0] if row else None
+
+    async def set_state(self, key, state=None):
+        now = time.time()
+        await self._execute(
+            'INSERT INTO fsm (key, state, data, expires_at) VALUES (?, ?, \'{}\', ?) '
+            'ON CONFLICT (key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at, '
+            'data = CASE WHEN fsm.expires_at > ? THEN fsm.data ELSE \'{}\' END',
+            (self.key_builder.build(key), resolve_state(state), now + self.ttl, now),
+        )
+
+    async def get_state(self, key):
+        return await self._read(key, 'state')
+
+    async def set_data(self, key, data):
+        now = time.time()
+        await self._execute(
+            'INSERT INTO fsm (key, state, data, expires_at) VALUES (?, NULL, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at, '
+            'state = CASE WHEN fsm.expires_at > ? THEN fsm.state ELSE NULL END',
+            (self.key_builder.build(key), json.dumps(data, ensure_ascii=False, separators=(',', ':')),
+             now + self.ttl, now),
+        )
+
+    async def get_data(self, key):
+        data = await self._read(key, 'data')
+        return json.loads(data) if data else {}
+
+    async def purge_expired(self):
+        cursor = await self._execute('DELETE FROM fsm WHERE expires_at <= ?', (time.time(),))
+        return cursor.rowcount
+
+    async def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def create_storage():
+    """
+    Хранилище FSM из настройки FSM_STORAGE: memory, database или sqlite.
+    """
+    backend = settings.FSM_STORAGE
+    if backend == 'database':
+        return DatabaseStorage(ttl=settings.FSM_STATE_TTL)
+    if backend == 'sqlite':
+        return SQLiteStorage(settings.FSM_SQLITE_PATH, ttl=settings.FSM_STATE_TTL)
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f"Unknown FSM_STORAGE: {backend}")
+
+
+async def purge_expired_states(storage, interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            deleted = await storage.purge_expired()
+            if deleted:
+                logging.info(f"Purged {deleted} expired FSM states")
+        except Exception as e:
+            logging.error(f"Error while purging FSM states: {e}")
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Признак того, что ответ еще дописывается
+CURSOR = ' ▌'
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    return [text[i:i + limit] for i in range(0, len(text), limit)] or ['']
+
+
+class StreamingReply:
+    """
+    Показывает ответ по мере генерации: первое сообщение отправляется по первым токенам,
+    дальше оно редактируется не чаще раза в interval секунд, в конце — финальная правка.
+    update() не ждет сети, поэтому не тормозит чтение потока от OpenAI.
+    """
+
+    def __init__(self, bot, chat_id, interval=1.0):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message = None
+        self.started = asyncio.Event()  # пришли первые токены
+
+        self._text = ''
+        self._shown = ''
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._next_edit_at = 0.0
+        self._task = None
+
+    def update(self, text):
+        if not text.strip() or self._finished.is_set():
+            return
+        self._text = text
+        self._changed.set()
+        self.started.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while not self._finished.is_set():
+            await self._changed.wait()
+            self._changed.clear()
+
+            delay = self._next_edit_at - time.monotonic()
+            if delay > 0:
+                await self._wait_finished(delay)
+            if self._finished.is_set():
+                return
+
+            try:
+                await self._show(self._text[:MESSAGE_LIMIT - len(CURSOR)].rstrip() + CURSOR)
+            except TelegramRetryAfter:
+                self._changed.set()
+                continue
+            self._next_edit_at = time.monotonic() + self.interval
+
+    async def _wait_finished(self, timeout):
+        try:
+            await asyncio.wait_for(self._finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _show(self, text):
+        if text == self._shown:
+            return
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(self.chat_id, text)
+            else:
+                await self.bot.edit_message_text(
+                    text=text, chat_id=self.chat_id, message_id=self.message.message_id
+                )
+            self._shown = text
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать — пропускаем промежуточные правки до этого момента
+            self._next_edit_at = time.monotonic() + e.retry_after
+            raise
+        except TelegramBadRequest as e:
+            if 'message is not modified' not in str(e):
+                raise
+
+    async def finish(self, text):
+        """
+        Финальный текст ответа. Если потока не было (ответ из кэша), просто отправляет сообщение.
+        """
+        await self._stop()
+        parts = split_text(text)
+        for attempt in range(2):
+            try:
+                await self._show(parts[0])
+                break
+            except TelegramRetryAfter as e:
+                if attempt:
+                    raise
+                await asyncio.sleep(e.retry_after)
+        for part in parts[1:]:
+            await self.bot.send_message(self.chat_id, part)
+        return self.message
+
+    async def abort(self):
+        await self._stop()
+
+    async def _stop(self):
+        self._finished.set()
+        self._changed.set()
+        if self._task is not None:
+            try:
+                await self._task
+            except Exception as e:
+                logging.error(f"Error while streaming reply: {e}")
@@ -1,3 +1,971 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import openai
+from aiogram import Bot, Dispatcher
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+from aiogram.types import Update
+from aiohttp import ClientSession, web
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, InterfaceError, OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from chatbot import importing, search, webhook
+from chatbot.benchmark import FakeServices, make_queries, make_update, percentile, run_load
+from chatbot.cache import SingleFlight, TTLCache
+from chatbot.context import OFF_TOPIC_ANSWER, RollingSummary
+from chatbot.conversations import ConversationCache
+from chatbot.embeddings import HashingEmbedder, VectorIndex, load_or_build_vectors
+from chatbot.llm import LLMClient
+from chatbot.models import EMPTY_ANSWER, ERROR_ANSWER_PREFIX, FAQ, FAQLearning, FSMRecord, UserQuery, UserQueryArchive
+from chatbot.outbox import Outbox
+from chatbot.persistence import FLUSH_ATTEMPTS, WriteBehindQueue, write_records
+from chatbot.retention import archive_queries, purge_archive
+from chatbot.search import FAQEntry, FAQIndex, FAQSearchResult, search_faq_in_database
+from chatbot.storage import DatabaseStorage, SQLiteStorage
+from chatbot.streaming import StreamingReply
+from chatbot.throttling import TokenBucket
+from chatbot.webhook import WebhookDispatcher
+
+# Большинство тестов без базы данных (SimpleTestCase): запись в базу подменяется, внешние API
+# изображает FakeServices из нагрузочного стенда. Запросы к базе проверяют TestCase (нужен PostgreSQL,
+# как и миграциям); функции, которые бот выполняет в пуле chatbot.db, вызываются напрямую через __wrapped__,
+# чтобы запросы шли в транзакции теста.
+
+
+class BenchmarkHarnessTests(SimpleTestCase):
+    def test_query_mix_is_reproducible(self):
+        questions = ['Как пополнить баланс карты?', 'Где скачать приложение?']
+        queries = make_queries(questions, 200, faq_ratio=0.5, llm_ratio=0.2)
+        self.assertEqual(queries, make_queries(questions, 200, faq_ratio=0.5, llm_ratio=0.2))
+        exact = sum(query in questions for query in queries)
+        llm = sum(query.startswith('Расскажите подробнее') for query in queries)
+        self.assertAlmostEqual(exact / 200, 0.5, delta=0.1)
+        self.assertAlmostEqual(llm / 200, 0.2, delta=0.1)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.5), 0.0)
+        self.assertEqual(percentile(list(range(100, 0, -1)), 0.95), 96)
+
+    async def test_run_load_feeds_every_update(self):
+        fed = []
+
+        class Dispatcher:
+            async def feed_update(self, bot, update):
+                fed.append(update.message.from_user.id)
+                if update.update_id == 3:
+                    raise RuntimeError('handler failed')
+
+        latencies, errors, _ = await run_load(Dispatcher(), None, ['вопрос'] * 10, users=4, rate=0, concurrency=3)
+        self.assertEqual((len(latencies), errors), (10, 1))
+        self.assertEqual(sorted(set(fed)), [1000, 1001, 1002, 1003])
+
+    async def test_fake_services(self):
+        services = FakeServices(openai_chunks=2)
+        url = await services.start()
+        try:
+            async with ClientSession() as session:
+                async with session.post(f'{url}/bottest/sendMessage', data={'chat_id': 5, 'text': 'ответ'}) as response:
+                    message = (await response.json())['result']
+                async with session.post(f'{url}/v1/chat/completions', json={'messages': [{'content': 'вопрос'}]}) as response:
+                    body = await response.text()
+        finally:
+            await services.stop()
+        self.assertEqual((message['chat']['id'], message['text']), (5, 'ответ'))
+        self.assertEqual(services.telegram_calls, {'sendMessage': 1})
+        self.assertEqual(body.count('data: '), 3)
+        self.assertTrue(body.endswith('data: [DONE]\n\n'))
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_expired_and_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        cache.set('c', 3)
+        cache.set('d', 4)
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('c'), cache.get('d')), (3, 4))
+
+
+class SingleFlightTests(SimpleTestCase):
+    async def test_concurrent_calls_share_one_execution(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value * 2
+
+        results = await asyncio.gather(*(flight.do('key', work, 21) for _ in range(5)))
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(len(flight), 0)
+
+    async def test_error_is_shared(self):
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+
+        results = await asyncio.gather(flight.do('key', fail), flight.do('key', fail), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_waiter_timeout_does_not_cancel_shared_call(self):
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.05)
+            return 'done'
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(flight.do('key', work), 0.01)
+        self.assertEqual(await flight.do('key', work), 'done')
+
+    async def test_stream_reaches_every_waiter(self):
+        # Присоединившийся к общему запросу получает текст до его окончания (таймаут первых токенов)
+        flight = SingleFlight()
+        leader, follower = [], []
+        follower_started = asyncio.Event()
+
+        async def work(on_text):
+            on_text('a')
+            await follower_started.wait()
+            on_text('ab')
+            return 'abc'
+
+        first = asyncio.create_task(flight.stream('key', work, on_text=leader.append))
+        await asyncio.sleep(0)
+
+        def on_follower_text(text):
+            follower.append(text)
+            follower_started.set()
+
+        second = asyncio.create_task(flight.stream('key', work, on_text=on_follower_text))
+        self.assertEqual(await asyncio.gather(first, second), ['abc', 'abc'])
+        self.assertEqual(leader, ['a', 'ab'])
+        self.assertEqual(follower, ['a', 'ab'])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_capacity_and_delay(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.delay(), 0.1, delta=0.02)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=1000)
+        bucket.pause(5)
+        self.assertFalse(bucket.try_acquire())
+        self.assertGreater(bucket.delay(), 4)
+
+    async def test_acquire_waits_for_refill(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.035)
+
+
+class FakeBot:
+    """
+    Вызовы Bot API в памяти: метод-объект aiogram (outbox) или send_message/edit_message_text (StreamingReply).
+    """
+
+    def __init__(self, retry_after=None):
+        self.calls = []
+        self.retry_after = retry_after  # Один раз ответить RetryAfter на этот текст
+        self._message_ids = iter(range(1, 1000))
+
+    async def __call__(self, method):
+        if self.retry_after is not None and getattr(method, 'text', None) == self.retry_after:
+            self.retry_after = None
+            raise TelegramRetryAfter(method=method, message='Flood control', retry_after=0)
+        self.calls.append((method.chat_id, method.text))
+        return True
+
+    async def send_message(self, chat_id, text):
+        self.calls.append(('send', text))
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+    async def edit_message_text(self, text, chat_id, message_id):
+        self.calls.append(('edit', text))
+
+
+class OutboxTests(SimpleTestCase):
+    def make_outbox(self, bot):
+        return Outbox(bot, rate=1000, chat_rate=1000, chat_burst=100, group_rate=1000, workers=3)
+
+    async def test_messages_to_one_chat_keep_order(self):
+        bot = FakeBot(retry_after='2')
+        outbox = self.make_outbox(bot)
+        futures = [outbox.send_message(chat_id, str(i)) for i in range(5) for chat_id in (1, 2)]
+        await asyncio.gather(*futures)
+        for chat_id in (1, 2):
+            self.assertEqual([text for chat, text in bot.calls if chat == chat_id], [str(i) for i in range(5)])
+        await outbox.close(1)
+
+    async def test_chat_action_is_skipped_while_messages_are_queued(self):
+        outbox = self.make_outbox(FakeBot())
+        outbox.send_message(1, 'hello')
+        self.assertIsNone(outbox.send_chat_action(1, 'typing'))
+        await outbox.close(1)
+
+    async def test_closed_outbox_rejects_messages(self):
+        outbox = self.make_outbox(FakeBot())
+        await outbox.close(1)
+        with self.assertRaises(RuntimeError):
+            outbox.submit(SendMessage(chat_id=1, text='late'))
+
+
+class StreamingReplyTests(SimpleTestCase):
+    async def test_updates_are_throttled_and_final_text_is_shown(self):
+        bot = FakeBot()
+        reply = StreamingReply(bot, chat_id=1, interval=10)
+        for text in ('Привет', 'Привет, мир', 'Привет, мир!'):
+            reply.update(text)
+            await asyncio.sleep(0.01)
+        self.assertTrue(reply.started.is_set())
+        await reply.finish('Привет, мир!')
+        self.assertEqual(bot.calls[0][0], 'send')
+        # Промежуточные правки чаще interval не отправляются, финальная — сразу
+        self.assertEqual(bot.calls[1:], [('edit', 'Привет, мир!')])
+
+    async def test_answer_without_stream_is_sent_once(self):
+        bot = FakeBot()
+        reply = StreamingReply(bot, chat_id=1)
+        await reply.finish('Ответ из кэша')
+        self.assertEqual(bot.calls, [('send', 'Ответ из кэша')])
+
+
+class ConversationCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.stored = {}
+
+        async def load_recent_queries(user_id, limit):
+            return self.stored.get(user_id, [])[-limit:]
+
+        patcher = mock.patch('chatbot.conversations.load_recent_queries', load_recent_queries)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def saved(self, pk, query):
+        return UserQuery(pk=pk, user_id='1', query=query)
+
+    async def test_history_is_read_once_per_process(self):
+        cache = ConversationCache(max_users=10, max_turns=5, ttl=60)
+        self.stored['1'] = [self.saved(1, 'первый')]
+        self.assertEqual([turn.query for turn in await cache.recent(1)], ['первый'])
+        self.stored['1'].append(self.saved(2, 'в другом процессе'))
+        self.assertEqual([turn.query for turn in await cache.recent(1)], ['первый'])
+        self.assertEqual(cache.last(1)[0].pk, 1)
+
+    async def test_stale_history_is_reloaded(self):
+        # Сообщения пользователя обрабатывают разные процессы: ход из другого процесса виден после refresh
+        cache = ConversationCache(max_users=10, max_turns=5, ttl=60, refresh=0.01)
+        self.stored['1'] = [self.saved(1, 'первый')]
+        await cache.recent(1)
+        cache.append(1, UserQuery(user_id='1', query='еще не записан'))
+        self.stored['1'].append(self.saved(2, 'в другом процессе'))
+        await asyncio.sleep(0.02)
+        self.assertEqual(cache.last(1)[0].query, 'еще не записан')
+        turns = await cache.recent(1)
+        self.assertEqual([turn.query for turn in turns], ['первый', 'в другом процессе', 'еще не записан'])
+
+    async def test_stale_parent_is_resolved_from_the_database(self):
+        cache = ConversationCache(max_users=10, max_turns=5, ttl=60, refresh=0.01)
+        self.stored['1'] = [self.saved(1, 'первый')]
+        await cache.recent(1)
+        self.assertEqual(cache.last(1), (self.stored['1'][0], True))
+        await asyncio.sleep(0.02)
+        self.assertEqual(cache.last(1), (None, False))
+
+
+class WriteBehindQueueTests(SimpleTestCase):
+    def make_queue(self):
+        conversations = ConversationCache(max_users=10, max_turns=5, ttl=60)
+        return WriteBehindQueue(max_batch=10, flush_interval=0.01, max_pending=100, conversations=conversations)
+
+    async def test_invalid_record_is_rejected_before_queueing(self):
+        queue = self.make_queue()
+        with self.assertRaises(ValidationError):
+            await queue.add_query(1, query=None, response='sticker')
+        self.assertEqual(len(queue), 0)
+
+    async def test_failing_record_does_not_drop_the_batch(self):
+        written = []
+
+        async def write_records(batch):
+            if any(record.query is None for record in batch):
+                raise IntegrityError('null value in column "query"')
+            written.extend(batch)
+
+        batch = [UserQuery(user_id=str(i), query=f'q{i}') for i in range(7)]
+        batch.insert(3, UserQuery(user_id='x', query=None))
+        with mock.patch('chatbot.persistence.write_records', write_records), \
+                mock.patch('chatbot.persistence.asyncio.sleep', mock.AsyncMock()):
+            await self.make_queue()._flush(batch)
+        self.assertEqual([record.query for record in written], [f'q{i}' for i in range(7)])
+
+    async def test_batch_waits_for_the_database(self):
+        written = []
+        failures = [OperationalError('server closed the connection unexpectedly')] * 5
+
+        async def write_records(batch):
+            if failures:
+                raise failures.pop()
+            written.extend(batch)
+
+        batch = [UserQuery(user_id=str(i), query=f'q{i}') for i in range(4)]
+        sleep = mock.AsyncMock()
+        with mock.patch('chatbot.persistence.write_records', write_records), \
+                mock.patch('chatbot.persistence.asyncio.sleep', sleep):
+            await self.make_queue()._flush(batch)
+        # Больше FLUSH_ATTEMPTS попыток, и ни одна запись не отброшена
+        self.assertEqual(sleep.await_count, 5)
+        self.assertEqual(written, batch)
+
+    async def test_close_gives_up_when_the_database_is_down(self):
+        write_records = mock.AsyncMock(side_effect=InterfaceError('connection already closed'))
+        queue = self.make_queue()
+        with mock.patch('chatbot.persistence.write_records', write_records), \
+                mock.patch('chatbot.persistence.asyncio.sleep', mock.AsyncMock()):
+            await queue.add_query(1, query='вопрос', response='ответ')
+            await queue.close()
+        self.assertEqual(write_records.await_count, FLUSH_ATTEMPTS)
+
+    async def test_close_flushes_queued_records(self):
+        written = []
+
+        async def write_records(batch):
+            written.extend(batch)
+
+        queue = self.make_queue()
+        with mock.patch('chatbot.persistence.write_records', write_records):
+            first = await queue.add_query(1, query='первый', response='ответ')
+            second = await queue.add_query(1, query='второй', response='ответ')
+            await queue.add_learning(question='вопрос', answer='ответ')
+            await queue.close()
+        self.assertEqual(len(written), 3)
+        # Родитель второго запроса известен из кэша диалога, без чтения из базы
+        self.assertIs(second.parent, first)
+
+
+class WriteRecordsTests(TestCase):
+    def test_parents_inside_and_before_the_batch(self):
+        earlier = UserQuery.objects.create(user_id='1', query='раньше')
+        first = UserQuery(user_id='1', query='первый')
+        first._resolve_parent = True
+        second = UserQuery(user_id='1', query='второй', parent=first)
+        learning = FAQLearning(question='вопрос', answer='ответ')
+        write_records.__wrapped__([first, second, learning])
+        self.assertEqual(UserQuery.objects.get(pk=first.pk).parent_id, earlier.pk)
+        self.assertEqual(UserQuery.objects.get(pk=second.pk).parent_id, first.pk)
+        self.assertTrue(FAQLearning.objects.filter(pk=learning.pk).exists())
+
+
+class SQLiteStorageTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'fsm.sqlite3')
+        self.key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+    async def test_state_and_data(self):
+        storage = SQLiteStorage(self.path, ttl=60)
+        await storage.set_state(self.key, 'FAQStates:awaiting_clarification')
+        await storage.set_data(self.key, {'faq_options': {'1': 5}})
+        self.assertEqual(await storage.get_state(self.key), 'FAQStates:awaiting_clarification')
+        self.assertEqual(await storage.get_data(self.key), {'faq_options': {'1': 5}})
+        await storage.close()
+
+    async def test_expired_state_is_not_returned(self):
+        storage = SQLiteStorage(self.path, ttl=-1)
+        await storage.set_state(self.key, 'A:b')
+        self.assertIsNone(await storage.get_state(self.key))
+        self.assertEqual(await storage.purge_expired(), 1)
+        await storage.close()
+
+    async def test_locked_file_is_awaited_without_blocking(self):
+        import sqlite3
+
+        storage = SQLiteStorage(self.path, ttl=60)
+        await storage.set_state(self.key, 'A:b')
+        other = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        asyncio.get_running_loop().call_later(0.1, other.execute, 'COMMIT')
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        ticker = asyncio.create_task(tick())
+        await storage.set_state(self.key, 'A:c')
+        ticker.cancel()
+        self.assertEqual(await storage.get_state(self.key), 'A:c')
+        self.assertGreater(ticks, 3)
+        await storage.close()
+
+
+class DatabaseStorageTests(TestCase):
+    # Методы хранилища выполняются в пуле chatbot.db, здесь — напрямую в транзакции теста
+    key = StorageKey(bot_id=1, chat_id=2, user_id=3)
+
+    def write(self, storage, **fields):
+        DatabaseStorage._write.__wrapped__(storage, self.key, **fields)
+
+    def read(self, storage, field):
+        return DatabaseStorage._read.__wrapped__(storage, self.key, field)
+
+    def test_state_and_data(self):
+        storage = DatabaseStorage(ttl=60)
+        self.write(storage, state='FAQStates:awaiting_clarification')
+        self.write(storage, data={'faq_options': {'1': 5}})
+        self.assertEqual(self.read(storage, 'state'), 'FAQStates:awaiting_clarification')
+        self.assertEqual(self.read(storage, 'data'), {'faq_options': {'1': 5}})
+        self.assertEqual(FSMRecord.objects.count(), 1)
+
+    def test_expired_data_does_not_come_back(self):
+        self.write(DatabaseStorage(ttl=-1), state='A:b', data={'old': True})
+        storage = DatabaseStorage(ttl=60)
+        self.assertIsNone(self.read(storage, 'state'))
+        # Новое состояние поверх устаревшей записи начинается с пустых данных
+        self.write(storage, state='A:c')
+        self.assertEqual(self.read(storage, 'data'), {})
+        self.assertEqual(FSMRecord.objects.count(), 1)
+
+    def test_purge_expired(self):
+        self.write(DatabaseStorage(ttl=-1), state='A:b')
+        DatabaseStorage._write.__wrapped__(DatabaseStorage(ttl=60), StorageKey(bot_id=1, chat_id=4, user_id=4), state='A:b')
+        self.assertEqual(DatabaseStorage.purge_expired.__wrapped__(DatabaseStorage(ttl=60)), 1)
+        self.assertEqual(FSMRecord.objects.count(), 1)
+
+
+class JSONStreamTests(SimpleTestCase):
+    def parse(self, text):
+        # Маленькие порции чтения: значения и числа разрываются на границах
+        with mock.patch.object(importing, 'READ_CHUNK_SIZE', 3):
+            return list(importing._JSONStream(io.StringIO(text)))
+
+    def test_top_level_array(self):
+        self.assertEqual(self.parse(' [ {"q": "Вопрос?", "a": 12345}, 678 , "x"] '), [{'q': 'Вопрос?', 'a': 12345}, 678, 'x'])
+
+    def test_telegram_export(self):
+        text = '{"name": "chat", "messages": [{"id": 1}, {"id": 22}], "id": 9}'
+        self.assertEqual(self.parse(text), [{'id': 1}, {'id': 22}])
+
+    def test_empty_and_invalid(self):
+        self.assertEqual(self.parse('[]'), [])
+        with self.assertRaises(ValueError):
+            self.parse('[1, 2')
+
+
+class FAQImporterTests(TestCase):
+    def setUp(self):
+        self.existing = FAQ.objects.create(question='Как пополнить карту?', answer='Старый ответ')
+        self.unchanged = FAQ.objects.create(question='Где скачать приложение?', answer='В App Store')
+
+    def test_upsert_by_normalized_question(self):
+        stats = importing.FAQImporter(batch_size=2).run([
+            ('как пополнить  КАРТУ', 'Новый ответ'),
+            ('Где скачать приложение?', 'В App Store'),
+            ('Что такое Dexnode?', 'Узел сети'),
+            ('Что такое DEXNODE', 'Повтор'),
+            ('', 'Без вопроса'),
+        ])
+        self.assertEqual(
+            stats, {'read': 5, 'duplicates': 1, 'skipped': 1, 'created': 1, 'updated': 1, 'unchanged': 1},
+        )
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.question, self.existing.answer), ('как пополнить  КАРТУ', 'Новый ответ'))
+        self.assertEqual(FAQ.objects.get(question_key='что такое dexnode').answer, 'Узел сети')
+        self.assertEqual(FAQ.objects.count(), 3)
+
+    def test_dry_run_writes_nothing(self):
+        stats = importing.FAQImporter(dry_run=True).run([('Как пополнить карту?', 'Новый ответ'), ('Новый?', 'Да')])
+        self.assertEqual((stats['created'], stats['updated']), (1, 1))
+        self.assertEqual(FAQ.objects.get(pk=self.existing.pk).answer, 'Старый ответ')
+        self.assertEqual(FAQ.objects.count(), 2)
+
+
+class FlakyServices(FakeServices):
+    """
+    FakeServices, где первые failures запросов к OpenAI отвечают 500, а первый успешный — с задержкой slow_first.
+    """
+
+    def __init__(self, failures=0, slow_first=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+        self.slow_first = slow_first
+        self.requests = 0
+
+    async def chat_completions(self, request):
+        self.requests += 1
+        if self.requests <= self.failures:
+            return web.json_response({'error': {'message': 'overloaded', 'type': 'server_error'}}, status=500)
+        if self.requests == self.failures + 1 and self.slow_first:
+            await asyncio.sleep(self.slow_first)
+        return await super().chat_completions(request)
+
+
+class LLMClientTests(SimpleTestCase):
+    async def complete(self, services, **options):
+        url = await services.start()
+        client = openai.AsyncOpenAI(
+            api_key='test', base_url=f'{url}/v1', http_client=openai.DefaultAsyncHttpxClient(), max_retries=0,
+        )
+        llm = LLMClient(client, model='test', max_concurrency=4, retry_base_delay=0.01, retry_max_delay=0.02, **options)
+        texts = []
+        started = time.monotonic()
+        try:
+            answer = await llm.complete([{'role': 'user', 'content': 'вопрос'}], on_text=texts.append)
+            self.elapsed = time.monotonic() - started
+            return answer, texts
+        finally:
+            await llm.close()
+            await services.stop()
+
+    async def test_streamed_text(self):
+        answer, texts = await self.complete(FakeServices(openai_chunks=3))
+        self.assertEqual(answer, 'Тестовый ответ на ')
+        self.assertEqual(texts, ['Тестовый ', 'Тестовый ответ ', 'Тестовый ответ на '])
+
+    async def test_server_errors_are_retried(self):
+        services = FlakyServices(failures=2, openai_chunks=2)
+        answer, _ = await self.complete(services, max_retries=2)
+        self.assertEqual(answer, 'Тестовый ответ ')
+        self.assertEqual(services.requests, 3)
+
+    async def test_retries_are_limited(self):
+        with self.assertRaises(openai.InternalServerError):
+            await self.complete(FlakyServices(failures=3), max_retries=1)
+
+    async def test_slow_request_is_hedged(self):
+        services = FlakyServices(slow_first=2, openai_chunks=2)
+        answer, texts = await self.complete(services, hedge_after=0.05)
+        self.assertEqual(answer, 'Тестовый ответ ')
+        self.assertLess(self.elapsed, 1)
+        self.assertEqual(services.requests, 2)
+        # Пользователь видит текст только одной попытки
+        self.assertEqual(texts, ['Тестовый ', 'Тестовый ответ '])
+
+
+class RollingSummaryTests(SimpleTestCase):
+    def test_reloaded_turns_are_not_summarized_twice(self):
+        summary = RollingSummary(budget=1000, max_users=10, ttl=60)
+        turns = [SimpleNamespace(query='q1', response='a1'), SimpleNamespace(query='q2', response='a2')]
+        first = summary.summarize(1, turns)
+        # Те же ходы новыми объектами (из базы), плюс повтор первого вопроса
+        reloaded = [SimpleNamespace(query=turn.query, response=turn.response) for turn in turns]
+        reloaded.append(SimpleNamespace(query='q1', response='a1'))
+        self.assertEqual(summary.summarize(1, reloaded), first + '\n- q1 — a1')
+
+
+class FAQIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = FAQIndex([
+            FAQEntry(1, '14 декабря:', 'Вебинар'),
+            FAQEntry(2, '2. Тариф "500":', 'Про тариф 500'),
+            FAQEntry(3, 'Как пополнить баланс карты?', 'Через приложение'),
+        ])
+
+    def search(self, query):
+        return self.index.search(query, min_score=0.3, limit=9, fuzzy_exact_score=0.9, fuzzy_min_score=0.3)
+
+    def test_exact_question(self):
+        self.assertEqual(self.search('как пополнить баланс карты').exact.id, 3)
+
+    def test_fuzzy_match_is_only_a_candidate(self):
+        result = self.search('тариф 5000')
+        self.assertIsNone(result.exact)
+        self.assertEqual([entry.id for entry in result.candidates], [2])
+
+
+class VectorIndexTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, 'faq.npz')
+        self.entries = [FAQEntry(i, f'Вопрос номер {i}', 'Ответ') for i in range(50)]
+
+    def test_concurrent_saves_leave_a_valid_file(self):
+        # Несколько воркеров строят и сохраняют индекс одновременно
+        embedder = HashingEmbedder(dim=64)
+        index = load_or_build_vectors(self.entries, embedder, path=None)
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: index.save(self.path), range(32)))
+        self.assertEqual(os.listdir(self.directory), ['faq.npz'])
+        self.assertEqual(list(VectorIndex.load(self.path).ids), list(range(50)))
+
+    def test_changed_questions_are_recomputed(self):
+        embedder = HashingEmbedder(dim=64)
+        load_or_build_vectors(self.entries, embedder, path=self.path)
+        self.entries[3] = FAQEntry(3, 'Совсем другой вопрос', 'Ответ')
+        with mock.patch.object(embedder, 'embed', wraps=embedder.embed) as embed:
+            index = load_or_build_vectors(self.entries, embedder, path=self.path)
+        embed.assert_called_once_with(['Совсем другой вопрос'])
+        self.assertEqual(index.top_k(embedder.embed(['Совсем другой вопрос'])[0], 1)[0][0], 3)
+
+    async def test_vectors_are_built_outside_the_db_pool(self):
+        threads = []
+
+        def build(entries):
+            threads.append(threading.current_thread().name)
+
+        async def load_entries():
+            return (1, None), self.entries
+
+        with mock.patch.object(search, '_load_entries', load_entries), \
+                mock.patch('chatbot.embeddings.load_or_build_vectors', build), \
+                self.settings(FAQ_SEARCH_MODE='semantic'):
+            await search._load_index(0)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0].startswith('db'))
+
+
+def set_bot_object(test, name, value):
+    """
+    Подменяет outbox, llm и другие объекты chatbot.bots, которые создаются лениво:
+    patch.object прочитал бы исходное значение и запустил setup_bot().
+    """
+    from chatbot import bots
+
+    missing = object()
+    previous = vars(bots).get(name, missing)
+    setattr(bots, name, value)
+    test.addCleanup(lambda: vars(bots).pop(name) if previous is missing else setattr(bots, name, previous))
+
+
+class FakeLLM:
+    def __init__(self):
+        self.contexts = []
+
+    async def complete(self, context, on_text=None):
+        self.contexts.append(context)
+        await asyncio.sleep(0.01)
+        return f"Ответ на {context[-1]['content']} ({len(context)} сообщений)"
+
+
+class FakeChatGPTMixin:
+    def setUp(self):
+        from chatbot import bots
+
+        self.bots = bots
+        self.llm = FakeLLM()
+        set_bot_object(self, 'llm', self.llm)
+        self.histories = {}
+
+        async def get_user_conversation(user_id, limit=5):
+            return self.histories.get(user_id, [])
+
+        for target, value in (
+            ('get_user_conversation', get_user_conversation),
+            ('llm_cache', TTLCache(maxsize=100, ttl=60)),
+            ('llm_calls', SingleFlight()),
+        ):
+            patcher = mock.patch.object(bots, target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class ChatGPTResponseTests(FakeChatGPTMixin, SimpleTestCase):
+    async def test_users_without_history_share_one_request(self):
+        answers = await asyncio.gather(*(
+            self.bots.get_chatgpt_response(user_id, 'Как пополнить карту?') for user_id in range(3)
+        ))
+        self.assertEqual(len(set(answers)), 1)
+        self.assertEqual(len(self.llm.contexts), 1)
+        # Повтор того же вопроса — из кэша
+        await self.bots.get_chatgpt_response(4, 'как пополнить КАРТУ')
+        self.assertEqual(len(self.llm.contexts), 1)
+
+    async def test_answer_is_not_shared_between_different_contexts(self):
+        self.histories[2] = [SimpleNamespace(query='Мой номер карты 1234', response='Записал')]
+        first, second = await asyncio.gather(
+            self.bots.get_chatgpt_response(1, 'Как пополнить карту?'),
+            self.bots.get_chatgpt_response(2, 'Как пополнить карту?'),
+        )
+        self.assertEqual(len(self.llm.contexts), 2)
+        self.assertNotEqual(first, second)
+        await self.bots.get_chatgpt_response(1, 'Как пополнить карту?')
+        self.assertEqual(len(self.llm.contexts), 2)
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+        self.queries = []
+        parent = None
+        # Диалог из 5 сообщений: три старых и два свежих
+        for days in (10, 9, 8, 1, 0):
+            parent = UserQuery.objects.create(user_id='1', query=f'вопрос {days}', response='ответ', parent=parent)
+            UserQuery.objects.filter(pk=parent.pk).update(created_at=self.now - timedelta(days=days))
+            self.queries.append(parent)
+
+    def test_archive_moves_old_queries_and_breaks_chains(self):
+        batches = list(archive_queries(self.now - timedelta(days=5), batch_size=2))
+        self.assertEqual(batches, [2, 1])
+        self.assertEqual(
+            list(UserQuery.objects.order_by('id').values_list('id', 'parent_id')),
+            [(self.queries[3].id, None), (self.queries[4].id, self.queries[3].id)],
+        )
+        archived = UserQueryArchive.objects.order_by('id')
+        self.assertEqual([q.id for q in archived], [q.id for q in self.queries[:3]])
+        # В архиве ссылки сохраняются, и диалог можно восстановить
+        self.assertEqual(archived[1].parent_id, self.queries[0].id)
+        self.assertEqual(archived[1].query, 'вопрос 9')
+
+    def test_delete_without_archive(self):
+        self.assertEqual(sum(archive_queries(self.now - timedelta(days=5), batch_size=100, archive=False)), 3)
+        self.assertEqual(UserQuery.objects.count(), 2)
+        self.assertFalse(UserQueryArchive.objects.exists())
+
+    def test_purge_archive(self):
+        list(archive_queries(self.now - timedelta(days=5), batch_size=100))
+        self.assertEqual(list(purge_archive(self.now - timedelta(days=9, hours=12), batch_size=1)), [1])
+        self.assertEqual(
+            list(UserQueryArchive.objects.order_by('id').values_list('id', flat=True)),
+            [q.id for q in self.queries[1:3]],
+        )
+
+
+class FAQLearningUsableTests(TestCase):
+    def test_errors_empty_answers_and_refusals_are_excluded(self):
+        answers = [
+            'Пополнить карту можно в приложении.',
+            '',
+            EMPTY_ANSWER,
+            f'{ERROR_ANSWER_PREFIX}: Ошибка при запросе к ассистенту: timeout',
+            # Отказ, который модель дает по системному промпту, в том числе в кавычках
+            f'{OFF_TOPIC_ANSWER}.',
+            f'"{OFF_TOPIC_ANSWER}"',
+            'К сожалению, я не могу помочь с этим',
+            "i'm sorry, but I can't help with that.",
+        ]
+        FAQLearning.objects.bulk_create([FAQLearning(question='вопрос', answer=answer) for answer in answers])
+        usable = FAQLearning.objects.usable().values_list('answer', flat=True)
+        self.assertEqual(list(usable), ['Пополнить карту можно в приложении.'])
+
+
+class PromoteLearningTests(TestCase):
+    def learn(self, question, answers):
+        FAQLearning.objects.bulk_create([FAQLearning(question=question, answer=answer) for answer in answers])
+
+    def promote(self, *args):
+        out = io.StringIO()
+        call_command('promote_learning', '--min-count', '3', *args, stdout=out)
+        return out.getvalue()
+
+    def test_apply_adds_frequent_questions_with_usable_answers(self):
+        related = FAQ.objects.create(question='Как пополнить карту Dexcard?', answer='В приложении')
+        # Последний ответ в кластере — отказ: в FAQ переносится предыдущий пригодный
+        self.learn('Как пополнить карту Dexcard через банк?', ['Переводом с карты банка', 'Через СБП', OFF_TOPIC_ANSWER])
+        self.learn('Кто выиграет чемпионат мира?', [OFF_TOPIC_ANSWER] * 3)
+        self.learn('Редкий вопрос про Dexnode', ['Ответ'] * 2)
+        self.promote('--apply')
+        faq = FAQ.objects.exclude(pk=related.pk).get()
+        self.assertEqual((faq.question, faq.answer), ('Как пополнить карту Dexcard через банк?', 'Через СБП'))
+        self.assertEqual(list(faq.related_questions.all()), [related])
+        self.assertEqual(list(related.related_questions.all()), [faq])
+        # Вопрос уже есть в FAQ: повторный запуск ничего не добавляет
+        self.assertIn("Новых частых вопросов нет", self.promote('--apply'))
+        self.assertEqual(FAQ.objects.count(), 2)
+
+    def test_without_apply_faq_is_unchanged(self):
+        self.learn('Как пополнить карту Dexcard через банк?', ['Через СБП'] * 3)
+        self.assertIn('Как пополнить карту Dexcard через банк?', self.promote())
+        self.assertFalse(FAQ.objects.exists())
+
+
+class LLMCacheSeedTests(FakeChatGPTMixin, TestCase):
+    async def test_seeded_answer_is_served_to_users_without_history(self):
+        await FAQLearning.objects.acreate(question='Как пополнить карту?', answer='Через приложение')
+        await FAQLearning.objects.acreate(question='Кто выиграет матч?', answer='Извините, произошла ошибка: timeout')
+        await FAQLearning.objects.acreate(question='Какая погода завтра?', answer=OFF_TOPIC_ANSWER)
+        self.assertEqual(await sync_to_async(self.bots.seed_llm_cache.__wrapped__)(), 1)
+        self.assertEqual(await self.bots.get_chatgpt_response(1, 'как пополнить карту'), 'Через приложение')
+        self.histories[2] = [SimpleNamespace(query='Привет', response='Здравствуйте')]
+        await self.bots.get_chatgpt_response(2, 'как пополнить карту')
+        await self.bots.get_chatgpt_response(1, 'Кто выиграет матч?')
+        await self.bots.get_chatgpt_response(1, 'Какая погода завтра?')
+        self.assertEqual(len(self.llm.contexts), 3)
+
+
+class DatabaseSearchTests(TestCase):
+    # Поиск без индекса в памяти (FAQ_INDEX_ENABLED=false): полнотекстовый и триграммный поиск PostgreSQL
+    @classmethod
+    def setUpTestData(cls):
+        cls.card = FAQ.objects.create(question='Как пополнить баланс карты?', answer='Через приложение Dexcard')
+        cls.tariff = FAQ.objects.create(question='Что входит в тариф "500"?', answer='Доступ ко всем сервисам')
+
+    def search(self, query):
+        return search_faq_in_database.__wrapped__(query, 5)
+
+    def test_question_substring_is_exact(self):
+        self.assertEqual(self.search('пополнить баланс'), FAQSearchResult(self.card, []))
+
+    def test_typo_is_found(self):
+        result = self.search('Как пополнить баланс карти')
+        self.assertIn(self.card, [result.exact, *result.candidates])
+        self.assertNotIn(self.tariff, result.candidates)
+
+    def test_unrelated_query(self):
+        # Ошибка запроса тоже дает пустой результат, поэтому проверяем и отсутствие ошибок
+        with self.assertNoLogs(level='ERROR'):
+            self.assertEqual(self.search('прогноз погоды'), FAQSearchResult(None, []))
+
+
+@override_settings(LLM_STREAM_REPLIES=False)
+class ClarificationReplyTests(SimpleTestCase):
+    def setUp(self):
+        from chatbot import bots
+
+        self.bots = bots
+        self.sent = []
+        set_bot_object(self, 'outbox', SimpleNamespace(
+            send_message=lambda chat_id, text, **kwargs: self.sent.append(text),
+            send_chat_action=lambda chat_id, action: None,
+        ))
+        self.answers = {2: 'Про тариф 500', 3: 'Про тариф 1000'}
+
+        async def get_faq_entry(faq_id):
+            return FAQEntry(faq_id, f'Вопрос {faq_id}', self.answers[faq_id])
+
+        self.search = mock.AsyncMock(return_value=FAQSearchResult(None, []))
+        self.bot = Bot('42:TEST')
+        self.bot_calls = mock.AsyncMock()
+        for patcher in (
+            mock.patch.object(bots, 'search_faq', self.search),
+            mock.patch.object(bots, 'get_faq_entry', get_faq_entry),
+            mock.patch.object(bots, 'wait_chatgpt_response', mock.AsyncMock(return_value='Ответ ChatGPT')),
+            mock.patch.object(bots.history, 'add_query', mock.AsyncMock()),
+            mock.patch.object(bots.history, 'add_learning', mock.AsyncMock()),
+            mock.patch.object(Bot, '__call__', self.bot_calls),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.dispatcher = Dispatcher(storage=MemoryStorage())
+        bots.register_handlers(self.dispatcher)
+        self.state = self.dispatcher.fsm.get_context(self.bot, chat_id=7, user_id=7)
+        self.updates = iter(range(1, 100))
+
+    async def offer_options(self):
+        await self.state.set_state(self.bots.FAQStates.awaiting_clarification)
+        await self.state.update_data(faq_options={'1': 2, '2': 3})
+
+    async def send(self, text):
+        update = make_update(next(self.updates), 7, text)
+        await self.dispatcher.feed_update(self.bot, Update.model_validate(update, context={'bot': self.bot}))
+
+    async def press(self, faq_id):
+        update_id = next(self.updates)
+        update = {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id), 'chat_instance': '1', 'data': f'faq_{faq_id}',
+                'from': {'id': 7, 'is_bot': False, 'first_name': 'user7'},
+                'message': {'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}, 'text': 'Варианты'},
+            },
+        }
+        await self.dispatcher.feed_update(self.bot, Update.model_validate(update, context={'bot': self.bot}))
+
+    async def test_digit_replies_select_options_before_search(self):
+        await self.offer_options()
+        await self.send('1')
+        await self.send(' 2 ')
+        self.assertEqual(self.sent, ['Про тариф 500', 'Про тариф 1000'])
+        self.search.assert_not_called()
+
+    async def test_other_message_ends_the_choice(self):
+        await self.offer_options()
+        await self.send('Как пополнить карту?')
+        self.assertIsNone(await self.state.get_state())
+        await self.send('1')
+        self.assertEqual(self.search.await_count, 2)
+        self.assertEqual(self.sent, ['Ответ ChatGPT', 'Ответ ChatGPT'])
+
+    async def test_buttons_work_after_a_digit_reply(self):
+        await self.offer_options()
+        await self.send('1')
+        await self.press(3)
+        self.assertEqual(self.sent, ['Про тариф 500', 'Про тариф 1000'])
+        # Нажатие подтверждено, чтобы на кнопке не оставались "часики"
+        self.assertIsInstance(self.bot_calls.await_args.args[0], AnswerCallbackQuery)
+
+    async def test_button_without_clarification_state(self):
+        await self.press(2)
+        self.assertEqual(self.sent, ['Про тариф 500'])
+
+
+class WebhookDispatcherTests(SimpleTestCase):
+    async def test_updates_of_one_user_are_processed_in_order(self):
+        processed = []
+
+        class Dispatcher:
+            async def feed_update(self, bot, update):
+                await asyncio.sleep(random.random() / 100)
+                processed.append((update.message.from_user.id, update.update_id))
+
+        dispatcher = WebhookDispatcher(Dispatcher(), None, max_concurrency=4, max_pending=100, dedup_ttl=60)
+        for update_id in range(30):
+            self.assertTrue(dispatcher.feed(make_update(update_id, update_id % 3, 'текст')))
+        self.assertTrue(dispatcher.feed(make_update(0, 0, 'повтор')))
+        await dispatcher.drain(5)
+        self.assertEqual(len(processed), 30)
+        for user_id in range(3):
+            order = [update_id for user, update_id in processed if user == user_id]
+            self.assertEqual(order, sorted(order))
+
+
+class WebhookStartupTests(SimpleTestCase):
+    def setUp(self):
+        self.startup_bot = mock.AsyncMock(return_value=[])
+        for patcher in (
+            mock.patch.object(webhook, '_startup', None),
+            mock.patch.object(webhook, '_background', []),
+            mock.patch.object(webhook, 'get_webhook_dispatcher'),
+            mock.patch('chatbot.bots.startup_bot', self.startup_bot),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def test_bot_starts_once_without_lifespan(self):
+        # Сервер без lifespan: бот запускается первым обновлением, параллельные ждут тот же запуск
+        with self.assertLogs(level='WARNING'):
+            await asyncio.gather(*(webhook.ensure_webhook_started() for _ in range(5)))
+        await webhook.ensure_webhook_started()
+        self.startup_bot.assert_awaited_once()
+
+    async def test_failed_startup_is_retried(self):
+        self.startup_bot.side_effect = [RuntimeError('database is unavailable'), []]
+        with self.assertLogs(level='WARNING'), self.assertRaises(RuntimeError):
+            await webhook.ensure_webhook_started()
+        with self.assertLogs(level='WARNING'):
+            await webhook.ensure_webhook_started()
+        self.assertEqual(self.startup_bot.await_count, 2)
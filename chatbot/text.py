@@ -0,0 +1,84 @@
+import re
+
+# Нормализация текста для поиска по FAQ
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Русские слова сильно склоняются, поэтому вместо полноценного стеммера
+# отрезаем типичное окончание и сравниваем слова по первым символам
+# ("стоимость", "стоимости" -> "стоимо", "ноду", "ноды" -> "нод")
+STEM_LENGTH = 6
+MIN_STEM_LENGTH = 3
+_ENDINGS = sorted((
+    'ами', 'ями', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ый', 'ий', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ов', 'ев',
+    'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ую', 'юю', 'ть', 'ся',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь',
+), key=len, reverse=True)
+
+
+def normalize_text(text):
+    """
+    Приводит текст к единому виду: нижний регистр, "ё" -> "е", схлопнутые пробелы.
+    """
+    text = (text or '').casefold().replace('ё', 'е')
+    return ' '.join(text.split())
+
+
+def query_key(text):
+    """
+    Ключ запроса для кэшей: "Стоимость устройства?" и "стоимость  устройства" совпадают.
+    """
+    return ' '.join(tokenize(normalize_text(text)))
+
+
+def tokenize(text):
+    """
+    Разбивает уже нормализованный текст на слова.
+    """
+    return _WORD_RE.findall(text)
+
+
+def word_spans(text):
+    """
+    Слова нормализованного текста вместе с их позициями.
+    """
+    return _WORD_RE.finditer(text)
+
+
+def stem(word):
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM_LENGTH:
+            word = word[:-len(ending)]
+            break
+    return word[:STEM_LENGTH]
+
+
+def stems(text):
+    """
+    Список основ слов для нормализованного текста.
+    """
+    return [stem(word) for word in tokenize(text)]
+
+
+def split_qa_pairs(text):
+    """
+    Разбивает сообщение из группы на пары 'вопрос-ответ' по двоеточиям:
+    "Вопрос: ответ" в начале строки, следующие строки без двоеточия продолжают ответ.
+    """
+    pairs = []
+    parts = [p.strip() for p in (text or '').split('\n') if p.strip()]
+
+    for part in parts:
+        if ':' in part:
+            question, answer = part.split(':', 1)
+            pairs.append({
+                "question": question.strip() + ":",
+                "answer": answer.strip()
+            })
+        elif pairs:
+            # Продолжение ответа на предыдущий вопрос
+            pairs[-1]['answer'] += f"\n{part}"
+
+    # Пары без ответа не нужны
+    return [pair for pair in pairs if pair['answer']]
@@ -0,0 +1,69 @@
+import asyncio
+import random
+import time
+
+# Ограничение частоты обращений к внешним API (OpenAI, Bot API Telegram)
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity за раз.
+    Ожидающие обслуживаются по очереди, поэтому ранний запрос не обгонят более поздние.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def try_acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        now = self._refill()
+        if now < self._paused_until or self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def delay(self, amount=1):
+        """
+        Через сколько секунд будет доступно amount токенов.
+        """
+        amount = min(amount, self.capacity)
+        now = self._refill()
+        return max(self._paused_until - now, (amount - self.tokens) / self.rate, 0.0)
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = self._refill()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """
+        Останавливает выдачу на seconds секунд (ответ 429 / Retry-After от API).
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def backoff_delay(attempt, base, maximum):
+    """
+    Экспоненциальная задержка с полным джиттером: случайная в [0, min(maximum, base * 2^attempt)].
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
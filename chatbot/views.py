@@ -1,3 +1,54 @@
-from django.shortcuts import render
+import hmac
+import json
+import logging
 
-# Create your views here.
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed
+from django.views.decorators.csrf import csrf_exempt
+
+from chatbot.metrics import CONTENT_TYPE, authorized, metrics, profiler
+from chatbot.startup import is_ready
+from chatbot.webhook import ensure_webhook_started, get_webhook_dispatcher
+
+
+# Прием обновлений Telegram (режим webhook)
+@csrf_exempt
+async def telegram_webhook(request):
+    if not settings.TELEGRAM_WEBHOOK_ENABLED:
+        raise Http404
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    secret = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if settings.TELEGRAM_WEBHOOK_SECRET and not hmac.compare_digest(secret, settings.TELEGRAM_WEBHOOK_SECRET):
+        return HttpResponseForbidden()
+
+    try:
+        await ensure_webhook_started()
+    except Exception as e:
+        logging.error(f"Error while starting Telegram webhook: {e}")
+        return HttpResponse(status=503)
+
+    # 503 — очередь переполнена или сервер останавливается, Telegram повторит доставку
+    try:
+        accepted = get_webhook_dispatcher().feed(json.loads(request.body))
+    except ValueError:
+        return HttpResponse(status=400)
+    return HttpResponse(status=200 if accepted else 503)
+
+
+# Метрики в формате Prometheus, с параметром ?profile — отчет профилировщика
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    if not authorized(request.headers, request.GET):
+        return HttpResponseForbidden()
+    body = profiler.report() if 'profile' in request.GET else metrics.render()
+    return HttpResponse(body, content_type=CONTENT_TYPE)
+
+
+# Готовность к приему обновлений: в режиме webhook 503, пока бот не прошел все этапы запуска
+def ready_view(request):
+    if settings.TELEGRAM_WEBHOOK_ENABLED and not is_ready():
+        return HttpResponse('starting', status=503)
+    return HttpResponse('ready')
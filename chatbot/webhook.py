@@ -0,0 +1,194 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from chatbot.cache import TTLCache
+from chatbot.metrics import metrics
+
+# Прием обновлений Telegram через webhook в ASGI-приложении Django (вместо long polling).
+# Обновление подтверждается Telegram сразу, а обрабатывается в фоне с ограничением параллельности.
+# Обновления одного пользователя обрабатываются по очереди, в порядке поступления.
+
+
+def update_key(update):
+    """
+    Чье обновление: id пользователя, если его нет — чата, иначе само update_id.
+    """
+    event = None
+    for name in update.model_fields_set:
+        if name != 'update_id':
+            event = getattr(update, name)
+            break
+    user = getattr(event, 'from_user', None)
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    return user.id if user else chat.id if chat else update.update_id
+
+
+class WebhookDispatcher:
+    """
+    Очередь обработки обновлений из webhook: отбрасывает повторы по update_id,
+    ограничивает число одновременно работающих обработчиков и дожидается их при остановке.
+    """
+
+    def __init__(self, dispatcher, bot, max_concurrency, max_pending, dedup_ttl):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.max_pending = max_pending
+        self.accepting = True
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._seen = TTLCache(maxsize=max(max_pending * 10, 10000), ttl=dedup_ttl)
+        self._tasks = set()
+        self._tails = {}  # пользователь -> последняя задача его обновлений
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def feed(self, data):
+        """
+        Принимает обновление. False — обновление не принято и Telegram стоит повторить его позже.
+        """
+        if not self.accepting or len(self._tasks) >= self.max_pending:
+            return False
+
+        from aiogram.types import Update  # aiogram импортируется долго, а views загружаются и без webhook
+
+        update = Update.model_validate(data, context={'bot': self.bot})
+        if self._seen.get(update.update_id):
+            return True  # Повторная доставка того же обновления
+        self._seen.set(update.update_id, True)
+
+        key = update_key(update)
+        task = asyncio.create_task(self._process(update, self._tails.get(key)))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return True
+
+    def _finished(self, key, task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _process(self, update, previous):
+        if previous is not None:
+            # Предыдущее сообщение пользователя еще обрабатывается; его ошибка или отмена не мешают этому
+            await asyncio.wait({previous})
+        async with self._semaphore:
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"Error while processing update {update.update_id}: {e}")
+
+    async def drain(self, timeout):
+        """
+        Перестает принимать обновления и ждет завершения начатых, не дольше timeout секунд.
+        """
+        self.accepting = False
+        if not self._tasks:
+            return
+        logging.info(f"Draining {len(self._tasks)} webhook updates")
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logging.warning(f"Cancelled {len(pending)} webhook updates after {timeout} s")
+
+
+_webhook = None
+_background = []
+_startup = None  # Задача запуска бота, общая для lifespan и первого обновления
+
+
+def get_webhook_dispatcher():
+    global _webhook
+    if _webhook is None:
+        from chatbot.bots import bot, dp
+
+        _webhook = WebhookDispatcher(
+            dp, bot,
+            max_concurrency=settings.WEBHOOK_MAX_CONCURRENCY,
+            max_pending=settings.WEBHOOK_MAX_PENDING,
+            dedup_ttl=settings.WEBHOOK_DEDUP_TTL,
+        )
+        metrics.gauge('webhook_pending', lambda: len(_webhook))
+    return _webhook
+
+
+async def _start_webhook():
+    from chatbot.bots import startup_bot
+
+    _background.extend(await startup_bot())
+    get_webhook_dispatcher()
+    logging.info("Telegram webhook mode started")
+
+
+async def startup_webhook():
+    """
+    Готовит бота один раз на процесс; параллельные вызовы ждут один и тот же запуск.
+    После ошибки следующий вызов запускает бота заново.
+    """
+    global _startup
+    if _startup is None:
+        _startup = asyncio.ensure_future(_start_webhook())
+    startup = _startup
+    try:
+        await asyncio.shield(startup)
+    except Exception:
+        if _startup is startup:
+            _startup = None
+        raise
+
+
+async def ensure_webhook_started():
+    """
+    Бот запускается событием lifespan при старте сервера. Если сервер не поддерживает lifespan
+    (или он выключен), бот запускается при первом обновлении, но без дренажа очереди при остановке.
+    """
+    if _startup is None:
+        logging.warning(
+            "ASGI lifespan startup did not run: starting the Telegram bot on the first webhook update, "
+            "pending updates will not be drained on shutdown"
+        )
+    await startup_webhook()
+
+
+async def shutdown_webhook():
+    from chatbot.bots import shutdown_bot
+
+    await get_webhook_dispatcher().drain(settings.WEBHOOK_DRAIN_TIMEOUT)
+    await shutdown_bot(_background)
+    _background.clear()
+
+
+class WebhookLifespan:
+    """
+    ASGI-обертка: обрабатывает lifespan-события (Django их не поддерживает),
+    чтобы подготовить бота при старте сервера и дождаться обработчиков при остановке.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'lifespan':
+            return await self.app(scope, receive, send)
+
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if settings.TELEGRAM_WEBHOOK_ENABLED:
+                        await startup_webhook()
+                except Exception as e:
+                    logging.error(f"Error while starting Telegram webhook: {e}")
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    if settings.TELEGRAM_WEBHOOK_ENABLED:
+                        await shutdown_webhook()
+                finally:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                return
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+import zlib
+
+from django.conf import settings
+
+from chatbot.metrics import Metrics, metrics, start_metrics_server
+from chatbot.webhook import WebhookDispatcher, update_key
+
+# Бот в нескольких процессах на одном сервере (run_bot --workers N).
+# Супервизор получает обновления long polling'ом и раздает их воркерам по хешу id пользователя,
+# поэтому состояние FSM пользователя остается в одном процессе, а WebhookDispatcher воркера
+# обрабатывает его сообщения по очереди.
+# Воркер — отдельный процесс `run_bot --worker-shard K`: обновления приходят ему в stdin
+# строками JSON, обратно в stdout раз в STATS_INTERVAL секунд уходят снимки метрик.
+# Запуск воркера заканчивается строкой {"ready": true}; обновления супервизор начинает получать,
+# когда готовы все воркеры.
+
+POLL_TIMEOUT = 30
+STATS_INTERVAL = 5
+# Задержка перезапуска упавшего воркера растет вдвое до RESTART_MAX_DELAY
+# и сбрасывается, если воркер перед падением проработал дольше STABLE_UPTIME
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 30
+STABLE_UPTIME = 60
+# Строка JSON с обновлением или снимком метрик
+LINE_LIMIT = 1 << 24
+# Лимиты на бота целиком (Telegram, OpenAI) и на сервер (соединения с базой) делятся между воркерами
+SHARED_LIMITS = (
+    'TELEGRAM_GLOBAL_RATE', 'LLM_REQUESTS_PER_MINUTE', 'LLM_TOKENS_PER_MINUTE',
+    'LLM_MAX_CONCURRENCY', 'LLM_HTTP_MAX_CONNECTIONS', 'DB_POOL_SIZE',
+)
+
+_STOP = object()
+
+
+def split_limits(workers):
+    """
+    Делит общие лимиты между воркерами. Вызывается до импорта chatbot.bots,
+    который создает клиентов с этими лимитами.
+    """
+    for name in SHARED_LIMITS:
+        value = getattr(settings, name)
+        if not value:
+            continue  # 0 — без ограничения
+        if isinstance(value, int):
+            setattr(settings, name, max(1, value // workers))
+        else:
+            setattr(settings, name, value / workers)
+
+
+def shard_of(update, workers):
+    """
+    Номер воркера для обновления: по id пользователя, если его нет — по чату.
+    """
+    return zlib.crc32(str(update_key(update)).encode()) % workers
+
+
+class Supervisor:
+    """
+    Получает обновления, раздает их воркерам и перезапускает упавших.
+    Пока воркер перезапускается, его обновления копятся в очереди (не больше max_pending),
+    при переполнении любой очереди прием обновлений приостанавливается.
+    """
+
+    def __init__(self, bot, workers, command, allowed_updates=None, max_pending=1000):
+        self.bot = bot
+        self.workers = workers
+        self.command = command  # Команда запуска воркера без --worker-shard
+        self.allowed_updates = allowed_updates
+        self.queues = [asyncio.Queue(maxsize=max_pending) for _ in range(workers)]
+        self.snapshots = {}  # номер воркера -> последний снимок его метрик
+        self._pending = [None] * workers  # Строка, которую не удалось передать упавшему воркеру
+        self._processes = {}
+        self._ready_shards = set()
+        self._all_ready = asyncio.Event()
+        self._stopping = False
+
+    def render(self):
+        """
+        Метрики всех процессов вместе (для start_metrics_server).
+        """
+        registry = Metrics()
+        registry.merge(metrics.snapshot())
+        for snapshot in self.snapshots.values():
+            registry.merge(snapshot)
+        return registry.render()
+
+    def is_ready(self):
+        """
+        Все воркеры запущены и готовы (для /ready сервера метрик).
+        """
+        return len(self._ready_shards) == self.workers
+
+    async def run(self):
+        for shard, queue in enumerate(self.queues):
+            metrics.gauge(f'worker_{shard}_queue', queue.qsize)
+        supervisors = [asyncio.create_task(self._supervise(shard)) for shard in range(self.workers)]
+        poll = asyncio.create_task(self._poll())
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, poll.cancel)
+        try:
+            await poll
+        except asyncio.CancelledError:
+            pass
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            await self._stop(supervisors)
+
+    async def _stop(self, supervisors):
+        # Воркеры дорабатывают очередь, получают конец stdin и завершаются сами
+        self._stopping = True
+        for queue in self.queues:
+            try:
+                queue.put_nowait(_STOP)
+            except asyncio.QueueFull:
+                asyncio.create_task(queue.put(_STOP))
+        timeout = settings.WEBHOOK_DRAIN_TIMEOUT + settings.TELEGRAM_SEND_DRAIN_TIMEOUT + 5
+        _, pending = await asyncio.wait(supervisors, timeout=timeout)
+        for process in self._processes.values():
+            if process.returncode is None:
+                logging.warning(f"Killing bot worker {process.pid}")
+                process.kill()
+        for task in pending:
+            task.cancel()
+
+    async def _poll(self):
+        started = time.monotonic()
+        await self._all_ready.wait()
+        logging.info(f"All {self.workers} bot workers ready in {time.monotonic() - started:.2f} s")
+        offset = None
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    offset=offset, timeout=POLL_TIMEOUT, allowed_updates=self.allowed_updates,
+                    request_timeout=POLL_TIMEOUT + 10,
+                )
+            except Exception as e:
+                logging.error(f"Error while getting updates: {e}")
+                await asyncio.sleep(RESTART_DELAY)
+                continue
+            for update in updates:
+                shard = shard_of(update, self.workers)
+                metrics.inc('updates_routed', shard=shard)
+                line = update.model_dump_json(exclude_unset=True).encode() + b'\n'
+                await self.queues[shard].put(line)
+                offset = update.update_id + 1
+
+    async def _supervise(self, shard):
+        delay = RESTART_DELAY
+        while True:
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                *self.command, '--worker-shard', str(shard),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                cwd=settings.BASE_DIR, limit=LINE_LIMIT,
+            )
+            self._processes[shard] = process
+            logging.info(f"Bot worker {shard} started (pid {process.pid})")
+            tasks = [
+                asyncio.create_task(self._feed(shard, process)),
+                asyncio.create_task(self._read_stats(shard, process)),
+            ]
+            code = await process.wait()
+            self._ready_shards.discard(shard)
+            for task in tasks:
+                task.cancel()
+            if self._stopping:
+                return
+
+            metrics.inc('worker_restarts', shard=shard)
+            if time.monotonic() - started > STABLE_UPTIME:
+                delay = RESTART_DELAY
+            logging.error(f"Bot worker {shard} exited with code {code}, restarting in {delay} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_MAX_DELAY)
+
+    async def _feed(self, shard, process):
+        queue = self.queues[shard]
+        while True:
+            if self._pending[shard] is None:
+                self._pending[shard] = await queue.get()
+            line = self._pending[shard]
+            if line is _STOP:
+                process.stdin.close()
+                return
+            try:
+                process.stdin.write(line)
+                await process.stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                return  # Воркер упал, строку передадим следующему процессу
+            self._pending[shard] = None
+
+    async def _read_stats(self, shard, process):
+        async for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                logging.warning(f"Unexpected output from bot worker {shard}: {line[:200]!r}")
+                continue
+            if 'metrics' in message:
+                self.snapshots[shard] = message['metrics']
+            if message.get('ready'):
+                self._ready_shards.add(shard)
+                if self.is_ready():
+                    self._all_ready.set()
+
+
+async def run_supervisor(workers):
+    from chatbot.bots import bot, dp
+
+    supervisor = Supervisor(
+        bot, workers,
+        command=[sys.executable, '-m', 'django', 'run_bot', '--workers', str(workers)],
+        allowed_updates=dp.resolve_used_update_types(),
+        max_pending=settings.WEBHOOK_MAX_PENDING,
+    )
+    metrics_server = None
+    if settings.METRICS_ENABLED and settings.METRICS_PORT:
+        metrics_server = await start_metrics_server(
+            settings.METRICS_HOST, settings.METRICS_PORT, registry=supervisor, ready=supervisor.is_ready,
+        )
+    logging.info(f"Bot supervisor started with {workers} workers")
+    try:
+        await supervisor.run()
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await bot.session.close()
+
+
+def _write(message):
+    sys.stdout.buffer.write(json.dumps(message).encode() + b'\n')
+    sys.stdout.buffer.flush()
+
+
+def _write_stats():
+    _write({'metrics': metrics.snapshot()})
+
+
+async def _report_stats(interval):
+    while True:
+        await asyncio.sleep(interval)
+        _write_stats()
+
+
+async def run_worker(shard, workers):
+    # Останавливает воркер супервизор (концом stdin), сигналы от терминала и systemd получает он
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    split_limits(workers)
+
+    from chatbot.bots import bot, dp, shutdown_bot, startup_bot
+
+    background = await startup_bot()
+    dispatcher = WebhookDispatcher(
+        dp, bot,
+        max_concurrency=settings.WEBHOOK_MAX_CONCURRENCY,
+        max_pending=settings.WEBHOOK_MAX_PENDING,
+        dedup_ttl=settings.WEBHOOK_DEDUP_TTL,
+    )
+    metrics.gauge('worker_pending', lambda: len(dispatcher))
+    stats = asyncio.create_task(_report_stats(STATS_INTERVAL))
+
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    loop = asyncio.get_running_loop()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    _write({'ready': True})
+    logging.info(f"Bot worker {shard} of {workers} ready")
+    try:
+        async for line in reader:
+            data = json.loads(line)
+            # Воркер перегружен: не читаем stdin, обновления ждут в очереди супервизора
+            while not dispatcher.feed(data):
+                await asyncio.sleep(0.05)
+        await dispatcher.drain(settings.WEBHOOK_DRAIN_TIMEOUT)
+    finally:
+        stats.cancel()
+        await shutdown_bot(background)
+        _write_stats()
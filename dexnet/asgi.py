@@ -13,4 +13,7 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dexnet.settings')
 
-application = get_asgi_application()
+# WebhookLifespan запускает и корректно останавливает бота в режиме webhook
+from chatbot.webhook import WebhookLifespan  # noqa: E402
+
+application = WebhookLifespan(get_asgi_application())
@@ -27,7 +27,7 @@ SECRET_KEY = os.environ['SECRET_KEY']
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = [host for host in os.getenv('ALLOWED_HOSTS', '').split(',') if host]
 
 
 # Application definition
@@ -39,6 +39,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
 
     'chatbot',
@@ -85,10 +86,16 @@ DATABASES = {
         'USER': os.environ['DB_USER'],
         'PORT': os.environ['DB_PORT'],
         'HOST': os.environ['DB_HOST'],
-        'PASSWORD': os.environ['DB_PASSWORD']
+        'PASSWORD': os.environ['DB_PASSWORD'],
+        # Постоянные соединения: каждый поток пула бота (DB_POOL_SIZE) держит свое соединение
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# Сколько запросов к базе бот выполняет параллельно (потоков в пуле chatbot.db)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -130,3 +137,137 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Telegram bot
+
+# Поиск по FAQ в памяти процесса бота вместо запросов к базе на каждое сообщение
+FAQ_INDEX_ENABLED = os.getenv('FAQ_INDEX_ENABLED', 'true').lower() == 'true'
+# Как часто (в секундах) бот проверяет, не изменились ли FAQ в других процессах
+FAQ_INDEX_REFRESH_SECONDS = float(os.getenv('FAQ_INDEX_REFRESH_SECONDS', 30))
+# Минимальная доля совпавших слов запроса, чтобы вопрос попал в варианты
+FAQ_INDEX_MIN_SCORE = float(os.getenv('FAQ_INDEX_MIN_SCORE', 0.3))
+# Максимум вариантов, которые бот предлагает на уточнение
+FAQ_SEARCH_LIMIT = int(os.getenv('FAQ_SEARCH_LIMIT', 9))
+
+# Поиск с опечатками по триграммам (pg_trgm в базе, TrigramIndex в памяти): при близости
+# не ниже FAQ_FUZZY_EXACT_SCORE вопрос считается точным совпадением (только почти дословный:
+# "тариф 5000" и 'Тариф "500"' близки на 0.77), не ниже MIN_SCORE — вариантом на уточнение.
+# Порог pg_trgm.similarity_threshold в базе по умолчанию 0.3, меньший MIN_SCORE там не действует
+FAQ_FUZZY_ENABLED = os.getenv('FAQ_FUZZY_ENABLED', 'true').lower() == 'true'
+FAQ_FUZZY_EXACT_SCORE = float(os.getenv('FAQ_FUZZY_EXACT_SCORE', 0.9))
+FAQ_FUZZY_MIN_SCORE = float(os.getenv('FAQ_FUZZY_MIN_SCORE', 0.3))
+
+# Режим поиска: lexical — только по словам, semantic — похожие вопросы по эмбеддингам,
+# hybrid — эмбеддинги только если по словам ничего не нашлось
+FAQ_SEARCH_MODE = os.getenv('FAQ_SEARCH_MODE', 'lexical')
+# Эмбеддер: hashing (локальный, без сети), sentence-transformers, openai или путь к своему классу
+FAQ_EMBEDDER = os.getenv('FAQ_EMBEDDER', 'hashing')
+FAQ_EMBEDDING_MODEL = os.getenv('FAQ_EMBEDDING_MODEL')
+# Файл с предрасчитанными векторами вопросов
+FAQ_EMBEDDINGS_PATH = os.getenv('FAQ_EMBEDDINGS_PATH', str(BASE_DIR / 'faq_embeddings.npz'))
+# Минимальная косинусная близость для вариантов и для ответа без уточнения
+FAQ_SEMANTIC_MIN_SCORE = float(os.getenv('FAQ_SEMANTIC_MIN_SCORE', 0.5))
+FAQ_SEMANTIC_EXACT_SCORE = float(os.getenv('FAQ_SEMANTIC_EXACT_SCORE', 0.9))
+
+# Кэш ответов ChatGPT: максимум записей (0 — выключен) и время жизни в секундах
+LLM_CACHE_SIZE = int(os.getenv('LLM_CACHE_SIZE', 1000))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 6 * 60 * 60))
+
+# Ответ ChatGPT показывается по мере генерации (правками сообщения не чаще раза в интервал)
+LLM_STREAM_REPLIES = os.getenv('LLM_STREAM_REPLIES', 'true').lower() == 'true'
+LLM_STREAM_EDIT_INTERVAL = float(os.getenv('LLM_STREAM_EDIT_INTERVAL', 1.0))
+# Сколько ждать ответа (при потоковом показе — первых токенов) и сколько максимум дописывать ответ
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 15))
+LLM_STREAM_TIMEOUT = float(os.getenv('LLM_STREAM_TIMEOUT', 60))
+
+# Хранилище состояний диалога (FSM): memory — в памяти процесса, database — в основной базе,
+# sqlite — локальный файл. Для нескольких процессов бота нужен database или sqlite
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+FSM_SQLITE_PATH = os.getenv('FSM_SQLITE_PATH', str(BASE_DIR / 'fsm.sqlite3'))
+# Время жизни состояния и интервал удаления устаревших записей (секунды)
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', 24 * 60 * 60))
+FSM_PURGE_INTERVAL = float(os.getenv('FSM_PURGE_INTERVAL', 60 * 60))
+
+# Режим webhook: обновления принимает ASGI-приложение (dexnet.asgi) по адресу /telegram/webhook/
+TELEGRAM_WEBHOOK_ENABLED = os.getenv('TELEGRAM_WEBHOOK_ENABLED', 'false').lower() == 'true'
+# Публичный адрес webhook (регистрируется командой run_bot --set-webhook) и секрет для проверки запросов
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET', '')
+# Максимум одновременно работающих обработчиков и принятых, но не обработанных обновлений
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv('WEBHOOK_MAX_CONCURRENCY', 100))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', 1000))
+# Сколько помнить update_id для отбрасывания повторов и сколько ждать обработчики при остановке
+WEBHOOK_DEDUP_TTL = float(os.getenv('WEBHOOK_DEDUP_TTL', 10 * 60))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv('WEBHOOK_DRAIN_TIMEOUT', 25))
+
+# Число процессов бота в режиме polling (run_bot --workers): обновления делятся между ними
+# по id пользователя, общие лимиты Telegram, OpenAI и пул соединений с базой — поровну
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', 1))
+
+# Очередь отправки в Telegram: сообщений в секунду на бота, в личный чат (и допустимый всплеск),
+# в группу; число параллельных запросов к Bot API и сколько ждать отправки очереди при остановке (с)
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE', 20 / 60))
+TELEGRAM_SEND_WORKERS = int(os.getenv('TELEGRAM_SEND_WORKERS', 16))
+TELEGRAM_SEND_DRAIN_TIMEOUT = float(os.getenv('TELEGRAM_SEND_DRAIN_TIMEOUT', 10))
+
+# Отложенная запись истории (UserQuery, FAQLearning): размер пачки, максимальная задержка записи (с)
+# и предел очереди, после которого обработчики ждут записи
+HISTORY_BATCH_SIZE = int(os.getenv('HISTORY_BATCH_SIZE', 200))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', 0.5))
+HISTORY_MAX_PENDING = int(os.getenv('HISTORY_MAX_PENDING', 10000))
+
+# Хранение истории (команда purge_history, запускается по расписанию): через сколько дней запросы
+# переносятся из UserQuery в архив и через сколько дней удаляются из архива (0 — хранить всегда),
+# размер пачки переноса
+HISTORY_RETENTION_DAYS = int(os.getenv('HISTORY_RETENTION_DAYS', 90))
+HISTORY_ARCHIVE_RETENTION_DAYS = int(os.getenv('HISTORY_ARCHIVE_RETENTION_DAYS', 365))
+HISTORY_PURGE_BATCH_SIZE = int(os.getenv('HISTORY_PURGE_BATCH_SIZE', 5000))
+
+# Кэш последних ходов диалога: сколько пользователей держать, сколько ходов на пользователя
+# и через сколько секунд без сообщений пользователь вытесняется
+CONVERSATION_CACHE_USERS = int(os.getenv('CONVERSATION_CACHE_USERS', 100000))
+CONVERSATION_CACHE_TURNS = int(os.getenv('CONVERSATION_CACHE_TURNS', 10))
+CONVERSATION_CACHE_TTL = float(os.getenv('CONVERSATION_CACHE_TTL', 6 * 60 * 60))
+# Через сколько секунд история пользователя в кэше перечитывается из базы (0 — никогда).
+# Нужно, когда сообщения одного пользователя обрабатывают разные процессы: webhook за несколькими
+# воркерами сервера. Режим polling и run_bot --workers закрепляют пользователя за процессом
+CONVERSATION_CACHE_REFRESH = float(os.getenv(
+    'CONVERSATION_CACHE_REFRESH', 5 if TELEGRAM_WEBHOOK_ENABLED else 0
+))
+
+# Запросы к OpenAI: максимум одновременных запросов и соединений в общем пуле,
+# таймаут ожидания очередного фрагмента ответа (с)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 20))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', 50))
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 30))
+# Лимиты тарифа API: запросов и токенов в минуту (0 — без ограничения) и ожидаемая длина ответа в токенах
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 3500))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 200000))
+LLM_COMPLETION_TOKENS = int(os.getenv('LLM_COMPLETION_TOKENS', 300))
+# Повторы при 429, 5xx и сетевых ошибках: количество и границы задержки с джиттером (с)
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 3))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv('LLM_RETRY_MAX_DELAY', 8))
+# Через сколько секунд без первых токенов отправить страхующий второй запрос (0 — не отправлять)
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', 0))
+# Сколько соединений с OpenAI открыть при запуске бота, до первых вопросов (0 — не открывать)
+LLM_WARMUP_CONNECTIONS = int(os.getenv('LLM_WARMUP_CONNECTIONS', 2))
+
+# Бюджет токенов контекста ChatGPT (промпт, история, вопрос) и из него — на сводку старых ходов
+LLM_CONTEXT_TOKENS = int(os.getenv('LLM_CONTEXT_TOKENS', 1500))
+LLM_SUMMARY_TOKENS = int(os.getenv('LLM_SUMMARY_TOKENS', 300))
+
+# Метрики задержек этапов обработки сообщений (/metrics) и доступ к ним по токену
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Без токена метрики закрыты (кроме DEBUG); METRICS_PUBLIC=true открывает их всем явно
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+# Порт отдельного сервера метрик для бота в режиме polling (0 — не запускать)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+# Доля сообщений, обработка которых профилируется cProfile (0 — профилировщик выключен)
+METRICS_PROFILE_RATE = float(os.getenv('METRICS_PROFILE_RATE', 0))
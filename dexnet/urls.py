@@ -17,6 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 
+from chatbot import views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('telegram/webhook/', views.telegram_webhook, name='telegram-webhook'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('ready', views.ready_view, name='ready'),
 ]
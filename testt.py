@@ -1,6 +1,11 @@
-import json,os
-from telethon.sync import TelegramClient
-from telethon.tl.functions.messages import GetHistoryRequest
+import asyncio
+import json
+import os
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from chatbot.text import split_qa_pairs
 
 # Конфигурация для подключения к Telegram API
 api_id = os.getenv('API_ID')
@@ -8,86 +13,138 @@ api_hash =os.getenv('API_HASH')
 bot_token = os.getenv('BOT_TOKEN')
 chat_id = os.getenv('GROUP_ID')  # ID группы
 
+# Пары дописываются в JSONL (загрузка в FAQ: python manage.py import_faq qa_data.jsonl),
+# а id последнего обработанного сообщения хранится в файле состояния,
+# поэтому повторный запуск скачивает только новые сообщения
+OUTPUT_FILE = os.getenv('QA_DATA_FILE', 'qa_data.jsonl')
+STATE_FILE = os.getenv('SCRAPER_STATE_FILE', 'qa_state.json')
+CONCURRENCY = int(os.getenv('SCRAPER_CONCURRENCY', 4))  # Сколько диапазонов истории качаем одновременно
+RANGE_SIZE = 2000  # Сколько id сообщений в одном диапазоне
+FLUSH_EVERY = 500  # Как часто сбрасывать файл на диск, в парах
+
 client = TelegramClient('session_name', api_id, api_hash)
 
-async def get_all_messages_from_group(group_name):
-    async with client:
-        entity = await client.get_entity(group_name)
-        all_messages = []
-        offset_id = 0
-        limit = 100
-
-        while True:
-            history = await client(GetHistoryRequest(
-                peer=entity,
-                offset_id=offset_id,
-                offset_date=None,
-                add_offset=0,
-                limit=limit,
-                max_id=0,
-                min_id=0,
-                hash=0
-            ))
-
-            if not history.messages:
-                break
-
-            all_messages.extend(history.messages)
-            offset_id = history.messages[-1].id
-
-        return all_messages
-
-def split_by_colon(text):
+
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return {}
+    with open(STATE_FILE, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state):
+    # Через временный файл, чтобы при падении не остаться с испорченным состоянием
+    tmp_path = f"{STATE_FILE}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def prepare_qa_data(message):
     """
-    Разбивает текст на пары 'вопрос-ответ' по двоеточиям.
+    Пары вопрос-ответ из одного сообщения.
     """
-    pairs = []
-    parts = [p.strip() for p in text.split('\n') if p.strip()]
-
-    for part in parts:
-        if ':' in part:
-            question, answer = part.split(':', 1)
-            pairs.append({
-                "question": question.strip() + ":",
-                "answer": answer.strip()
-            })
-        elif pairs:
-            # Если это продолжение ответа для предыдущего вопроса
-            pairs[-1]['answer'] += f"\n{part}"
-
-    # Удаляем пары, где ответ пустой
-    return [pair for pair in pairs if pair['answer']]
-
-def prepare_qa_data(messages):
+    if not message.message:
+        return []
+    return split_qa_pairs(message.message.strip())
+
+
+async def fetch_range(entity, low, high, queue):
     """
-    Формирует список вопросов и ответов из сообщений.
+    Сообщения с id в (low, high], от старых к новым. При FloodWait ждет и продолжает
+    с последнего полученного сообщения.
     """
-    qa_pairs = []
-
-    for message in messages:
-        if not message.message:
+    offset = low
+    while True:
+        try:
+            async for message in client.iter_messages(entity, min_id=offset, max_id=high + 1, reverse=True, wait_time=0):
+                pairs = prepare_qa_data(message)
+                if pairs:
+                    await queue.put(('pairs', message.id, pairs))
+                offset = message.id
+            break
+        except FloodWaitError as e:
+            print(f"FloodWait: ждем {e.seconds} с")
+            await asyncio.sleep(e.seconds + 1)
+    await queue.put(('done', low, high))
+
+
+async def fetch_worker(entity, ranges, queue):
+    while not ranges.empty():
+        low, high = ranges.get_nowait()
+        await fetch_range(entity, low, high, queue)
+
+
+async def write_pairs(queue, output, ranges, state, group_name):
+    """
+    Дописывает пары в файл. Состояние сдвигается только на диапазоны, которые
+    скачаны целиком вместе со всеми предыдущими, поэтому прерванный запуск продолжится без пропусков.
+    """
+    done = set()
+    next_range = 0
+    written = 0
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        kind, *payload = item
+        if kind == 'pairs':
+            message_id, pairs = payload
+            for pair in pairs:
+                output.write(json.dumps({**pair, 'message_id': message_id}, ensure_ascii=False) + '\n')
+            written += len(pairs)
+            if written % FLUSH_EVERY < len(pairs):
+                output.flush()
             continue
 
-        text = message.message.strip()
-        pairs = split_by_colon(text)
-        qa_pairs.extend(pairs)
+        done.add(tuple(payload))
+        if next_range < len(ranges) and ranges[next_range] in done:
+            while next_range < len(ranges) and ranges[next_range] in done:
+                next_range += 1
+            output.flush()
+            os.fsync(output.fileno())
+            state[group_name] = ranges[next_range - 1][1]
+            save_state(state)
+    return written
 
-    return qa_pairs
 
-async def save_qa_to_json(messages, filename="qa_data.json"):
-    qa_pairs = prepare_qa_data(messages)
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(qa_pairs, f, ensure_ascii=False, indent=4)
+async def sync_group(group_name):
+    state = load_state()
+    last_id = state.get(group_name, 0)
 
-async def main():
-    group_name = os.getenv('GROUP_NAME')
-    messages = await get_all_messages_from_group(group_name)
+    async with client:
+        entity = await client.get_entity(group_name)
+        latest = await client.get_messages(entity, limit=1)
+        if not latest or latest[0].id <= last_id:
+            return 0
+
+        ranges = [(low, min(low + RANGE_SIZE, latest[0].id)) for low in range(last_id, latest[0].id, RANGE_SIZE)]
+        pending = asyncio.Queue()
+        for item in ranges:
+            pending.put_nowait(item)
+
+        queue = asyncio.Queue(maxsize=1000)
+        with open(OUTPUT_FILE, 'a', encoding='utf-8') as output:
+            writer = asyncio.create_task(write_pairs(queue, output, ranges, state, group_name))
+            workers = [
+                asyncio.create_task(fetch_worker(entity, pending, queue))
+                for _ in range(min(CONCURRENCY, len(ranges)))
+            ]
+            try:
+                await asyncio.gather(*workers)
+                await queue.put(None)
+                return await writer
+            finally:
+                for task in workers + [writer]:
+                    task.cancel()
 
-    # Форматируем и сохраняем данные как QA-пары
-    await save_qa_to_json(messages)
 
-    print("Данные сохранены в qa_data.json")
+async def main():
+    group_name = os.getenv('GROUP_NAME')
+    written = await sync_group(group_name)
 
-client.loop.run_until_complete(main())
+    print(f"Новых пар: {written}, данные дописаны в {OUTPUT_FILE}")
 
 
+if __name__ == '__main__':
+    client.loop.run_until_complete(main())